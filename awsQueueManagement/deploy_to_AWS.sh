@@ -12,7 +12,13 @@ cd lambda_package
 zip -r ../lambda_package.zip *
 cd ..
 zip -g lambda_package.zip lambda_function.py
+zip -g lambda_package.zip aws_clients.py
 zip -g lambda_package.zip variables.json
+echo -e "\e[35m\e[1mcreate missing SQS queues\e[21m"
+# create-queue does nothing if the queue already exists with the same attributes
+for QUEUE_NAME in $(python -c "import json; print(' '.join(name.lower() for name in json.load(open('variables.json'))['aws_queues'].values()))"); do
+    aws sqs create-queue --queue-name ${QUEUE_NAME}
+done
 echo -e "\e[35m\e[1mupdate lambda function on AWS\e[21m"
 aws lambda update-function-code --function-name ${AWS_LAMBDAFUNCTION_NAME} --zip-file fileb://lambda_package.zip
 echo -e "\e[35m\e[1mclean artifacts\e[21m"
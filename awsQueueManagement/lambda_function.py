@@ -13,33 +13,120 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import boto3
 import json
+import os
+import time
+import collections
 
+import aws_clients
+from aws_clients import get_client
+
+lambda_dir = os.path.dirname(os.path.abspath(__file__))
+
+# parameters of the lambda (variables.json), loaded once per container
+params = None
+# queue name -> queue url, kept while the container is warm
+_queue_urls = {}
+max_messages_per_batch = 10
+max_send_attempts = 3
+
+
+def init_container():
+    """
+    load the parameters and set up the boto3 clients, once per container
+    """
+    global params
+    if params is not None:
+        return
+    with open(os.path.join(lambda_dir, "variables.json")) as f:
+        loaded_params = json.load(f)
+    aws_clients.configure(**loaded_params.get("aws_clients", {}))
+    params = loaded_params
+
+
+def get_queue_url(queue_name, refresh=False):
+    """
+    get the url of a queue, from the cache if it is known. Queues are created at deployment (see deploy_to_AWS.sh)
+
+    :param queue_name: name of the queue
+    :param refresh: if True, the url is asked to SQS even if it is in the cache
+    :return: url of the queue
+    """
+    if refresh or queue_name not in _queue_urls:
+        _queue_urls[queue_name] = get_client('sqs').get_queue_url(QueueName=queue_name)["QueueUrl"]
+    return _queue_urls[queue_name]
+
+
+def _send_message_batch(queue_name, entries):
+    """
+    send a batch of messages, asking the url of the queue again if the call fails (the queue may have been recreated)
+
+    :return: list of the ids of the entries which failed
+    """
+    sqs = get_client('sqs')
+    try:
+        response = sqs.send_message_batch(QueueUrl=get_queue_url(queue_name), Entries=entries)
+    except Exception as e:
+        print("Could not send messages to {} ({}), retrying with a new queue url".format(queue_name, e))
+        response = sqs.send_message_batch(QueueUrl=get_queue_url(queue_name, refresh=True), Entries=entries)
+    return [failed["Id"] for failed in response.get("Failed", [])]
 
-def lambda_handler(event, context):
-    print(event)
 
-    with open("variables.json") as f:
-        params = json.load(f)
+def send_to_queue(queue_name, message_bodies):
+    """
+    send messages to a queue, by batches of max_messages_per_batch (send_message_batch).
+    Messages which failed in a batch are sent again, up to max_send_attempts times
 
-    sqs = boto3.resource('sqs')
+    :param queue_name: name of the queue
+    :param message_bodies: list of str
+    :return: number of SQS calls
+    """
+    nb_calls = 0
+    for batch_start in range(0, len(message_bodies), max_messages_per_batch):
+        entries = [{"Id": str(batch_start + i), "MessageBody": message_body}
+                   for i, message_body in enumerate(message_bodies[batch_start:batch_start + max_messages_per_batch])]
+        for attempt in range(max_send_attempts):
+            if attempt:
+                time.sleep(0.1 * 2 ** attempt)
+            failed_ids = _send_message_batch(queue_name, entries)
+            nb_calls += 1
+            entries = [entry for entry in entries if entry["Id"] in failed_ids]
+            if not entries:
+                break
+        if entries:
+            # the stream batch will be given again to the lambda
+            raise Exception("Could not send {} messages to {}".format(len(entries), queue_name))
+    return nb_calls
 
-    #check that queues exists, create those that don't
-    existing_queues = []
-    for queue in sqs.queues.all():
-        existing_queues.append(queue.attributes['QueueArn'].split(':')[-1])
 
-    queues_to_create = set(params["aws_queues"].values()) - set(existing_queues)
-    for queue_name in queues_to_create:
-        print('Creating queue : {}'.format(queue_name))
-        queue = sqs.create_queue(QueueName=queue_name)
-        print("Created queue: {}".format(queue.url))
+def get_last_step(image):
+    """
+    :param image: image of a document in a DynamoDB stream record (NewImage or OldImage), or None
+    :return: tuple (index, step name, state in lower case) of the last entry of process_steps, or None
+    """
+    if not image or not image.get("process_steps", {}).get("L"):
+        return None
+    process_steps = image["process_steps"]["L"]
+    last_step = process_steps[-1]["M"]
+    return len(process_steps) - 1, last_step["step"]["S"], last_step["state"]["S"].lower()
+
+
+def lambda_handler(event, context):
+    print(event)
+    init_container()
+
+    # queue name -> message bodies, sent by batches once all records are read
+    messages = collections.OrderedDict()
+    # (VideoId, step) already dispatched by this invocation
+    dispatched_steps = set()
 
     # process event (dynamoDB update)
     for record in event["Records"]:
         record = record["dynamodb"]
         videoId = record['Keys']["VideoId"]["N"]
+        if "NewImage" not in record:
+            # document removed
+            continue
         updated_values = record["NewImage"]
         s3_bucket = updated_values["bucket"]["S"]
         s3_key = updated_values["key"]["S"]
@@ -48,9 +135,10 @@ def lambda_handler(event, context):
             print("Ignoring videoId {} because not in the 'project' directory".format(videoId))
             continue
 
-        current_process_step = updated_values["process_steps"]["L"][-1]["M"]
-        step_name = current_process_step["step"]["S"]
-        step_status = current_process_step["state"]["S"]
+        current_process_step = get_last_step(updated_values)
+        if current_process_step is None:
+            continue
+        _, step_name, step_status = current_process_step
         try:
             current_process_step_ind = params["process_steps"].index(step_name)
         except ValueError as e:
@@ -61,7 +149,17 @@ def lambda_handler(event, context):
             print('Found state for step {} is not "done". skipping'.format(step_name))
             continue
 
-        if current_process_step == len(params["process_steps"]) - 1:
+        # only a step which has just been done is dispatched : later changes of the document (eg its sub_videos, or the claims of
+        # the next step) are skipped. Delivery is still at least once : a record given again after a failed invocation has the same
+        # OldImage and is dispatched again, as are the messages already sent by the failed invocation. The workers refuse the
+        # duplicates with the claims of the steps (see human_detector/src/video_documents.py)
+        if current_process_step == get_last_step(record.get("OldImage")):
+            print('Step {} of {} was already done. skipping'.format(step_name, videoId))
+            continue
+        if (videoId, step_name) in dispatched_steps:
+            continue
+
+        if current_process_step_ind == len(params["process_steps"]) - 1:
             continue
         next_process_step = params["process_steps"][current_process_step_ind+1]
 
@@ -70,16 +168,27 @@ def lambda_handler(event, context):
             print('Next process step does not have a queue yet. skipping')
             continue
         target_queue_name = params["aws_queues"][next_process_step].lower()
-        queue = sqs.get_queue_by_name(QueueName=target_queue_name)
-        message_body = json.dumps({
+        message = {
             'VideoId': videoId,
             "s3": {
                 "bucket": s3_bucket,
                 "key": s3_key
             }
-        })
-        queue.send_message(MessageBody=message_body)
-        print("sending {} to {}".format(message_body, target_queue_name))
+        }
+        if "parent_video" in updated_values:
+            # the workers interleave the clips they hold by match (see human_detector/src/match_interleaver.py)
+            message["parent_video"] = updated_values["parent_video"]["N"]
+        message_body = json.dumps(message)
+        messages.setdefault(target_queue_name, []).append(message_body)
+        dispatched_steps.add((videoId, step_name))
+
+    dispatched = {}
+    for target_queue_name, message_bodies in messages.items():
+        nb_calls = send_to_queue(target_queue_name, message_bodies)
+        dispatched[target_queue_name] = len(message_bodies)
+        print("sent {} messages to {} in {} calls : {}".format(len(message_bodies), target_queue_name, nb_calls, message_bodies))
+    print("dispatched {} records : {}".format(len(event["Records"]), dispatched))
+    return {"dispatched": dispatched}
 
 
 # if __name__ == "__main__":
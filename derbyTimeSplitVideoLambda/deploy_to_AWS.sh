@@ -21,6 +21,8 @@ cd lambda_package
 zip -r ../lambda_package.zip *
 cd ..
 zip -g lambda_package.zip lambda_function.py
+zip -g lambda_package.zip aws_clients.py
+zip -g lambda_package.zip video_documents.py
 zip -g lambda_package.zip variables.json
 
 echo -e "\e[35m\e[1mupdate lambda function on AWS\e[21m"
@@ -13,18 +13,45 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import time
+# start of the container initialisation (module import), for the cold start timing
+init_start_time = time.time()
+
 import json
 import os
 import tempfile
-import time
 import datetime
 import math
 import random
 import decimal
-import boto3
+import collections
+import struct
+import threading
+import csv
+import shutil
+import subprocess
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from boto3.s3.transfer import TransferConfig
+import aws_clients
+from aws_clients import get_client, get_resource
+from video_documents import append_sub_videos, set_process_step_state, set_video_attributes, VideoDocumentsBatchWriter
+
+lambda_dir = os.path.dirname(os.path.abspath(__file__))
+os.environ["IMAGEIO_FFMPEG_EXE"] = os.path.join(lambda_dir, 'ffmpeg')
+
+
+def open_video_clip(video_file):
+    """
+    open a video with moviepy, which is imported on first use only : importing moviepy.editor takes seconds at each cold start,
+    and the "copy" split mode seldom needs it
 
-os.environ["IMAGEIO_FFMPEG_EXE"] = os.path.join(os.getcwd(), 'ffmpeg')
-from moviepy.editor import VideoFileClip
+    :param video_file: path to the video
+    :return: moviepy VideoFileClip
+    """
+    from moviepy.video.io.VideoFileClip import VideoFileClip
+    return VideoFileClip(video_file)
 
 
 
@@ -42,7 +69,7 @@ def get_video_from_s3(bucket_name, key, local_filename):
     :return: None
     """
     print("getting file {} from bucket {}".format(key, bucket_name))
-    s3 = boto3.resource('s3')
+    s3 = get_resource('s3')
 
     try:
         s3.Bucket(bucket_name).download_file(key, local_filename)
@@ -65,7 +92,7 @@ def put_video_to_s3(local_filename, bucket_name, key):
     :return: None
     """
     print("uploading file {} to bucket {}".format(key, bucket_name))
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
 
     try:
         s3.upload_file(local_filename, bucket_name, key)
@@ -74,6 +101,107 @@ def put_video_to_s3(local_filename, bucket_name, key):
         raise e
 
 
+default_range_size = 8 * 1024 * 1024
+default_nb_range_threads = 4
+
+
+class S3RangeReader(object):
+
+    def __init__(self, bucket_name, key, range_size=default_range_size, nb_threads=default_nb_range_threads):
+        """
+        file-like object reading a file on s3 from start to end, while the next ranges of the file are downloaded in parallel
+        (ranged GETs), so that the file can be used (eg by ffmpeg through a pipe) while its end is still downloading, and is
+        never written to disk. At most 2 * nb_threads ranges are held in memory. You must have access rights
+
+        :param bucket_name: name of the bucket
+        :param key: key of the file to read in the bucket
+        :param range_size: size of the ranges to download, in bytes
+        :param nb_threads: number of ranges downloaded at the same time
+        """
+        self._s3 = get_client('s3')
+        self._bucket_name = bucket_name
+        self._key = key
+        self._range_size = range_size
+        self.size = self._s3.head_object(Bucket=bucket_name, Key=key)["ContentLength"]
+
+        self._pool = ThreadPoolExecutor(max_workers=nb_threads)
+        self._max_ranges_ahead = 2 * nb_threads
+        self._ranges = collections.deque()
+        self._next_range_start = 0
+        self._buffer = b''
+        self._download_next_ranges()
+
+    def _download_next_ranges(self):
+        while len(self._ranges) < self._max_ranges_ahead and self._next_range_start < self.size:
+            range_end = min(self._next_range_start + self._range_size, self.size)
+            self._ranges.append(self._pool.submit(self._get_range, self._next_range_start, range_end))
+            self._next_range_start = range_end
+
+    def _get_range(self, start, end):
+        response = self._s3.get_object(Bucket=self._bucket_name, Key=self._key, Range="bytes={}-{}".format(start, end - 1))
+        return response["Body"].read()
+
+    def read(self, size=-1):
+        """
+        :param size: number of bytes to read, -1 to read until the end of the file
+        :return: bytes, empty at the end of the file
+        """
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while (size < 0 or length < size) and self._ranges:
+            chunks.append(self._ranges.popleft().result())
+            length += len(chunks[-1])
+            self._download_next_ranges()
+        data = b''.join(chunks)
+        if size < 0:
+            self._buffer = b''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+    def peek(self, size):
+        """
+        :param size: number of bytes to get
+        :return: the next bytes of the file, which are not consumed
+        """
+        data = self.read(size)
+        self._buffer = data + self._buffer
+        return data
+
+    def close(self):
+        for downloading_range in self._ranges:
+            downloading_range.cancel()
+        self._pool.shutdown(wait=False)
+
+
+def is_streamable(head, video_format):
+    """
+    check if a video can be read from start to end (ie through a pipe). Mp4/mov files are only if their index (moov box)
+    is before their data (mdat box) ("faststart" files)
+
+    :param head: first bytes of the file
+    :param video_format: extension of the file
+    :return: bool
+    """
+    if video_format.lower() not in ["mp4", "mov", "m4v"]:
+        return True
+    position = 0
+    while position + 8 <= len(head):
+        box_size, box_type = struct.unpack(">I4s", head[position:position + 8])
+        if box_type == b'moov':
+            return True
+        if box_type == b'mdat':
+            return False
+        if box_size == 1:
+            if position + 16 > len(head):
+                break
+            box_size = struct.unpack(">Q", head[position + 8:position + 16])[0]
+        if box_size < 8:
+            break
+        position += box_size
+    return False
+
+
 #####################
 # DynamoDB functions
 #####################
@@ -113,7 +241,7 @@ def send_video_info_to_dynamo_db(region_id, tableId, document):
     :param document: dict to insert
     :return: None
     """
-    dynamodb = boto3.resource('dynamodb', region_name=region_id) #, endpoint_url="http://localhost:8000")
+    dynamodb = get_resource('dynamodb', region_id)
     table = dynamodb.Table(tableId)
     # trick to turn floats and ints to Decimal for DynamoDB
     response = table.put_item(Item=json.loads(json.dumps(document), parse_float=decimal.Decimal))
@@ -125,10 +253,361 @@ def send_video_info_to_dynamo_db(region_id, tableId, document):
 # split functions
 ###############
 
+split_modes = ["encode", "copy"]
+default_nb_encoding_processes = 2
+default_nb_upload_threads = 4
+
+
+def compute_split_ranges(duration, subvid_duration_in_sec):
+    """
+    cut a video in consecutive time ranges
+
+    :param duration: duration of the video, in sec
+    :param subvid_duration_in_sec: length of the ranges in seconds. Last range may be shorter
+    :return: list of tuple (start, end), in sec
+    """
+    ranges = []
+    current_start = 0
+    while current_start < duration:
+        ranges.append((current_start, min(current_start + subvid_duration_in_sec, duration)))
+        current_start += subvid_duration_in_sec
+    return ranges
+
+
+def encode_subclips(video_file, subclips):
+    """
+    encode subclips of a video to files
+
+    :param video_file: path to the video
+    :param subclips: list of tuple (index, start, end, output_file)
+    :return: generator of tuple (index, output_file, dict of the subclip information
+             {"size", "fps", "duration", "audio", "start_time", "end_time"}), as each subclip is written
+    """
+    video_object = open_video_clip(video_file)
+    try:
+        for index, start, end, output_file in subclips:
+            new_subvid = video_object.subclip(start, end)
+            new_subvid.write_videofile(output_file)
+            yield index, output_file, {"size": new_subvid.size,
+                                       "fps": new_subvid.fps,
+                                       "duration": new_subvid.duration,
+                                       "audio": (new_subvid.audio is not None),
+                                       "start_time": start,
+                                       "end_time": end}
+    finally:
+        video_object.close()
+
+
+def _encoding_process(video_file, subclips, connection):
+    """
+    target of the encoding processes : encode subclips and send the results through connection, then None when done
+    (or the error if there is one)
+    """
+    try:
+        for result in encode_subclips(video_file, subclips):
+            connection.send(result)
+        connection.send(None)
+    except Exception as e:
+        connection.send(Exception("Error encoding subclips of {} : {}".format(video_file, e)))
+    finally:
+        connection.close()
+
+
+def split_in_subclips(video_file, subclips, nb_processes=default_nb_encoding_processes):
+    """
+    encode subclips of a video to files, with several processes working on disjoint subclips
+
+    IMPORTANT : multiprocessing pools and queues do not work on lambda (no /dev/shm), so each process gets its subclips
+    at start and sends the results back through a pipe
+
+    :param video_file: path to the video
+    :param subclips: list of tuple (index, start, end, output_file)
+    :param nb_processes: number of encoding processes. If 1, subclips are encoded in the current process
+    :return: generator of tuple (index, output_file, dict of the subclip information), as each subclip is written
+    """
+    if nb_processes <= 1:
+        yield from encode_subclips(video_file, subclips)
+        return
+
+    processes = []
+    connections = []
+    try:
+        for i in range(min(nb_processes, len(subclips))):
+            parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
+            # subclips are dealt in turn, so the first ones are ready (and uploaded) first
+            process = multiprocessing.Process(target=_encoding_process,
+                                              args=(video_file, subclips[i::nb_processes], child_connection))
+            process.start()
+            child_connection.close()
+            processes.append(process)
+            connections.append(parent_connection)
+
+        while connections:
+            for connection in multiprocessing.connection.wait(connections):
+                try:
+                    result = connection.recv()
+                except EOFError:
+                    raise Exception("An encoding process of {} stopped unexpectedly".format(video_file))
+                if result is None:
+                    connections.remove(connection)
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    yield result
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+# output options of ffmpeg for the formats which can be written to a pipe (mp4/mov as fragmented files, whose index is
+# written before the data)
+pipe_output_args = {
+    "mp4": ["-c:v", "libx264", "-c:a", "aac", "-f", "mp4", "-movflags", "frag_keyframe+empty_moov"],
+    "m4v": ["-c:v", "libx264", "-c:a", "aac", "-f", "mp4", "-movflags", "frag_keyframe+empty_moov"],
+    "mov": ["-c:v", "libx264", "-c:a", "aac", "-f", "mov", "-movflags", "frag_keyframe+empty_moov"],
+    "mkv": ["-c:v", "libx264", "-c:a", "aac", "-f", "matroska"],
+    "webm": ["-c:v", "libvpx", "-c:a", "libvorbis", "-f", "webm"]
+}
+default_part_size = 8 * 1024 * 1024
+_ffmpeg_encoders = None
+
+
+def get_ffmpeg_encoders():
+    """
+    list the encoders of ffmpeg (the executable given by IMAGEIO_FFMPEG_EXE). It is probed once per container
+
+    :return: set of encoder names
+    """
+    global _ffmpeg_encoders
+    if _ffmpeg_encoders is None:
+        output = subprocess.run([os.environ["IMAGEIO_FFMPEG_EXE"], "-hide_banner", "-encoders"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode('utf-8', 'replace')
+        encoders = set()
+        for line in output.splitlines():
+            # encoders are listed as "flags name description", eg " V..... libx264   libx264 H.264 / AVC / MPEG-4 AVC"
+            parts = line.split()
+            if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] in "VAS" and parts[1] != "=":
+                encoders.add(parts[1])
+        _ffmpeg_encoders = encoders
+    return _ffmpeg_encoders
+
+
+def can_encode_to_pipe(video_format):
+    """
+    check if subclips of a format can be encoded to a pipe (see encode_subclip_to_s3) by the bundled ffmpeg
+
+    :param video_format: extension of the video
+    :return: bool
+    """
+    output_args = pipe_output_args.get(video_format.lower())
+    if output_args is None:
+        return False
+    codecs = [output_args[i + 1] for i, arg in enumerate(output_args) if arg in ["-c:v", "-c:a"]]
+    return all(codec in get_ffmpeg_encoders() for codec in codecs)
+
+
+def encode_subclip_to_s3(video_file, start, end, video_format, bucket_name, key,
+                         part_size=default_part_size, nb_upload_threads=default_nb_upload_threads):
+    """
+    encode a subclip of a video with ffmpeg (the executable given by IMAGEIO_FFMPEG_EXE) and upload it to s3 while it is encoded :
+    the output of ffmpeg is read from a pipe by parts, and each part is sent as soon as it is read (multipart upload),
+    so the subclip is never written to disk. You must have access rights
+
+    :param video_file: path to the video
+    :param start: start of the subclip, in sec
+    :param end: end of the subclip, in sec
+    :param video_format: extension of the video, must be in pipe_output_args
+    :param bucket_name: name of the bucket
+    :param key: key of the file to write in the bucket
+    :param part_size: size of the parts of the upload, in bytes
+    :param nb_upload_threads: number of parts uploaded at the same time
+    :return: None
+    """
+    print("encoding and uploading file {} to bucket {}".format(key, bucket_name))
+    s3 = get_client('s3')
+    # ffmpeg output is written to a file : a pipe would have to be read while stdout is uploaded, or ffmpeg may block on it
+    with tempfile.TemporaryFile() as error_output:
+        ffmpeg_process = subprocess.Popen([os.environ["IMAGEIO_FFMPEG_EXE"], "-loglevel", "error",
+                                           "-ss", str(start), "-i", video_file, "-t", str(end - start)]
+                                          + pipe_output_args[video_format.lower()] + ["pipe:1"],
+                                          stdout=subprocess.PIPE, stderr=error_output)
+        try:
+            s3.upload_fileobj(ffmpeg_process.stdout, bucket_name, key,
+                              Config=TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                                                    max_concurrency=nb_upload_threads))
+        except Exception as e:
+            ffmpeg_process.kill()
+            if hasattr(e, "message"):
+                e.message = "S3 : " + e.message
+            raise e
+        finally:
+            ffmpeg_process.wait()
+
+        if ffmpeg_process.returncode != 0:
+            # the upload is complete, but holds a truncated file
+            s3.delete_object(Bucket=bucket_name, Key=key)
+            error_output.seek(0)
+            raise Exception("ffmpeg encoding of {} failed : {}".format(key, error_output.read().decode('utf-8', 'replace')))
+    print("file uploaded")
+
+
+def split_to_s3(video_file, subclips, video_format, video_information, bucket_name,
+                nb_processes=default_nb_encoding_processes, nb_upload_threads=default_nb_upload_threads):
+    """
+    encode subclips of a video and upload them to s3 while they are encoded (see encode_subclip_to_s3),
+    with nb_processes ffmpeg processes working on disjoint subclips
+
+    :param video_file: path to the video
+    :param subclips: list of tuple (index, start, end, output_key)
+    :param video_format: extension of the video, must be in pipe_output_args
+    :param video_information: dict of information on the video {"size", "fps", "audio"}, which is the same for subclips
+    :param bucket_name: name of the bucket to write to
+    :param nb_processes: number of ffmpeg processes
+    :param nb_upload_threads: number of parts uploaded at the same time, for each subclip
+    :return: generator of tuple (index, None, dict of the subclip information
+             {"size", "fps", "duration", "audio", "start_time", "end_time"}), as each subclip is uploaded
+    """
+    with ThreadPoolExecutor(max_workers=max(nb_processes, 1)) as encoding_pool:
+        encodings = {}
+        # subclips are submitted in order, so the first ones are ready first
+        for index, start, end, output_key in subclips:
+            encodings[encoding_pool.submit(encode_subclip_to_s3, video_file, start, end, video_format, bucket_name,
+                                           output_key, nb_upload_threads=nb_upload_threads)] = (index, start, end)
+        try:
+            for encoding in as_completed(encodings):
+                encoding.result()
+                index, start, end = encodings[encoding]
+                yield index, None, {"size": video_information["size"],
+                                    "fps": video_information["fps"],
+                                    "duration": end - start,
+                                    "audio": video_information["audio"],
+                                    "start_time": start,
+                                    "end_time": end}
+        finally:
+            for encoding in encodings:
+                encoding.cancel()
+
+
+def _feed_process(input_stream, process, feed_result, chunk_size=default_range_size):
+    """
+    write a stream to the stdin of a process, then close it.
+    The number of bytes written is put in feed_result["nb_bytes"]. If reading the stream fails (eg a ranged GET of S3RangeReader),
+    the exception is put in feed_result["error"] and the process is killed, so that it does not take the truncated input for a whole file
+    """
+    try:
+        while True:
+            data = input_stream.read(chunk_size)
+            if not data:
+                break
+            process.stdin.write(data)
+            feed_result["nb_bytes"] += len(data)
+    except BrokenPipeError:
+        # the process stopped, its return code tells why
+        pass
+    except Exception as e:
+        feed_result["error"] = e
+        process.kill()
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def split_with_stream_copy(video_file, output_dir, subvid_duration_in_sec, video_format, video_information=None):
+    """
+    split a video without re-encoding it, with the segment muxer of ffmpeg (the executable given by IMAGEIO_FFMPEG_EXE).
+    Streams are copied, so the video can only be cut at keyframes : each subvid starts at the first keyframe after
+    the end of the previous one, and lasts about subvid_duration_in_sec (depending on the keyframe interval).
+
+    :param video_file: path to the video, or file-like object to read it from (eg S3RangeReader, see is_streamable),
+                       which is piped to ffmpeg
+    :param output_dir: directory to write the subvids to
+    :param subvid_duration_in_sec: target length of subvids in seconds
+    :param video_format: extension of the video (the output format is deduced from it)
+    :param video_information: dict of information on the video {"size", "fps", "audio"}, which is the same for subvids.
+                              If None, it is read from the first subvid
+    :return: generator of tuple (index, output_file, dict of the subvid information
+             {"size", "fps", "duration", "audio", "start_time", "end_time"}), as each subvid is written.
+             start_time and end_time are the actual times of the cuts in the video, in sec
+    """
+    segment_list_file = os.path.join(output_dir, "segments.csv")
+    is_piped = hasattr(video_file, "read")
+    # ffmpeg output is written to a file, so that ffmpeg never waits for it to be read
+    error_output = tempfile.TemporaryFile()
+    ffmpeg_process = subprocess.Popen([os.environ["IMAGEIO_FFMPEG_EXE"], "-loglevel", "error", "-y",
+                                       "-i", "pipe:0" if is_piped else video_file,
+                                       "-map", "0", "-c", "copy",
+                                       "-f", "segment",
+                                       "-segment_time", str(subvid_duration_in_sec),
+                                       "-segment_list", segment_list_file, "-segment_list_type", "csv",
+                                       "-reset_timestamps", "1",
+                                       os.path.join(output_dir, "%d." + video_format)],
+                                      stdin=subprocess.PIPE if is_piped else None,
+                                      stderr=error_output)
+    feeder = None
+    feed_result = {"nb_bytes": 0, "error": None}
+    if is_piped:
+        feeder = threading.Thread(target=_feed_process, args=(video_file, ffmpeg_process, feed_result), daemon=True)
+        feeder.start()
+    try:
+        # the segment list gets a line "file,start,end" each time a subvid is finished
+        nb_segments = 0
+        process_running = True
+        while process_running:
+            process_running = ffmpeg_process.poll() is None
+            if not process_running and feeder is not None:
+                # ffmpeg may have stopped on an input cut short : check that it was given the whole video
+                feeder.join()
+                if feed_result["error"] is not None:
+                    raise feed_result["error"]
+                if ffmpeg_process.returncode == 0 and feed_result["nb_bytes"] != getattr(video_file, "size", feed_result["nb_bytes"]):
+                    raise Exception("ffmpeg split failed : {} bytes of the video were given to ffmpeg instead of {}".format(
+                        feed_result["nb_bytes"], video_file.size))
+            if not process_running and ffmpeg_process.returncode != 0:
+                error_output.seek(0)
+                raise Exception("ffmpeg split failed : {}".format(error_output.read().decode('utf-8', 'replace')))
+            segments = []
+            if os.path.exists(segment_list_file):
+                with open(segment_list_file) as f:
+                    segments = [line for line in f.readlines() if line.endswith('\n')]
+            for segment_file, start, end in csv.reader(segments[nb_segments:]):
+                start, end = float(start), float(end)
+                if video_information is None:
+                    segment_object = open_video_clip(os.path.join(output_dir, segment_file))
+                    video_information = {"size": segment_object.size,
+                                         "fps": segment_object.fps,
+                                         "audio": (segment_object.audio is not None)}
+                    segment_object.close()
+                yield nb_segments, os.path.join(output_dir, segment_file), {"size": video_information["size"],
+                                                                            "fps": video_information["fps"],
+                                                                            "duration": round(end - start, 6),
+                                                                            "audio": video_information["audio"],
+                                                                            "start_time": start,
+                                                                            "end_time": end}
+                nb_segments += 1
+            if process_running:
+                time.sleep(0.2)
+    finally:
+        if ffmpeg_process.poll() is None:
+            ffmpeg_process.kill()
+        ffmpeg_process.wait()
+        error_output.close()
+
+
 def transfer_and_split_in_sequences(input_s3_bucket, input_file_key, output_s3_bucket, output_key_prefix,
-                                    subvid_duration_in_sec, dynamodb_region_id, dynamodb_tableId):
+                                    subvid_duration_in_sec, dynamodb_region_id, dynamodb_tableId,
+                                    nb_encoding_processes=default_nb_encoding_processes,
+                                    nb_upload_threads=default_nb_upload_threads,
+                                    split_mode="encode",
+                                    streaming_input=False,
+                                    direct_upload=False):
     """
     Gets a video from s3, split it in subvids based on duration, and uploads all resulting files back to s3. You must have access rights
+    Subvids are encoded by nb_encoding_processes processes (or cut without re-encoding, see split_mode),
+    and each one is uploaded in background as soon as it is written.
 
     :param input_s3_bucket: name of the s3 bucket to get input video from
     :param input_file_key: key of the file to get in the bucket
@@ -137,18 +616,25 @@ def transfer_and_split_in_sequences(input_s3_bucket, input_file_key, output_s3_b
                               should contain "{video_name}", which will be replaced by the input video name.
                               final keys will be : output_key_prefix.format(video_name)/video_name_i.video_format
     :param subvid_duration_in_sec: length of subvids in seconds. Last vid may be shorter
+    :param nb_encoding_processes: number of processes encoding subvids
+    :param nb_upload_threads: number of subvids uploaded at the same time
+    :param split_mode: "encode" to re-encode subvids cut at exact times, or "copy" to copy the streams and cut at keyframes
+                       (see split_with_stream_copy, much faster). The times of the cuts are stored in the docs of the subvids
+    :param streaming_input: only for split_mode "copy" : if True, the video is not downloaded before the split, but piped to ffmpeg
+                            while it is downloaded by parallel ranged GETs (see S3RangeReader). Mp4 files must have their index
+                            at the start (faststart), otherwise the video is downloaded.
+                            The size, fps, duration and audio of the video are then added to its doc at the end of the split
+    :param direct_upload: only for split_mode "encode" : if True, subvids are encoded by ffmpeg to a pipe and uploaded while they
+                          are encoded (see split_to_s3), instead of being written to /tmp then uploaded.
+                          Formats which can not be written to a pipe (see can_encode_to_pipe) are written to /tmp
     :return: None
     """
+    if split_mode not in split_modes:
+        raise ValueError("Unknown split mode {}. Must be one of {}".format(split_mode, split_modes))
 
-    # get video from s3
-    temp_file = tempfile.NamedTemporaryFile(delete=False)
-    get_video_from_s3(input_s3_bucket, input_file_key, temp_file.name)
     video_name = os.path.basename(input_file_key)
     video_format = video_name[video_name.rfind('.') + 1:]
     video_name = video_name[:video_name.rfind('.')]
-
-    print("starting time-based split")
-    video_object = VideoFileClip(temp_file.name)
     upload_video_information = {
         "VideoId": generate_row_id(),
         "process_steps": [{"step": "upload", "state": "processing"}],
@@ -157,27 +643,67 @@ def transfer_and_split_in_sequences(input_s3_bucket, input_file_key, output_s3_b
         "key": input_file_key,
         "name": video_name,
         "extension": video_format,
-        "size": video_object.size,
-        "fps": video_object.fps,
-        "duration": video_object.duration,
-        "audio": (video_object.audio is not None),
         "sub_videos": []
     }
-    send_video_info_to_dynamo_db(dynamodb_region_id, dynamodb_tableId, upload_video_information)
 
-    current_start = 0
-    current_index = 0
-
-    while current_start < video_object.duration:
-        # get new subvid and write it to s3
-        new_subvid = video_object.subclip(current_start,
-                                          min(current_start + subvid_duration_in_sec, video_object.duration))
-        output_key = os.path.join(output_key_prefix.format(video_name=video_name),
-                                  "{}_{}.{}".format(video_name, current_index, video_format))
-        subvid_temp = tempfile.NamedTemporaryFile(delete=False, prefix="/tmp/", suffix='.{}'.format(video_format))
-        new_subvid.write_videofile(subvid_temp.name)
-        put_video_to_s3(subvid_temp.name, output_s3_bucket, output_key)
+    # stream video from s3 if possible
+    input_reader = None
+    if streaming_input and split_mode == "copy":
+        input_reader = S3RangeReader(input_s3_bucket, input_file_key)
+        if not is_streamable(input_reader.peek(default_range_size), video_format):
+            print("{} can not be read through a pipe (mp4 index at the end of the file), downloading it".format(input_file_key))
+            input_reader.close()
+            input_reader = None
+
+    temp_file = None
+    if input_reader is None:
+        # get video from s3
+        temp_file = tempfile.NamedTemporaryFile(delete=False)
+        get_video_from_s3(input_s3_bucket, input_file_key, temp_file.name)
+        video_object = open_video_clip(temp_file.name)
+        upload_video_information.update({
+            "size": video_object.size,
+            "fps": video_object.fps,
+            "duration": video_object.duration,
+            "audio": (video_object.audio is not None)
+        })
+        # the encoding processes open their own clip
+        video_object.close()
+
+    print("starting time-based split")
+    send_video_info_to_dynamo_db(dynamodb_region_id, dynamodb_tableId, upload_video_information)
 
+    def get_output_key(index):
+        return os.path.join(output_key_prefix.format(video_name=video_name), "{}_{}.{}".format(video_name, index, video_format))
+
+    split_dir = tempfile.mkdtemp(dir="/tmp")
+    if input_reader is not None:
+        new_subvids = split_with_stream_copy(input_reader, split_dir, subvid_duration_in_sec, video_format)
+    elif split_mode == "copy":
+        new_subvids = split_with_stream_copy(temp_file.name, split_dir, subvid_duration_in_sec, video_format, upload_video_information)
+    elif direct_upload and can_encode_to_pipe(video_format):
+        subclips = []
+        for index, (start, end) in enumerate(compute_split_ranges(upload_video_information["duration"], subvid_duration_in_sec)):
+            subclips.append((index, start, end, get_output_key(index)))
+        new_subvids = split_to_s3(temp_file.name, subclips, video_format, upload_video_information, output_s3_bucket,
+                                  nb_encoding_processes, nb_upload_threads)
+    else:
+        subclips = []
+        for index, (start, end) in enumerate(compute_split_ranges(upload_video_information["duration"], subvid_duration_in_sec)):
+            subclips.append((index, start, end, os.path.join(split_dir, "{}.{}".format(index, video_format))))
+        new_subvids = split_in_subclips(temp_file.name, subclips, nb_encoding_processes)
+
+    # new docs are sent by batches of 25 as they come
+    documents_writer = VideoDocumentsBatchWriter(dynamodb_region_id, dynamodb_tableId)
+    # uploads in progress : index -> (future, output key, subclip information)
+    uploads = {}
+    sub_video_ids = {}
+
+    def upload_subvid(subvid_file, output_key):
+        put_video_to_s3(subvid_file, output_s3_bucket, output_key)
+        os.remove(subvid_file)
+
+    def register_subvid(index, output_key, subclip_information):
         subvideo_information = {
             "VideoId": generate_row_id(),
             "process_steps": [{"step": "timesplit", "state": "done"}],
@@ -186,23 +712,58 @@ def transfer_and_split_in_sequences(input_s3_bucket, input_file_key, output_s3_b
             "key": output_key,
             "name": os.path.basename(output_key),
             "extension": video_format,
-            "size": new_subvid.size,
-            "fps": new_subvid.fps,
-            "duration": new_subvid.duration,
-            "audio": (new_subvid.audio is not None),
             "parent_video": upload_video_information["VideoId"]
         }
-        send_video_info_to_dynamo_db(dynamodb_region_id, dynamodb_tableId, subvideo_information)
-        upload_video_information["sub_videos"].append(subvideo_information["VideoId"])
+        subvideo_information.update(subclip_information)
+        documents_writer.put(subvideo_information)
+        sub_video_ids[index] = subvideo_information["VideoId"]
+
+    def register_uploaded_subvids(wait_all=False):
+        for index in list(uploads):
+            upload, output_key, subclip_information = uploads[index]
+            if wait_all or upload.done():
+                upload.result()
+                register_subvid(index, output_key, subclip_information)
+                del uploads[index]
 
-        os.remove(subvid_temp.name)
-        current_index += 1
-        current_start += subvid_duration_in_sec
-
-    upload_video_information["process_steps"][0]["state"] = "done"
-    send_video_info_to_dynamo_db(dynamodb_region_id, dynamodb_tableId, upload_video_information)
-    # clean
-    os.remove(temp_file.name)
+    try:
+        with documents_writer, ThreadPoolExecutor(max_workers=nb_upload_threads) as upload_pool:
+            for index, subvid_file, subclip_information in new_subvids:
+                output_key = get_output_key(index)
+                if subvid_file is None:
+                    # already uploaded while it was encoded
+                    upload = Future()
+                    upload.set_result(None)
+                else:
+                    # write new subvid to s3 in background
+                    upload = upload_pool.submit(upload_subvid, subvid_file, output_key)
+                uploads[index] = (upload, output_key, subclip_information)
+                last_subclip_information = subclip_information
+                register_uploaded_subvids()
+            register_uploaded_subvids(wait_all=True)
+    finally:
+        # clean
+        new_subvids.close()
+        shutil.rmtree(split_dir, ignore_errors=True)
+        if input_reader is not None:
+            input_reader.close()
+        else:
+            os.remove(temp_file.name)
+
+    print("{} sub videos registered".format(documents_writer.nb_documents))
+
+    if input_reader is not None and sub_video_ids:
+        # information on the streamed video, from its subvids
+        set_video_attributes(dynamodb_region_id, dynamodb_tableId, upload_video_information["VideoId"],
+                             size=last_subclip_information["size"],
+                             fps=last_subclip_information["fps"],
+                             duration=last_subclip_information["end_time"],
+                             audio=last_subclip_information["audio"])
+
+    # register all new videos in their parent doc at once (partial update, see video_documents.py)
+    append_sub_videos(dynamodb_region_id, dynamodb_tableId, upload_video_information["VideoId"],
+                      [sub_video_ids[index] for index in sorted(sub_video_ids)])
+    set_process_step_state(dynamodb_region_id, dynamodb_tableId, upload_video_information["VideoId"], 0, "upload", "done")
     print("split finished")
 
 
@@ -210,6 +771,36 @@ def transfer_and_split_in_sequences(input_s3_bucket, input_file_key, output_s3_b
 # Lambda handler
 #################
 
+# parameters of the lambda (variables.json), loaded once per container by init_container
+params = None
+
+
+def init_container():
+    """
+    set up what is kept from one invocation to the next while the container is warm : parameters, boto3 clients,
+    ffmpeg encoders and working directory. Does nothing if it is already done
+
+    :return: True if the container was initialised (cold start), False otherwise
+    """
+    global params
+    if params is not None:
+        return False
+    print(os.environ["IMAGEIO_FFMPEG_EXE"])
+    print(os.listdir(lambda_dir))
+
+    with open(os.path.join(lambda_dir, "variables.json")) as f:
+        loaded_params = json.load(f)
+    aws_clients.configure(**loaded_params.get("aws_clients", {}))
+    get_client('s3')
+    get_resource('dynamodb', loaded_params["dynamodb"]["region"])
+    get_ffmpeg_encoders()
+    # lambdas can only write to /tmp, and moviepy writes its temporary audio files to the working directory
+    print("moving to /tmp")
+    os.chdir('/tmp')
+    params = loaded_params
+    return True
+
+
 def lambda_handler(event, context):
     """
     AWS lambda entry point
@@ -218,9 +809,10 @@ def lambda_handler(event, context):
     :param context: trigger context (json)
     :return: dict
     """
-    print(os.environ["IMAGEIO_FFMPEG_EXE"])
-    print(os.listdir(os.getcwd()))
-
+    handler_start_time = time.time()
+    is_cold_start = init_container()
+    if is_cold_start:
+        print("cold start : container initialised in {:.2f}s".format(time.time() - init_start_time))
 
     print("Incoming Event: ", event)
     input_bucket = event['Records'][0]['s3']['bucket']['name']
@@ -228,17 +820,16 @@ def lambda_handler(event, context):
     message = "File is uploaded in - {} -> {}".format(input_bucket, input_key)
     print(message)
 
-    with open("variables.json") as f:
-        params = json.load(f)
-
-    current_dir = os.getcwd()
     try:
-        print("moving to /tmp")
-        os.chdir('/tmp')
         transfer_and_split_in_sequences(input_bucket, input_key,
                                         params["video_split"]["output_bucket"], params["video_split"]["output_key_prefix"],
                                         params["video_split"]["output_files_duration_in_sec"],
-                                        params["dynamodb"]["region"], params["dynamodb"]["table_id"])
+                                        params["dynamodb"]["region"], params["dynamodb"]["table_id"],
+                                        params["video_split"].get("nb_encoding_processes", default_nb_encoding_processes),
+                                        params["video_split"].get("nb_upload_threads", default_nb_upload_threads),
+                                        params["video_split"].get("split_mode", "encode"),
+                                        params["video_split"].get("streaming_input", False),
+                                        params["video_split"].get("direct_upload", False))
         # TODO implement
         return_dict = {
             'statusCode': 200,
@@ -252,7 +843,8 @@ def lambda_handler(event, context):
             'body': json.dumps('Error processing {} : {}'.format(input_key, e))
         }
     finally:
-        os.chdir(current_dir)
+        print("{} start : invocation handled in {:.2f}s".format("cold" if is_cold_start else "warm",
+                                                                 time.time() - handler_start_time))
 
     return return_dict
 
@@ -0,0 +1 @@
+../human_detector/src/video_documents.py
\ No newline at end of file
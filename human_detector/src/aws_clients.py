@@ -0,0 +1,132 @@
+# Copyright 2019 Cyril Poulet, cyril.poulet@centraliens.net
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Registry of boto3 clients and resources, shared by all calls of a process, so that credentials, endpoints and connections
+are set up once instead of at each call.
+
+IMPORTANT : this module only depends on boto3, as it is shared with results_viewer, derbyTimeSplitVideoLambda and
+awsQueueManagement (symbolic links)
+
+    - clients are thread-safe, and are shared by all threads. Their connection pool holds max_pool_connections connections
+    - resources are not thread-safe, so each thread gets its own (built on the shared session)
+
+Endpoints can be overridden per service (eg {"dynamodb": "http://localhost:8000"} for a local DynamoDB), see configure.
+Services can also be replaced by objects of the process (eg local_pipeline/local_services.py), see use_local_services.
+"""
+
+import threading
+
+import boto3
+from botocore.config import Config
+
+
+default_max_pool_connections = 20
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_thread_resources = threading.local()
+_max_pool_connections = default_max_pool_connections
+_endpoint_urls = {}
+# service name -> object given instead of the boto3 client and resource
+_local_services = {}
+
+
+def configure(max_pool_connections=default_max_pool_connections, endpoint_urls=None):
+    """
+    set the parameters of the clients and resources. If they change, those already created are dropped, so call it at startup.
+
+    :param max_pool_connections: max number of connections kept open by each client
+    :param endpoint_urls: dict {service name: endpoint url} to use instead of the AWS endpoints
+    """
+    global _max_pool_connections, _endpoint_urls, _session, _thread_resources
+    with _lock:
+        if max_pool_connections == _max_pool_connections and dict(endpoint_urls or {}) == _endpoint_urls:
+            return
+        _max_pool_connections = max_pool_connections
+        _endpoint_urls = dict(endpoint_urls or {})
+        _session = None
+        _clients.clear()
+        _thread_resources = threading.local()
+
+
+def use_local_services(local_services):
+    """
+    replace services by objects of the process, which implement the parts of the boto3 client and resource used by the pipeline
+    (eg to run it on one machine). They are given by get_client and get_resource for all regions
+
+    :param local_services: dict {service name: object}, eg {"s3": LocalS3(...)}. Services not in it use boto3 again
+    """
+    with _lock:
+        _local_services.clear()
+        _local_services.update(local_services)
+
+
+def _get_session():
+    # boto3 sessions are not thread-safe, so they must be created (and used to create clients) under the lock
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+
+def _get_client_args(service_name, region_name):
+    return {"region_name": region_name,
+            "endpoint_url": _endpoint_urls.get(service_name),
+            "config": Config(max_pool_connections=_max_pool_connections)}
+
+
+def get_client(service_name, region_name=None):
+    """
+    get the shared client for a service and region
+
+    :param service_name: eg "s3", "sqs", "dynamodb"
+    :param region_name: region (eg "eu-west-1"), None for the default one
+    :return: boto3 client
+    """
+    if service_name in _local_services:
+        return _local_services[service_name]
+    client_key = (service_name, region_name)
+    client = _clients.get(client_key)
+    if client is None:
+        with _lock:
+            client = _clients.get(client_key)
+            if client is None:
+                client = _get_session().client(service_name, **_get_client_args(service_name, region_name))
+                _clients[client_key] = client
+    return client
+
+
+def get_resource(service_name, region_name=None):
+    """
+    get the resource for a service and region, for the current thread
+
+    :param service_name: eg "s3", "sqs", "dynamodb"
+    :param region_name: region (eg "eu-west-1"), None for the default one
+    :return: boto3 resource
+    """
+    if service_name in _local_services:
+        return _local_services[service_name]
+    resources = getattr(_thread_resources, "resources", None)
+    if resources is None:
+        resources = _thread_resources.resources = {}
+    resource_key = (service_name, region_name)
+    resource = resources.get(resource_key)
+    if resource is None:
+        with _lock:
+            resource = _get_session().resource(service_name, **_get_client_args(service_name, region_name))
+        resources[resource_key] = resource
+    return resource
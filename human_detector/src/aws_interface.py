@@ -13,16 +13,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import collections
 import json
 import os
 import tempfile
 import decimal
-import boto3
 import logging
+import socket
 import sys
-
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_clients
+from aws_clients import get_client, get_resource
+from video_documents import claim_process_step, renew_process_step_claim, release_process_step, complete_process_step, \
+    set_process_step_state, StepAlreadyClaimed, default_claim_lease_in_sec
 from utils import DecimalDecoder
 from video_analyzer import VideoAnalyzer
+from results_writer import create_results_writer
+from s3_cache import S3FileCache
+from match_interleaver import MatchInterleaver
 
 
 ###############
@@ -39,7 +50,7 @@ def get_object_from_s3(region_id, bucket_name, key, local_filename):
     :param local_filename: path to file to write
     :return: None
     """
-    s3 = boto3.resource('s3', region_name=region_id)
+    s3 = get_resource('s3', region_id)
     try:
         res = s3.Bucket(bucket_name).download_file(key, local_filename)
     except Exception as e:
@@ -58,7 +69,7 @@ def put_object_to_s3(region_id, local_filename, bucket_name, key):
     :param key: key of the file to write in the bucket
     :return: None
     """
-    s3 = boto3.client('s3', region_name=region_id)
+    s3 = get_client('s3', region_id)
     try:
         s3.upload_file(local_filename, bucket_name, key)
     except Exception as e:
@@ -67,6 +78,99 @@ def put_object_to_s3(region_id, local_filename, bucket_name, key):
         raise e
 
 
+# S3 needs parts of at least 5MB, except for the last one
+default_upload_part_size = 8 * 1024 * 1024
+
+
+class S3MultipartUploadStream(object):
+
+    def __init__(self, region_id, bucket_name, key, part_size=default_upload_part_size):
+        """
+        file-like object uploading what is written to it to s3 with a multipart upload, one part each time part_size bytes
+        have been written, so that the file never has to be written to disk or held in memory. You must have access rights
+        If less than part_size bytes are written, the file is uploaded with a single put_object.
+
+        Use it as a context manager : the upload is completed on exit, or aborted if an exception was raised.
+
+        :param region_id: region for the bucket (eg "eu-west-1")
+        :param bucket_name: name of the bucket
+        :param key: key of the file to write in the bucket
+        :param part_size: size of the parts to upload, in bytes (min 5MB)
+        """
+        self._s3 = get_client('s3', region_id)
+        self._bucket_name = bucket_name
+        self._key = key
+        self._part_size = part_size
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data):
+        """
+        :param data: str (encoded in utf-8) or bytes
+        :return: number of bytes written
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._buffer.extend(data)
+        if len(self._buffer) >= self._part_size:
+            self._upload_part()
+        return len(data)
+
+    def flush(self):
+        """
+        nothing to do : parts are uploaded as soon as they are full (called by writers which flush their output, eg zipfile)
+        """
+        pass
+
+    def _upload_part(self):
+        try:
+            if self._upload_id is None:
+                self._upload_id = self._s3.create_multipart_upload(Bucket=self._bucket_name, Key=self._key)["UploadId"]
+            part_number = len(self._parts) + 1
+            response = self._s3.upload_part(Bucket=self._bucket_name, Key=self._key, UploadId=self._upload_id,
+                                            PartNumber=part_number, Body=bytes(self._buffer))
+            self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+            self._buffer = bytearray()
+        except Exception as e:
+            if hasattr(e, "message"):
+                e.message = "S3 : " + e.message
+            raise e
+
+    def close(self):
+        """
+        upload what is left and complete the upload
+        """
+        try:
+            if self._upload_id is None:
+                self._s3.put_object(Bucket=self._bucket_name, Key=self._key, Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._upload_part()
+                self._s3.complete_multipart_upload(Bucket=self._bucket_name, Key=self._key, UploadId=self._upload_id,
+                                                   MultipartUpload={"Parts": self._parts})
+        except Exception as e:
+            if hasattr(e, "message"):
+                e.message = "S3 : " + e.message
+            raise e
+
+    def abort(self):
+        """
+        abort the upload, so that s3 drops the parts already uploaded
+        """
+        if self._upload_id is not None:
+            self._s3.abort_multipart_upload(Bucket=self._bucket_name, Key=self._key, UploadId=self._upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
 #####################
 # DynamoDB functions
 #####################
@@ -81,7 +185,7 @@ def get_video_info_from_dynamo_db(region_id, tableId, search_keys):
     :param document: dict to get from
     :return: None
     """
-    dynamodb = boto3.resource('dynamodb', region_name=region_id) #, endpoint_url="http://localhost:8000")
+    dynamodb = get_resource('dynamodb', region_id)
     table = dynamodb.Table(tableId)
     # trick to turn floats and ints to Decimal for DynamoDB
     response = table.get_item(Key=search_keys)
@@ -104,7 +208,7 @@ def send_video_info_to_dynamo_db(region_id, tableId, document):
     :param document: dict to insert
     :return: None
     """
-    dynamodb = boto3.resource('dynamodb', region_name=region_id) #, endpoint_url="http://localhost:8000")
+    dynamodb = get_resource('dynamodb', region_id)
     table = dynamodb.Table(tableId)
     # trick to turn floats and ints to Decimal for DynamoDB
     try:
@@ -116,19 +220,129 @@ def send_video_info_to_dynamo_db(region_id, tableId, document):
         raise e
 
 
+def set_step_state(step_name, video_id, step_index, state, dyndb_region_id, dyndb_tableId, **step_values):
+    """
+    set the state (and other values) of the step entry of the current step in the video doc (partial update, see video_documents.py)
+
+    :param step_name: name of the step
+    :param video_id: dynamoDB id of the video
+    :param step_index: index of the step entry in process_steps, as returned by prepare_video
+    :param state: new state of the step ("running", "done", "error")
+    :param dyndb_region_id: region of the dynamoDB table
+    :param dyndb_tableId: table to update
+    :param step_values: other values to set in the step entry (eg result_file)
+    """
+    set_process_step_state(dyndb_region_id, dyndb_tableId, int(video_id), step_index, step_name, state, **step_values)
+
+
+def set_step_error(step_name, video_id, step_index, dyndb_region_id, dyndb_tableId, claimer):
+    """
+    set the state of the step entry of the current step to "error", and release the claim on the step so that the video can be
+    processed again
+
+    :params: see set_step_state
+    :param claimer: id of the claimer of the step (see prepare_video)
+    """
+    set_step_state(step_name, video_id, step_index, "error", dyndb_region_id, dyndb_tableId)
+    release_process_step(dyndb_region_id, dyndb_tableId, int(video_id), step_name, claimer)
+
+
+def new_claimer_id():
+    """
+    :return: id identifying a worker in the claims of the steps (see video_documents.claim_process_step)
+    """
+    return "{}-{}".format(socket.gethostname(), uuid.uuid4().hex[:8])
+
+
+def prepare_video(step_name,
+                  video_id,
+                  video_s3_region_id, video_s3_bucket, video_s3_key,
+                  dyndb_region_id, dyndb_tableId,
+                  logger, file_cache=None, claimer=None, lease_in_sec=default_claim_lease_in_sec):
+    """
+    first part of process_video, which does not need the analyzer (network I/O only) :
+        - claims the step in the video doc in dynamoDB, adding it with the state "running" (see video_documents.claim_process_step)
+        - get the video from S3 to a local temp file, or from the local cache
+    If it fails, the step state is set to "error" and the temp file is removed.
+
+    :params: see process_video
+    :return: tuple (index of the step entry in process_steps, path to the local video file)
+    :raise StepAlreadyClaimed: if the step is claimed by another worker or done (duplicate request), nothing is done
+    """
+    # add step to doc in dynamodb
+    logger.info("Updating doc on dynamoDB")
+    step_index = claim_process_step(dyndb_region_id, dyndb_tableId, int(video_id), step_name, "running", claimer, lease_in_sec)
+
+    try:
+        # get video from s3
+        logger.info("Getting video from S3: {}/{}".format(video_s3_bucket, video_s3_key))
+        if file_cache is not None:
+            return step_index, file_cache.get_file(video_s3_region_id, video_s3_bucket, video_s3_key)
+        video_temp_file = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            get_object_from_s3(video_s3_region_id, video_s3_bucket, video_s3_key, video_temp_file.name)
+        except Exception as e:
+            os.remove(video_temp_file.name)
+            raise e
+        return step_index, video_temp_file.name
+    except Exception as e:
+        set_step_error(step_name, video_id, step_index, dyndb_region_id, dyndb_tableId, claimer)
+        raise e
+
+
+def analyze_prepared_video(step_name,
+                           video_id, step_index, video_file, video_analyzer,
+                           video_s3_region_id, video_s3_bucket, video_s3_key,
+                           dyndb_region_id, dyndb_tableId,
+                           logger, results_format="json", file_cache=None, claimer=None):
+    """
+    second part of process_video, on the outputs of prepare_video :
+        - applies :param video_analyzer: to the local video file, streaming the results to a file on s3 as frames are analyzed
+    If it fails, the step state is set to "error" (see set_step_error). The local video file is removed (or released to the cache) in any case.
+
+    :params: see process_video
+    :param video_id: dynamoDB id of the video
+    :param step_index: index of the step entry returned by prepare_video
+    :param video_file: path to the local video file returned by prepare_video
+    :return: key of the result file on s3
+    """
+    try:
+        video_name = os.path.basename(video_s3_key)
+        video_name = video_name[:video_name.rfind('.')]
+
+        # analyze video, and stream results to s3
+        video_key_path = os.path.dirname(video_s3_key)  # this is project_name/split
+        result_key = os.path.join(os.path.dirname(video_key_path), step_name, video_name + '.' + results_format)
+        logger.info("Analyzing video, pushing results to s3 : {}/{}".format(video_s3_bucket, result_key))
+        with S3MultipartUploadStream(video_s3_region_id, video_s3_bucket, result_key) as results_stream:
+            video_analyzer.analyze_video(video_file, results_sink=create_results_writer(results_stream, results_format))
+        return result_key
+
+    except Exception as e:
+        set_step_error(step_name, video_id, step_index, dyndb_region_id, dyndb_tableId, claimer)
+        raise e
+
+    finally:
+        # clean
+        if file_cache is not None:
+            file_cache.release(video_file)
+        else:
+            os.remove(video_file)
+
+
 def process_video(step_name,
                   video_id, video_analyzer,
                   video_s3_region_id, video_s3_bucket, video_s3_key,
                   dyndb_region_id, dyndb_tableId,
-                  logger):
+                  logger, results_format="json", file_cache=None, claimer=None, lease_in_sec=default_claim_lease_in_sec):
     """
     This function :
-        - gets the video doc from dynamoDB,
-        - sets the step state to "running" and updates the DB
+        - claims the step in the video doc in dynamoDB, adding it with the state "running".
+          If the step is already claimed (duplicate request), StepAlreadyClaimed is raised and nothing is done
         - get the video from S3
-        - applies :param video_analyzer: to it
-        - pushes the results to a file on s3
-        - updates the DB doc with state="done" and a path to the result file
+        - applies :param video_analyzer: to it, streaming the results to a file on s3 as frames are analyzed
+        - updates the DB doc with state="done" and a path to the result file, and marks the claim as finished
+    The claim is not renewed : the analysis must take less than lease_in_sec, or another worker may take the step over.
 
     :param step_name: name of the current step
     :param video_id: dynamoDB id of the video to process
@@ -139,56 +353,287 @@ def process_video(step_name,
     :param dyndb_region_id: region of the dynamoDB table to get from
     :param dyndb_tableId: table to get from
     :param logger: Logging.Logger object to log to
+    :param results_format: format of the result file (see results_writer.results_formats)
+    :param file_cache: S3FileCache to get the video from, or None to download it to a temp file
+    :param claimer: id of the worker in the claim of the step, or None for a new one (see new_claimer_id)
+    :param lease_in_sec: duration after which the claim can be taken over by another worker
     """
-    # get doc from dynamodb
-    logger.info("Getting doc from dynamoDB")
-    video_doc = get_video_info_from_dynamo_db(dyndb_region_id, dyndb_tableId, {"VideoId": int(video_id)})
-    video_doc["process_steps"].append({"step": step_name, "state": "running"})
-    send_video_info_to_dynamo_db(dyndb_region_id, dyndb_tableId, video_doc)
-
-    video_temp_file = tempfile.NamedTemporaryFile(delete=False)
-    results_temp_file = tempfile.NamedTemporaryFile(delete=False)
-    try:
-        # get video from s3
-        logger.info("Getting video from S3: {}/{}".format(video_s3_bucket, video_s3_key))
-        get_object_from_s3(video_s3_region_id, video_s3_bucket, video_s3_key, video_temp_file.name)
-        video_name = os.path.basename(video_s3_key)
-        video_name = video_name[:video_name.rfind('.')]
+    claimer = claimer or new_claimer_id()
+    step_index, video_file = prepare_video(step_name, video_id,
+                                           video_s3_region_id, video_s3_bucket, video_s3_key,
+                                           dyndb_region_id, dyndb_tableId, logger, file_cache, claimer, lease_in_sec)
+    result_key = analyze_prepared_video(step_name, video_id, step_index, video_file, video_analyzer,
+                                        video_s3_region_id, video_s3_bucket, video_s3_key,
+                                        dyndb_region_id, dyndb_tableId, logger, results_format, file_cache, claimer)
 
-        # analyze video
-        logger.info("Analyzing video")
-        results = video_analyzer.analyze_video(video_temp_file.name)
-        with open(results_temp_file.name, 'w') as f:
-            json.dump(results, f)
+    # update dynamoDB document
+    logger.info("Updating doc on dynamoDB")
+    complete_process_step(dyndb_region_id, dyndb_tableId, int(video_id), step_index, step_name, claimer,
+                          result_file={"bucket": video_s3_bucket, "key": result_key})
 
-        # push result to s3
-        video_key_path = os.path.dirname(video_s3_key)  # this is project_name/split
-        result_key = os.path.join(os.path.dirname(video_key_path), step_name, video_name + '.json')
-        logger.info("Pushing results to s3 : {}/{}".format(video_s3_bucket, result_key))
-        put_object_to_s3(video_s3_region_id, results_temp_file.name, video_s3_bucket, result_key)
-
-        # update dynamoDB document
-        logger.info("Updating doc on dynamoDB")
-        for i in range(len(video_doc["process_steps"])):
-            if video_doc["process_steps"][i]["step"] == step_name:
-                video_doc["process_steps"][i]["state"] = "done"
-                video_doc["process_steps"][i]["result_file"] = {"bucket": video_s3_bucket, "key": result_key}
-                break
-        send_video_info_to_dynamo_db(dyndb_region_id, dyndb_tableId, video_doc)
 
-    except Exception as e:
-        # update dynamoDB document
-        for i in range(len(video_doc["process_steps"])):
-            if video_doc["process_steps"][i]["step"] == step_name:
-                video_doc["process_steps"][i]["state"] = "error"
-                break
-        send_video_info_to_dynamo_db(dyndb_region_id, dyndb_tableId, video_doc)
-        raise e
+#####################
+# SQS worker
+#####################
 
-    finally:
-        # clean
-        os.remove(video_temp_file.name)
-        os.remove(results_temp_file.name)
+default_messages_in_flight = 2
+default_visibility_timeout = 300
+default_scheduling_window = 0
+
+
+class SQSWorker(object):
+
+    def __init__(self, sqs_queue, step_name, video_analyzer,
+                 video_s3_region_id, dyndb_region_id, dyndb_tableId,
+                 logger,
+                 messages_in_flight=default_messages_in_flight,
+                 visibility_timeout=default_visibility_timeout,
+                 results_format="json",
+                 file_cache=None,
+                 scheduling_window=default_scheduling_window):
+        """
+        This class processes the messages of an SQS queue with process_video, keeping up to messages_in_flight messages
+        received at once so that the network I/O of the next videos overlaps the analysis of the current one :
+            - the DB update and the download of each video (prepare_video) run in a thread pool as soon as its message is received,
+              so the next queued videos are prefetched (to the file cache, if given) while the current one is analyzed
+            - videos are analyzed one at a time, in the order of the messages, in the calling thread (the analyzer is not shared)
+            - the final DB update and the deletion of the message run in the thread pool, while the next video is analyzed
+        While a message is in flight, its visibility timeout is extended every visibility_timeout / 2 seconds, so that it does
+        not go back to the queue however long the video waits or takes to analyze. The lease of the worker on the claimed steps
+        (see video_documents.claim_process_step) lasts visibility_timeout, and is renewed at the same time.
+        A message for a step claimed by another worker is left in the queue, and comes back after visibility_timeout : by then,
+        the step is done (and the message is deleted), or the other worker has stopped renewing its lease and the step is taken over.
+
+        With messages_in_flight=1, messages are processed one after the other as before, with the timeout extension.
+
+        Up to scheduling_window more messages are received and held (with the timeout extension) before being prepared.
+        The next video to prepare is chosen among them by a MatchInterleaver (see match_interleaver.py), which interleaves the
+        matches of the held messages (parent_video in the messages). This only reorders the held messages, it does not change the
+        order in which the queue gives them.
+        With scheduling_window=0, messages are processed in the order they are received. Held messages are invisible to the other
+        workers of the queue, so a large window reorders more messages but lets the worker hoard clips other workers could process.
+
+        :param sqs_queue: boto3 SQS Queue resource
+        :param step_name: name of the current step
+        :param video_analyzer: instanciated VideoAnalyzer
+        :param video_s3_region_id: region for the s3 buckets (eg "eu-west-1")
+        :param dyndb_region_id: region of the dynamoDB table
+        :param dyndb_tableId: dynamoDB table
+        :param logger: Logging.Logger object to log to
+        :param messages_in_flight: max number of messages received and not yet processed
+        :param visibility_timeout: visibility timeout set on the messages in flight, in seconds
+        :param results_format: format of the result files (see results_writer.results_formats)
+        :param file_cache: S3FileCache to get the videos from, or None to download them to temp files
+        :param scheduling_window: max number of messages received and waiting to be prepared
+        """
+        self._sqs_queue = sqs_queue
+        self._step_name = step_name
+        self._video_analyzer = video_analyzer
+        self._video_s3_region_id = video_s3_region_id
+        self._dyndb_region_id = dyndb_region_id
+        self._dyndb_tableId = dyndb_tableId
+        self._logger = logger
+        self._messages_in_flight = max(1, messages_in_flight)
+        self._visibility_timeout = visibility_timeout
+        self._results_format = results_format
+        self._file_cache = file_cache
+        self._scheduling_window = max(0, scheduling_window)
+        self._claimer = new_claimer_id()
+
+        # one thread per message in flight for the downloads, plus one for the final updates
+        self._io_pool = ThreadPoolExecutor(max_workers=self._messages_in_flight + 1)
+        self._in_flight = set()
+        # message -> VideoId, for the messages whose step is (being) claimed
+        self._claims = {}
+        self._in_flight_lock = threading.Lock()
+        self._stop_heartbeat = threading.Event()
+
+    def run(self):
+        """
+        process messages until a stop command is received ({"command": "stop"})
+        Messages in flight when the command is received are processed before returning.
+        """
+        heartbeat = threading.Thread(target=self._extend_visibility, daemon=True)
+        heartbeat.start()
+
+        # (message, message_body), waiting to be prepared
+        interleaver = MatchInterleaver()
+        # (message, message_body, future of prepare_video), in the order they are analyzed
+        pending = collections.deque()
+        finishing = []
+        run = True
+        try:
+            while run or pending or len(interleaver):
+                if run and len(pending) + len(interleaver) < self._messages_in_flight + self._scheduling_window:
+                    run = self._receive(interleaver, self._messages_in_flight + self._scheduling_window - len(pending) - len(interleaver),
+                                        wait=not (pending or len(interleaver)))
+
+                while len(interleaver) and len(pending) < self._messages_in_flight:
+                    _, (message, message_body) = interleaver.pop()
+                    pending.append(self._prepare(message, message_body))
+
+                if not pending:
+                    continue
+
+                message, message_body, preparation = pending.popleft()
+                finishing = [f for f in finishing if not f.done()]
+                try:
+                    step_index, video_file = preparation.result()
+                    result_key = analyze_prepared_video(self._step_name, message_body["VideoId"], step_index, video_file, self._video_analyzer,
+                                                        self._video_s3_region_id, message_body["s3"]["bucket"], message_body["s3"]["key"],
+                                                        self._dyndb_region_id, self._dyndb_tableId,
+                                                        self._logger, self._results_format, self._file_cache, self._claimer)
+                    finishing.append(self._io_pool.submit(self._finish, message, message_body, step_index, result_key))
+                except StepAlreadyClaimed as e:
+                    if e.finished:
+                        # the step is done, this is a duplicate message
+                        self._logger.warning("Refusing duplicate message : {}".format(e))
+                        self._release(message)
+                    else:
+                        # another worker holds the step : the message comes back once its lease may have expired
+                        self._logger.warning("Postponing message : {}".format(e))
+                        self._postpone(message)
+                except Exception as e:
+                    self._logger.error("Error processing message: {}".format(e))
+                    self._release(message)
+        finally:
+            for f in finishing:
+                f.result()
+            self._stop_heartbeat.set()
+            heartbeat.join()
+            self._io_pool.shutdown()
+
+    def _receive(self, interleaver, nb_messages, wait):
+        """
+        receive up to nb_messages new messages, and add them to the interleaver
+
+        :param interleaver: MatchInterleaver of the messages waiting to be prepared
+        :param nb_messages: max number of messages to receive
+        :param wait: if True, wait for messages (long polling)
+        :return: False if a stop command was received (the messages received after it are made visible again at once), else True
+        """
+        while nb_messages > 0:
+            messages = self._sqs_queue.receive_messages(MaxNumberOfMessages=min(nb_messages, 10),
+                                                        WaitTimeSeconds=10 if wait else 0,
+                                                        VisibilityTimeout=self._visibility_timeout)
+            if not messages:
+                break
+            wait = False
+            nb_messages -= len(messages)
+            for index, message in enumerate(messages):
+                try:
+                    message_body = json.loads(message.body)
+                    self._logger.info("Received new message : {}".format(message_body))
+                    # manage stop command
+                    if "command" in message_body:
+                        if message_body["command"] == "stop":
+                            self._logger.info("Received stop command, exiting")
+                            self._return_to_queue(messages[index + 1:])
+                            return False
+
+                    # manage requests for video processing : held videos are interleaved by match
+                    with self._in_flight_lock:
+                        self._in_flight.add(message)
+                    interleaver.add(message_body.get("parent_video", message_body["VideoId"]), (message, message_body))
+                except Exception as e:
+                    self._logger.error("Error processing message: {}".format(e))
+                    self._release(message)
+        return True
+
+    def _return_to_queue(self, messages):
+        """
+        Make received messages visible again at once, for the other workers
+        """
+        for message in messages:
+            try:
+                message.change_visibility(VisibilityTimeout=0)
+            except Exception as e:
+                self._logger.warning("Could not change visibility of message : {}".format(e))
+
+    def _prepare(self, message, message_body):
+        """
+        start preparing the video of a message (DB update and download, see prepare_video) in the thread pool
+
+        :return: tuple (message, message_body, future of prepare_video)
+        """
+        preparation = self._io_pool.submit(self._prepare_video, message, message_body)
+        return message, message_body, preparation
+
+    def _prepare_video(self, message, message_body):
+        # the lease is renewed by the heartbeat from now on
+        with self._in_flight_lock:
+            self._claims[message] = message_body["VideoId"]
+        video_file = message_body["s3"]
+        return prepare_video(self._step_name, message_body["VideoId"],
+                             self._video_s3_region_id, video_file["bucket"], video_file["key"],
+                             self._dyndb_region_id, self._dyndb_tableId,
+                             self._logger, self._file_cache, self._claimer, self._visibility_timeout)
+
+    def _finish(self, message, message_body, step_index, result_key):
+        """
+        update the DB doc with state="done" and a path to the result file, then delete the message.
+        If the update fails, the step is set to "error" (which releases its claim) before deleting the message. If that fails too,
+        the message is left in the queue, to be processed again once the claim has expired.
+        """
+        try:
+            self._logger.info("Updating doc on dynamoDB")
+            complete_process_step(self._dyndb_region_id, self._dyndb_tableId, int(message_body["VideoId"]), step_index,
+                                  self._step_name, self._claimer,
+                                  result_file={"bucket": message_body["s3"]["bucket"], "key": result_key})
+        except Exception as e:
+            self._logger.error("Error processing message: {}".format(e))
+            try:
+                set_step_error(self._step_name, message_body["VideoId"], step_index, self._dyndb_region_id, self._dyndb_tableId,
+                               self._claimer)
+            except Exception as e:
+                self._logger.error("Could not set step error, leaving the message in the queue : {}".format(e))
+                self._postpone(message)
+                return
+        self._release(message)
+
+    def _release(self, message):
+        """
+        Let the queue know that the message is processed, and stop extending its visibility
+        """
+        with self._in_flight_lock:
+            self._in_flight.discard(message)
+            self._claims.pop(message, None)
+        try:
+            message.delete()
+        except Exception as e:
+            self._logger.error("Could not delete message : {}".format(e))
+
+    def _postpone(self, message):
+        """
+        Stop extending the visibility of the message, and leave it in the queue : it is received again after visibility_timeout
+        """
+        with self._in_flight_lock:
+            self._in_flight.discard(message)
+            self._claims.pop(message, None)
+        try:
+            message.change_visibility(VisibilityTimeout=self._visibility_timeout)
+        except Exception as e:
+            self._logger.warning("Could not change visibility of message : {}".format(e))
+
+    def _extend_visibility(self):
+        """
+        extend the visibility timeout of the messages in flight, and renew the leases on their steps, every visibility_timeout / 2 seconds
+        """
+        while not self._stop_heartbeat.wait(self._visibility_timeout / 2.):
+            with self._in_flight_lock:
+                messages = list(self._in_flight)
+                claims = list(self._claims.values())
+            for message in messages:
+                try:
+                    message.change_visibility(VisibilityTimeout=self._visibility_timeout)
+                except Exception as e:
+                    self._logger.warning("Could not extend visibility of message : {}".format(e))
+            for video_id in claims:
+                try:
+                    renew_process_step_claim(self._dyndb_region_id, self._dyndb_tableId, int(video_id), self._step_name, self._claimer)
+                except Exception as e:
+                    # ConditionFailed if the step is not claimed yet, or was taken over by another worker after renewals failed
+                    self._logger.warning("Could not renew claim on video {} : {}".format(video_id, e))
 
 
 if __name__ == "__main__":
@@ -196,6 +641,7 @@ if __name__ == "__main__":
     Main function and entrypoint of the docker container
 
     It loads the variables, connects to SQS, instantiate the VideoAnalyzer, then waits for messages and processes them as they come
+    (see SQSWorker, configured by the "human_detection_worker" variables)
 
     IMPORTANT : for calls to AWS you need to specify the region, because though you do need it locally (it is in your AWS identity file),
     your container will need it once on a cluster (the information is not passed on by ECS)
@@ -208,6 +654,8 @@ if __name__ == "__main__":
     current_detector = "human_detection"
     sqs_queue_name = params["aws_queues"][current_detector]
     module_parameters = params["human_detection"]
+    worker_parameters = params.get("human_detection_worker", {})
+    cache_parameters = params.get("s3_cache")
 
     # configure logging
     logging.basicConfig(stream=sys.stdout,
@@ -216,11 +664,13 @@ if __name__ == "__main__":
 
     logger = logging.getLogger("HumanDetectionAWSInterface")
 
+    aws_clients.configure(**params.get("aws_clients", {}))
+
     # connect to SQS
     logger.info("Starting up. Connecting to SQS queue {}".format(sqs_queue_name))
     sqs_queue = None
     try:
-        sqs = boto3.resource('sqs', region_name=params["aws_region"])
+        sqs = get_resource('sqs', params["aws_region"])
         sqs_queue = sqs.get_queue_by_name(QueueName=sqs_queue_name)
         logger.info("Connected to SQS")
     except Exception as e:
@@ -235,34 +685,22 @@ if __name__ == "__main__":
         logger.error("Could not instantiate analyzer : {}. Exiting".format(e))
         exit()
 
+    # local cache of the videos
+    file_cache = None
+    if cache_parameters:
+        logger.info("Using local cache {}".format(cache_parameters["directory"]))
+        file_cache = S3FileCache(cache_parameters["directory"], cache_parameters["max_size_in_mb"])
+
     # enter message processing loop
     logger.info("Entering main loop")
-    run = True
-    while run:
-        for message in sqs_queue.receive_messages(WaitTimeSeconds=10):
-            try:
-                message_body = json.loads(message.body)
-                logger.info("Received new message : {}".format(message_body))
-                # manage stop command
-                if "command" in message_body:
-                    if message_body["command"] == "stop":
-                        logging.info("Received stop command, exiting")
-                        run = False
-                        break
-
-                # manage requests for video processing
-                video_id = message_body["VideoId"]
-                video_file = message_body["s3"]
-
-                process_video(current_detector,
-                              video_id, video_analyzer,
-                              params["aws_region"],  video_file["bucket"], video_file["key"],
-                              params["dynamodb"]["region"], params["dynamodb"]["table_id"],
-                              logger)
-            except Exception as e:
-                logger.error("Error processing message: {}".format(e))
-
-            # Let the queue know that the message is processed
-            message.delete()
+    worker = SQSWorker(sqs_queue, current_detector, video_analyzer,
+                       params["aws_region"], params["dynamodb"]["region"], params["dynamodb"]["table_id"],
+                       logger,
+                       messages_in_flight=worker_parameters.get("messages_in_flight", default_messages_in_flight),
+                       visibility_timeout=worker_parameters.get("visibility_timeout_in_sec", default_visibility_timeout),
+                       results_format=worker_parameters.get("results_format", "json"),
+                       file_cache=file_cache,
+                       scheduling_window=worker_parameters.get("scheduling_window", default_scheduling_window))
+    worker.run()
 
     video_analyzer.close()
@@ -0,0 +1,264 @@
+# Copyright 2019 Cyril Poulet, cyril.poulet@centraliens.net
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Columnar format for the results of VideoAnalyzer.analyze_video : an uncompressed .npz file holding the arrays
+
+    - fps, codec_code : 0D float arrays
+    - detectors_names : (D,) str, names of the detectors, in the order of the frames dicts
+    - frame_index : (F,) int64
+    - frame_timestamp : (F,) float64
+    - detection_offsets : (F * D + 1,) int64, detections of frame f for detector d are the rows
+                          detection_offsets[f * D + d] to detection_offsets[f * D + d + 1] of the detection arrays
+    - detection_frame : (N,) int32, row of the frame of each detection in the frame arrays
+    - detection_detector : (N,) uint8, index of the detector of each detection in detectors_names
+    - detection_classes : (N,) int32
+    - detection_boxes : (N, 4) float32, [top_left.y, top_left.x, bottom_right.y, bottom_right.x]
+    - detection_scores : (N,) float32
+
+It holds the same information as the json document (boxes and scores are float32, as given by the detectors), and
+converts back to it with ColumnarResults.to_json_dict.
+"""
+
+import io
+import json
+import shutil
+import struct
+import tempfile
+import zipfile
+import numpy as np
+
+
+frame_keys = ["frame_index", "frame_timestamp"]
+local_file_header_size = 30
+# columns written as the frames come : name, dtype, shape of an item
+columns = [("frame_index", np.int64, ()),
+           ("frame_timestamp", np.float64, ()),
+           ("detection_offsets", np.int64, ()),
+           ("detection_frame", np.int32, ()),
+           ("detection_detector", np.uint8, ()),
+           ("detection_classes", np.int32, ()),
+           ("detection_boxes", np.float32, (4,)),
+           ("detection_scores", np.float32, ())]
+
+
+class ColumnarResultsWriter(object):
+
+    def __init__(self, output):
+        """
+        This class writes the results of VideoAnalyzer.analyze_video in the columnar format (see above).
+        It can be used as results_sink of analyze_video. The frames given to write_frames are appended to one temporary file
+        per column, so memory does not grow with the number of frames (the temporary files take about the size of the result file).
+        end() writes the archive to the output, column by column, without building it in memory.
+
+        :param output: path of the file to write, or file-like object opened for writing bytes (eg S3MultipartUploadStream)
+        """
+        self._output = output
+        self._video_info = {}
+        self._detectors_names = None
+        # column name -> temporary file of its data
+        self._column_files = {name: tempfile.TemporaryFile() for name, _, _ in columns}
+        self._column_lengths = {name: 0 for name, _, _ in columns}
+        self._nb_detections = 0
+        self.nb_frames = 0
+        self._append("detection_offsets", np.zeros(1, dtype=np.int64))
+
+    def _append(self, name, values):
+        self._column_files[name].write(values.tobytes())
+        self._column_lengths[name] += len(values)
+
+    def start(self, video_info):
+        """
+        :param video_info: dict {"fps": vid_fps, "codec_code": vid_codec_code}
+        """
+        self._video_info = video_info
+
+    def write_frames(self, frames):
+        """
+        :param frames: list of dict (see VideoAnalyzer.analyze_video)
+        """
+        if not frames:
+            return
+        if self._detectors_names is None:
+            self._detectors_names = [key for key in frames[0] if key not in frame_keys]
+        values = {name: [] for name, _, _ in columns}
+        for frame in frames:
+            values["frame_index"].append(frame["frame_index"])
+            values["frame_timestamp"].append(frame["frame_timestamp"])
+
+            for det_ind, det_name in enumerate(self._detectors_names):
+                scores = np.asarray(frame[det_name]["scores"], dtype=np.float32)
+                nb_detections = len(scores)
+                values["detection_scores"].append(scores)
+                values["detection_classes"].append(np.asarray(frame[det_name]["classes"], dtype=np.int32).reshape(nb_detections))
+                values["detection_boxes"].append(np.asarray(frame[det_name]["boxes"], dtype=np.float32).reshape(nb_detections, 4))
+                values["detection_frame"].append(np.full(nb_detections, self.nb_frames, dtype=np.int32))
+                values["detection_detector"].append(np.full(nb_detections, det_ind, dtype=np.uint8))
+                self._nb_detections += nb_detections
+                values["detection_offsets"].append(self._nb_detections)
+
+            self.nb_frames += 1
+
+        for name, dtype, item_shape in columns:
+            if name in ["frame_index", "frame_timestamp", "detection_offsets"]:
+                self._append(name, np.array(values[name], dtype=dtype))
+            elif values[name]:
+                self._append(name, np.concatenate(values[name]).astype(dtype, copy=False).reshape((-1,) + item_shape))
+
+    def end(self):
+        """
+        write the file (an uncompressed npz archive), and remove the temporary files. The output is not closed.
+        """
+        # zipfile writes streams which can not seek (sizes are given after the data), and copies the members by chunks.
+        # Members are written from files (ZipFile.write), as ZipFile.open can only write from python 3.6
+        with zipfile.ZipFile(self._output, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for name, array in [("fps", np.float64(self._video_info.get("fps", 0.))),
+                                ("codec_code", np.float64(self._video_info.get("codec_code", 0.))),
+                                ("detectors_names", np.array(self._detectors_names or [], dtype=str))]:
+                member = io.BytesIO()
+                np.lib.format.write_array(member, np.asanyarray(array))
+                archive.writestr(name + '.npy', member.getvalue())
+
+            for name, dtype, item_shape in columns:
+                column_file = self._column_files[name]
+                # the header of the array (which holds its shape) is written before the data, so the column is copied to a .npy file
+                with tempfile.NamedTemporaryFile(suffix='.npy') as member:
+                    np.lib.format.write_array_header_1_0(member, {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                                  "fortran_order": False,
+                                                                  "shape": (self._column_lengths[name],) + item_shape})
+                    column_file.seek(0)
+                    shutil.copyfileobj(column_file, member)
+                    column_file.close()
+                    member.flush()
+                    archive.write(member.name, name + '.npy')
+
+
+def _load_npz_arrays(path, mmap):
+    """
+    load all arrays of an npz file. If mmap, arrays stored uncompressed are memory-mapped instead of read.
+
+    :param path: path to the npz file
+    :param mmap: bool
+    :return: dict {array name: nd array}
+    """
+    with np.load(path) as data:
+        if not mmap:
+            return {name: data[name] for name in data.files}
+        arrays = {}
+        with zipfile.ZipFile(path) as zip_file, open(path, 'rb') as f:
+            for info in zip_file.infolist():
+                name = info.filename[:-len('.npy')]
+                # the data starts after the local header of the member, whose extra field may differ from the central directory one
+                f.seek(info.header_offset)
+                local_header = f.read(local_file_header_size)
+                name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+                f.seek(info.header_offset + local_file_header_size + name_length + extra_length)
+                version = np.lib.format.read_magic(f)
+                if info.compress_type != zipfile.ZIP_STORED or version not in [(1, 0), (2, 0)]:
+                    arrays[name] = data[name]
+                    continue
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                if dtype.hasobject or not np.prod(shape):
+                    arrays[name] = data[name]
+                    continue
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', shape=shape,
+                                         order='F' if fortran_order else 'C', offset=f.tell())
+        return arrays
+
+
+class ColumnarResults(object):
+
+    def __init__(self, path, mmap=True):
+        """
+        This class reads a result file in the columnar format (see above)
+
+        :param path: path to the file
+        :param mmap: if True, arrays are memory-mapped, so only the parts used are read from disk
+        """
+        arrays = _load_npz_arrays(path, mmap)
+        self.fps = float(arrays["fps"])
+        self.codec_code = float(arrays["codec_code"])
+        self.detectors_names = [str(name) for name in arrays["detectors_names"]]
+        self.frame_index = arrays["frame_index"]
+        self.frame_timestamp = arrays["frame_timestamp"]
+        self.detection_offsets = arrays["detection_offsets"]
+        self.detection_frame = arrays["detection_frame"]
+        self.detection_detector = arrays["detection_detector"]
+        self.detection_classes = arrays["detection_classes"]
+        self.detection_boxes = arrays["detection_boxes"]
+        self.detection_scores = arrays["detection_scores"]
+
+    def __len__(self):
+        return len(self.frame_index)
+
+    def get_detections(self, frame_row, detector_name):
+        """
+        get the detections of a detector on a frame
+
+        :param frame_row: row of the frame in the frame arrays (not its frame_index)
+        :param detector_name: str
+        :return: dict {"classes" : [...], "boxes": [...], "scores": [...]} of nd arrays (views on the columns)
+        """
+        ind = frame_row * len(self.detectors_names) + self.detectors_names.index(detector_name)
+        start, end = self.detection_offsets[ind], self.detection_offsets[ind + 1]
+        return {"classes": self.detection_classes[start:end],
+                "boxes": self.detection_boxes[start:end],
+                "scores": self.detection_scores[start:end]}
+
+    def iter_frames(self):
+        """
+        iterate over the frames in order, without loading the whole file
+
+        :return: generator of dict, as the frames of VideoAnalyzer.analyze_video, with the detections as nd arrays (views on the columns)
+        """
+        for frame_row in range(len(self)):
+            frame = {
+                "frame_index": int(self.frame_index[frame_row]),
+                "frame_timestamp": float(self.frame_timestamp[frame_row])
+            }
+            for det_name in self.detectors_names:
+                frame[det_name] = self.get_detections(frame_row, det_name)
+            yield frame
+
+    def to_json_dict(self):
+        """
+        convert back to the json document returned by VideoAnalyzer.analyze_video
+
+        :return: dict {"fps": vid_fps, "codec_code": vid_codec_code, "frames": list of dict}
+        """
+        frames = []
+        for frame in self.iter_frames():
+            for det_name in self.detectors_names:
+                frame[det_name] = {key: values.tolist() for key, values in frame[det_name].items()}
+            frames.append(frame)
+        return {"fps": self.fps, "codec_code": self.codec_code, "frames": frames}
+
+
+def convert_json_to_columnar(json_file, output_file):
+    """
+    convert a json result file to the columnar format
+
+    :param json_file: path to the json file
+    :param output_file: path to the file to write
+    """
+    with open(json_file) as f:
+        results = json.load(f)
+    writer = ColumnarResultsWriter(output_file)
+    writer.start({"fps": results["fps"], "codec_code": results["codec_code"]})
+    writer.write_frames(results["frames"])
+    writer.end()
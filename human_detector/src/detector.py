@@ -14,7 +14,9 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import importlib
+import numpy as np
 from utils import camelcase_to_underscores
+from preprocessing import BatchPreprocessor
 
 
 class Detector(object):
@@ -30,6 +32,12 @@ class Detector(object):
         """
         self.detected_category = detected_category
         self.batch_max_size = 1
+        # input expected by analyze_preprocessed_images : None for raw frames, or (target_width, color_space) (see BatchPreprocessor)
+        self.input_spec = None
+        # reusable batches of model inputs (see get_batch_buffer)
+        self._batch_buffer = None
+        # reusable batch of the direct calls (analyze_image(s)), apart from the ring of the pipeline (see _get_model_batch)
+        self._direct_batch_buffer = None
 
     def analyze_image(self, image):
         """
@@ -54,6 +62,61 @@ class Detector(object):
         """
         raise NotImplementedError("Detector.analyze_images must be implemented in subclasses")
 
+    def preprocess_images(self, images):
+        """
+        transforms raw frames into the inputs expected by analyze_preprocessed_images, as declared by self.input_spec
+        This is split from the analysis so that callers can run it in a different thread than the model,
+        and share it between detectors (see VideoAnalyzer)
+
+        :param images: list of 3D nd array, HxWxC
+        :return: list of preprocessed inputs
+        """
+        return BatchPreprocessor(images).get(self.input_spec)
+
+    def analyze_preprocessed_images(self, preprocessed_images):
+        """
+        entry point to analyze several images already transformed by preprocess_images
+
+        :param preprocessed_images: list of preprocessed inputs, or 4D nd array taken from the batch buffer (see get_batch_buffer)
+        :return: same as analyze_images
+        """
+        raise NotImplementedError("Detector.analyze_preprocessed_images must be implemented in subclasses")
+
+    def get_batch_buffer(self, nb_buffers=2):
+        """
+        get the BatchBuffer that batches of model inputs are written to. It is created at first call, and recreated if
+        more batches must be able to be in use at the same time than the current one allows.
+
+        :param nb_buffers: min number of batches that must be able to be in use at the same time
+        :return: BatchBuffer
+        """
+        if self._batch_buffer is None \
+                or self._batch_buffer.batch_size != self.batch_max_size \
+                or self._batch_buffer.nb_buffers < nb_buffers:
+            self._batch_buffer = BatchBuffer(self.batch_max_size, nb_buffers)
+        return self._batch_buffer
+
+    def _get_model_batch(self, inputs):
+        """
+        get the 4D batch array to feed to the model
+
+        :param inputs: 4D nd array already taken from the batch buffer, or list of 3D nd array (direct calls), which are then copied
+                       into a batch buffer of their own : the ring of get_batch_buffer may hold batches still queued by a
+                       pipelined analysis (see VideoAnalyzer), which a direct call must not overwrite
+        :return: 4D nd array (N, H, W, C)
+        """
+        if isinstance(inputs, np.ndarray):
+            return inputs
+        if len(inputs) > self.batch_max_size:
+            return np.stack(inputs)
+        if self._direct_batch_buffer is None or self._direct_batch_buffer.batch_size != self.batch_max_size:
+            # the batch is used by the model before the direct call returns, one array is enough
+            self._direct_batch_buffer = BatchBuffer(self.batch_max_size, nb_buffers=1)
+        batch_buffer = self._direct_batch_buffer
+        for im in inputs:
+            batch_buffer.write(im)
+        return batch_buffer.take()
+
     def close(self):
         """
         Method to release all resources
@@ -61,6 +124,69 @@ class Detector(object):
         raise NotImplementedError("Detector.analyze_images must be implemented in subclasses")
 
 
+class BatchBuffer(object):
+
+    def __init__(self, batch_size, nb_buffers=2):
+        """
+        This class holds a ring of preallocated (batch_size, H, W, C) arrays that model inputs are written to, one slot per image,
+        so that no batch array is allocated for each model call. An array is only reallocated when the geometry of the inputs changes.
+
+        nb_buffers batches can be in use at the same time (eg one being filled by the decoding thread while the model runs on others):
+        a batch returned by take() is overwritten after nb_buffers - 1 other batches have been started.
+
+        :param batch_size: max number of inputs in a batch
+        :param nb_buffers: number of arrays in the ring
+        """
+        self.batch_size = batch_size
+        self.nb_buffers = nb_buffers
+        self.nb_allocations = 0
+        self._buffers = [None] * nb_buffers
+        self._current_buffer = 0
+        self._nb_filled_slots = 0
+
+    def write(self, input_image):
+        """
+        copies an input in the next slot of the current batch
+
+        :param input_image: 3D nd array, HxWxC
+        :return: True if the current batch is full (and must be taken before writing again)
+        """
+        if self._nb_filled_slots >= self.batch_size:
+            raise ValueError("Batch is full, it must be taken before writing new inputs")
+
+        buffer = self._buffers[self._current_buffer]
+        if buffer is None or buffer.shape[1:] != input_image.shape or buffer.dtype != input_image.dtype:
+            if self._nb_filled_slots:
+                raise ValueError("Inputs of different shapes cannot be written in the same batch")
+            buffer = np.empty((self.batch_size,) + input_image.shape, dtype=input_image.dtype)
+            self._buffers[self._current_buffer] = buffer
+            self.nb_allocations += 1
+
+        buffer[self._nb_filled_slots] = input_image
+        self._nb_filled_slots += 1
+        return self._nb_filled_slots == self.batch_size
+
+    def __len__(self):
+        return self._nb_filled_slots
+
+    def reset(self):
+        """
+        drop the inputs written in the current batch (eg left by an interrupted analysis)
+        """
+        self._nb_filled_slots = 0
+
+    def take(self):
+        """
+        get the current batch and move to the next array of the ring
+
+        :return: 4D nd array (N, H, W, C), view on the filled slots of the current array
+        """
+        batch = self._buffers[self._current_buffer][:self._nb_filled_slots]
+        self._current_buffer = (self._current_buffer + 1) % self.nb_buffers
+        self._nb_filled_slots = 0
+        return batch
+
+
 class DetectorFactory:
 
     @staticmethod
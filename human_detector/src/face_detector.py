@@ -21,6 +21,7 @@ import numpy as np
 import tensorflow as tf
 
 from detector import Detector
+from preprocessing import build_tf_preprocessing
 
 
 logging.basicConfig(stream=sys.stdout,
@@ -41,10 +42,18 @@ class FaceDetector(Detector):
                  model_file=tf_model,
                  target_input_width=target_input_width,
                  min_detection_score=tf_model_human_threshold,
-                 max_batch_size=batch_max_size):
+                 max_batch_size=batch_max_size,
+                 in_graph_preprocessing=False):
         """
         This class implements a detector of faces in images, using a mobilenet SingleShot Detector trained on WiderFace database.
         Credits for the trained model to https://github.com/yeephycho/tensorflow-face-detection
+
+        :param model_file: path to the frozen model (pb)
+        :param target_input_width: width images are resized to before detection (ratio is kept)
+        :param min_detection_score: threshold for detection score
+        :param max_batch_size: max number of images processed in one model call
+        :param in_graph_preprocessing: if True, the detector takes raw frames and the resize and colour conversion run as TF ops
+                                       plugged before the model input, instead of cv2 in python (see preprocessing.build_tf_preprocessing)
         """
         super().__init__("Face")
 
@@ -52,6 +61,9 @@ class FaceDetector(Detector):
         self._target_input_width = target_input_width
         self._min_detection_score = min_detection_score
         self.batch_max_size = max_batch_size
+        self._in_graph_preprocessing = in_graph_preprocessing
+        self._model_input_spec = (target_input_width, "RGB")
+        self.input_spec = None if in_graph_preprocessing else self._model_input_spec
 
         self._graph = None
         self._tf_sess = None
@@ -82,7 +94,12 @@ class FaceDetector(Detector):
             with tf.gfile.GFile(self._model_file, 'rb') as fid:
                 serialized_graph = fid.read()
                 od_graph_def.ParseFromString(serialized_graph)
-                tf.import_graph_def(od_graph_def, name='')
+                input_map = None
+                if self._in_graph_preprocessing:
+                    self._logger.debug('adding preprocessing ops to the graph')
+                    self._input_placeholder, preprocessed_images = build_tf_preprocessing(self._model_input_spec)
+                    input_map = {'image_tensor:0': preprocessed_images}
+                tf.import_graph_def(od_graph_def, name='', input_map=input_map)
 
         with self._graph.as_default():
             config = tf.ConfigProto()
@@ -90,8 +107,9 @@ class FaceDetector(Detector):
             self._tf_sess = tf.Session(graph=self._graph, config=config)
 
         self._logger.debug('getting placeholders')
-        # get graph input placeholder
-        self._input_placeholder = self._graph.get_tensor_by_name('image_tensor:0')
+        # get graph input placeholder (already set to the raw frames placeholder if the preprocessing is in the graph)
+        if self._input_placeholder is None:
+            self._input_placeholder = self._graph.get_tensor_by_name('image_tensor:0')
         # get output placeholders
         self._output_nb_detections = self._graph.get_tensor_by_name('num_detections:0')
         self._output_classes = self._graph.get_tensor_by_name('detection_classes:0')
@@ -115,14 +133,12 @@ class FaceDetector(Detector):
 
         :param image: 3D nd array, HxWxC
         :return: dict {"classes" : [...], "boxes": [...], "scores": [...]} where
-                        - classes = list of int
-                        - boxes : list of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
-                        - scores : list of float
+                        - classes = 1D nd array of int
+                        - boxes : 2D nd array of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
+                        - scores : 1D nd array of float
         """
-        preprocessed_input = self._preprocess_image(image)
-        model_output = self._run_model([preprocessed_input])[0]
-        filtered_output = self._filter_by_score(model_output)
-        return filtered_output
+        preprocessed_input = self.preprocess_images([image])[0]
+        return self._filter_by_score(*self._run_model([preprocessed_input]))[0]
 
     def analyze_images(self, images):
         """
@@ -131,44 +147,37 @@ class FaceDetector(Detector):
 
         :param images: list of 3D nd array, HxWxC
         :return: list of dict {"classes" : [...], "boxes": [...], "scores": [...]} where
-                        - classes = list of int
-                        - boxes : list of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
-                        - scores : list of float
+                        - classes = 1D nd array of int
+                        - boxes : 2D nd array of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
+                        - scores : 1D nd array of float
         """
-        if len(images) > batch_max_size:
-            self._logger.warning('Too much images in HumanDetector.analyze_images. Only the {} will be processed'.format(batch_max_size))
-            images = images[:batch_max_size]
-        preprocessed_inputs = [self._preprocess_image(im) for im in images]
-        model_outputs = self._run_model(preprocessed_inputs)
-        filtered_outputs = [self._filter_by_score(out) for out in model_outputs]
-        return filtered_outputs
+        if len(images) > self.batch_max_size:
+            self._logger.warning('Too much images in FaceDetector.analyze_images. Only the {} will be processed'.format(self.batch_max_size))
+            images = images[:self.batch_max_size]
+        return self.analyze_preprocessed_images(self.preprocess_images(images))
 
-    def _preprocess_image(self, input_image):
+    def analyze_preprocessed_images(self, preprocessed_images):
         """
-        resize image to target_input_width while keeping the ratio
+        entry point to analyze several images already transformed by preprocess_images
 
-        :param input_image: 3D nd array
-        :return: 3D nd array
+        :param preprocessed_images: list of 3D nd array, HxWxC, or 4D nd array taken from the batch buffer (see Detector.get_batch_buffer)
+        :return: same as analyze_images
         """
-        w = input_image.shape[1]
-        ratio = float(self._target_input_width) / float(w)
-        resized_img = cv2.resize(input_image, (self._target_input_width, int(float(input_image.shape[0])*ratio)))
-
-        cvt_image = cv2.cvtColor(resized_img, cv2.COLOR_BGR2RGB)
-        return cvt_image
+        return self._filter_by_score(*self._run_model(preprocessed_images))
 
     def _run_model(self, input_images):
         """
         run the TF model on list of input images
 
-        :param input_images: list of 3D nd array
-        :return: list of dict {"classes" : [...], "boxes": [...], "scores": [...]} where
-                        - classes = list of int
-                        - boxes : list of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
-                        - scores : list of float
+        :param input_images: list of 3D nd array, or 4D nd array taken from the batch buffer
+        :return: tuple of nd arrays for the whole batch (num, classes, boxes, scores) where
+                        - num : (batch,) number of valid detections for each image
+                        - classes : (batch, N), int
+                        - boxes : (batch, N, 4), [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
+                        - scores : (batch, N), float
         """
-        # Expand dimensions since the trained_model expects images to have shape: [1, None, None, 3]
-        images_np_expanded = np.vstack([np.expand_dims(im, axis=0) for im in input_images])
+        # the trained_model expects a batch of images with shape: [N, None, None, 3]
+        images_np_expanded = self._get_model_batch(input_images)
         # Actual detection.
         start_time = time.time()
         (num, classes, boxes, scores) = self._tf_sess.run(
@@ -181,33 +190,27 @@ class FaceDetector(Detector):
         self._logger.debug(
             "Predicting {} images. Processing Time: {}s".format(len(input_images), end_time - start_time))
 
-        results = []
-        for im_ind in range(len(input_images)):
-            num_res = int(num[im_ind])
-            results.append({"classes": [int(x) for x in classes[im_ind].tolist()][:num_res],
-                            "boxes": boxes[im_ind].tolist()[:num_res],
-                            "scores": scores[im_ind].tolist()[:num_res]})
-        return results
-
-    def _filter_by_score(self, results):
-        """
-        Filters the predictions for a single image to keep only the humans detected with a score above a given threshold
-
-        :param results: dict {"classes" : [...], "boxes": [...], "scores": [...]} where
-                        - classes = list of int
-                        - boxes : list of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
-                        - scores : list of float
-        :return: same as input
-        """
-        # filter on score
-        correct_faces_boxes, correct_faces_scores = [], []
-        filtered_tuples = [vals for vals in zip(results["boxes"], results["scores"]) if vals[1] >= self._min_detection_score]
-        if len(filtered_tuples):
-            correct_faces_boxes, correct_faces_scores = zip(*filtered_tuples)
-
-        return {"classes": [0 for _ in correct_faces_scores],
-                "boxes": list(correct_faces_boxes),
-                "scores": list(correct_faces_scores) }
+        return num.astype(int), classes.astype(int), boxes, scores
+
+    def _filter_by_score(self, num, classes, boxes, scores):
+        """
+        Filters the predictions for a batch of images to keep only the faces detected with a score above a given threshold
+        Filtering is done with masks on the whole batch; results stay nd arrays (see utils.NumpyEncoder for serialization)
+
+        :param num, classes, boxes, scores: batch outputs of the model, as given by _run_model
+        :return: list of dict {"classes" : [...], "boxes": [...], "scores": [...]} where
+                        - classes = 1D nd array of int (always 0)
+                        - boxes : 2D nd array of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
+                        - scores : 1D nd array of float
+        """
+        # keep only the num first detections of each image, with a high enough score
+        mask = np.arange(scores.shape[1])[np.newaxis, :] < num[:, np.newaxis]
+        mask &= scores >= self._min_detection_score
+
+        return [{"classes": np.zeros(np.count_nonzero(im_mask), dtype=int),
+                 "boxes": im_boxes[im_mask],
+                 "scores": im_scores[im_mask]}
+                for im_mask, im_boxes, im_scores in zip(mask, boxes, scores)]
 
 
 if __name__ == "__main__":
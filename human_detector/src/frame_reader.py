@@ -0,0 +1,191 @@
+# Copyright 2019 Cyril Poulet, cyril.poulet@centraliens.net
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import cv2
+import logging
+import sys
+import time
+
+logging.basicConfig(stream=sys.stdout,
+                    level=logging.DEBUG,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+decode_modes = ["read", "grab", "seek"]
+default_seek_min_frame_gap = 60
+
+
+class FrameReader(object):
+
+    def __init__(self, path_to_video, frame_ratio=1., decode_mode="grab", seek_min_frame_gap=default_seek_min_frame_gap):
+        """
+        This class reads the frames of a video to analyze, with respect to a ratio of frames to keep.
+
+        Decode modes:
+            - "read" : every frame is fully decoded with cap.read(), and the ones not kept are thrown away
+            - "grab" : skipped frames are only grabbed (cap.grab()), kept frames are grabbed then retrieved (cap.retrieve()),
+                       which avoids the conversion of skipped frames to BGR images
+            - "seek" : same as "grab", but when the gap to the next kept frame is at least seek_min_frame_gap frames,
+                       the reader jumps directly to it (cap.set(cv2.CAP_PROP_POS_FRAMES)).
+                       OpenCV seeks to the previous keyframe and decodes from there, so seek_min_frame_gap should be above
+                       the keyframe interval (GOP size) of the videos for the jump to pay off.
+                       If the backend cannot seek accurately, the reader does not seek again : it goes on grabbing from the
+                       position reported after the missed seek, as in "grab" mode, for the rest of the video.
+
+        Frame indexes are counted from 1, and frame i is kept if (i - 1) is a multiple of int(1 / frame_ratio), whatever the mode.
+
+        :param path_to_video: path to the video to read
+        :param frame_ratio: ratio of frames to keep (1 -> all frames, 0.2 -> 1 on 5, etc)
+        :param decode_mode: one of decode_modes
+        :param seek_min_frame_gap: min number of frames to skip to use a seek instead of grabs (only used in "seek" mode)
+        """
+        if decode_mode not in decode_modes:
+            raise ValueError("Unknown decode mode {}. Must be one of {}".format(decode_mode, decode_modes))
+
+        self._logger = logging.getLogger("FrameReader")
+        self._path_to_video = path_to_video
+        self._one_frame_every_n_frame = int(1. / float(frame_ratio))
+        self._decode_mode = decode_mode
+        self._seek_min_frame_gap = seek_min_frame_gap
+
+        self._cap = cv2.VideoCapture(path_to_video)
+        self.fps = self._cap.get(cv2.CAP_PROP_FPS)
+        self.codec_code = self._cap.get(cv2.CAP_PROP_FOURCC)
+
+        self.stats = {
+            "decode_mode": decode_mode,
+            "nb_kept_frames": 0,
+            "nb_grabbed_frames": 0,
+            "nb_seeked_over_frames": 0,
+            "nb_seeks": 0,
+            "grab_time": 0.,
+            "retrieve_time": 0.,
+            "seek_time": 0.,
+            "saved_decode_time": 0.
+        }
+
+    def __iter__(self):
+        """
+        reads the video and yields the frames to keep
+
+        :return: yields tuples (index of frame, time of frame, 3D nd array HxWxC)
+        """
+        if self._decode_mode == "read":
+            return self._read_all_frames()
+        return self._grab_frames(allow_seek=(self._decode_mode == "seek"))
+
+    def _read_all_frames(self):
+        """
+        decode every frame, and yield the ones to keep
+        """
+        current_frame_ind = 0
+        while True:
+            start_time = time.time()
+            r, img = self._cap.read()
+            self.stats["grab_time"] += time.time() - start_time
+            if not r:
+                # we reached the end of the video
+                break
+
+            # count frames, skip frames if necessary to respect processing ratio
+            current_frame_ind += 1
+            self.stats["nb_grabbed_frames"] += 1
+            if (current_frame_ind - 1) % self._one_frame_every_n_frame != 0:
+                continue
+
+            self.stats["nb_kept_frames"] += 1
+            yield current_frame_ind, self._cap.get(cv2.CAP_PROP_POS_MSEC), img
+
+    def _grab_frames(self, allow_seek):
+        """
+        grab every frame (or seek over them), and only retrieve the ones to keep
+        """
+        current_frame_ind = 0
+        last_kept_frame_ind = 0
+        while True:
+            if allow_seek:
+                next_kept_frame_ind = current_frame_ind + (-current_frame_ind % self._one_frame_every_n_frame) + 1
+                if next_kept_frame_ind - 1 - current_frame_ind >= self._seek_min_frame_gap:
+                    position = self._seek(next_kept_frame_ind - 1)
+                    if position != next_kept_frame_ind - 1:
+                        # grab sequentially from where the reader actually is : another seek could miss the same way
+                        self._logger.warning("Could not seek accurately in {} (asked for frame {}, at frame {}), "
+                                             "falling back to grab mode".format(self._path_to_video, next_kept_frame_ind - 1, position))
+                        allow_seek = False
+                    self.stats["nb_seeked_over_frames"] += max(position - current_frame_ind, 0)
+                    current_frame_ind = position
+
+            start_time = time.time()
+            r = self._cap.grab()
+            self.stats["grab_time"] += time.time() - start_time
+            if not r:
+                # we reached the end of the video
+                break
+
+            # count frames, skip frames if necessary to respect processing ratio
+            current_frame_ind += 1
+            self.stats["nb_grabbed_frames"] += 1
+            # after a missed seek that went backwards, frames already kept are grabbed again, but not yielded twice
+            if (current_frame_ind - 1) % self._one_frame_every_n_frame != 0 or current_frame_ind <= last_kept_frame_ind:
+                continue
+
+            start_time = time.time()
+            r, img = self._cap.retrieve()
+            self.stats["retrieve_time"] += time.time() - start_time
+            if not r:
+                break
+
+            self.stats["nb_kept_frames"] += 1
+            last_kept_frame_ind = current_frame_ind
+            yield current_frame_ind, self._cap.get(cv2.CAP_PROP_POS_MSEC), img
+
+    def _seek(self, frame_position):
+        """
+        move the reader so that the next grabbed frame is at frame_position (0-based)
+
+        :param frame_position: int
+        :return: position of the reader after the seek (0-based index of the next grabbed frame), which may not be frame_position
+        """
+        start_time = time.time()
+        self._cap.set(cv2.CAP_PROP_POS_FRAMES, frame_position)
+        self.stats["seek_time"] += time.time() - start_time
+        self.stats["nb_seeks"] += 1
+        return int(self._cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+    def release(self):
+        """
+        release the video, and compute the decode time saved compared to a full decode of all frames
+
+        :return: dict of decoding statistics (see self.stats)
+        """
+        self._cap.release()
+
+        if self._decode_mode != "read" and self.stats["nb_grabbed_frames"] and self.stats["nb_kept_frames"]:
+            # full decode of a frame = grab + retrieve
+            mean_grab_time = self.stats["grab_time"] / self.stats["nb_grabbed_frames"]
+            mean_retrieve_time = self.stats["retrieve_time"] / self.stats["nb_kept_frames"]
+            nb_frames = self.stats["nb_grabbed_frames"] + self.stats["nb_seeked_over_frames"]
+            full_decode_time = nb_frames * (mean_grab_time + mean_retrieve_time)
+            actual_decode_time = self.stats["grab_time"] + self.stats["retrieve_time"] + self.stats["seek_time"]
+            self.stats["saved_decode_time"] = full_decode_time - actual_decode_time
+
+        self._logger.info("Decoded {} frames out of {} in {:.3f}s ({} mode, {} seeks). Estimated decode time saved: {:.3f}s".format(
+            self.stats["nb_kept_frames"],
+            self.stats["nb_grabbed_frames"] + self.stats["nb_seeked_over_frames"],
+            self.stats["grab_time"] + self.stats["retrieve_time"] + self.stats["seek_time"],
+            self._decode_mode,
+            self.stats["nb_seeks"],
+            self.stats["saved_decode_time"]))
+        return self.stats
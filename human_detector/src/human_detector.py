@@ -22,6 +22,7 @@ import sys
 
 from utils import get_available_gpus
 from detector import Detector
+from preprocessing import build_tf_preprocessing
 
 logging.basicConfig(stream=sys.stdout,
                     level=logging.DEBUG,
@@ -43,7 +44,8 @@ class HumanDetector(Detector):
                  saved_model=tf_model,
                  output_ind_for_humans=coco_output_ind_for_humans,
                  min_detection_score=tf_model_human_threshold,
-                 max_batch_size=batch_max_size):
+                 max_batch_size=batch_max_size,
+                 in_graph_preprocessing=False):
         """
         This class implements a detector of people in images, based on a trained model which is loaded at init.
         Model must be a trained TF model.
@@ -55,12 +57,18 @@ class HumanDetector(Detector):
         :param saved_model: path to the model files (no extension)
         :param output_ind_for_humans: index of the output class for humans
         :param min_detection_score: threshold for detection score for class "human"
+        :param max_batch_size: max number of images processed in one model call
+        :param in_graph_preprocessing: if True, the detector takes raw frames and the resize runs as TF ops plugged before the model input,
+                                       instead of cv2 in python (see preprocessing.build_tf_preprocessing)
         """
         super().__init__("Human")
         self._model_file = saved_model
         self._output_ind_for_humans = output_ind_for_humans
         self._min_detection_score = min_detection_score
         self.batch_max_size = max_batch_size
+        self._in_graph_preprocessing = in_graph_preprocessing
+        self._model_input_spec = (target_input_width, "BGR")
+        self.input_spec = None if in_graph_preprocessing else self._model_input_spec
 
         self._graph = None
         self._tf_sess = None
@@ -91,18 +99,19 @@ class HumanDetector(Detector):
         if gpus:
             self._logger.debug('loading graph on GPU')
             with tf.device(gpus[0]):
-                new_saver = tf.train.import_meta_graph(self._model_file + '.meta', clear_devices=True)
+                new_saver = self._import_graph()
                 new_saver.restore(self._tf_sess, self._model_file)
                 self._graph = self._tf_sess.graph
         else:
             self._logger.debug('loading graph on CPU')
-            new_saver = tf.train.import_meta_graph(self._model_file + '.meta', clear_devices=True)
+            new_saver = self._import_graph()
             new_saver.restore(self._tf_sess, self._model_file)
             self._graph = self._tf_sess.graph
 
         self._logger.debug('getting placeholders')
-        # get graph input placeholder
-        self._input_placeholder = self._graph.get_tensor_by_name('image_tensor:0')
+        # get graph input placeholder (already set to the raw frames placeholder if the preprocessing is in the graph)
+        if self._input_placeholder is None:
+            self._input_placeholder = self._graph.get_tensor_by_name('image_tensor:0')
         # get output placeholders
         self._output_nb_detections = self._graph.get_tensor_by_name('num_detections:0')
         self._output_classes = self._graph.get_tensor_by_name('detection_classes:0')
@@ -110,6 +119,21 @@ class HumanDetector(Detector):
         self._output_scores = self._graph.get_tensor_by_name('detection_scores:0')
         self._logger.info('... model loaded')
 
+    def _import_graph(self):
+        """
+        Import the model graph in the session graph. If in_graph_preprocessing, the preprocessing ops are created first
+        and mapped to the model input placeholder.
+
+        :return: tf.train.Saver for the imported graph
+        """
+        input_map = None
+        with self._tf_sess.graph.as_default():
+            if self._in_graph_preprocessing:
+                self._logger.debug('adding preprocessing ops to the graph')
+                self._input_placeholder, preprocessed_images = build_tf_preprocessing(self._model_input_spec)
+                input_map = {'image_tensor:0': preprocessed_images}
+            return tf.train.import_meta_graph(self._model_file + '.meta', clear_devices=True, input_map=input_map)
+
     def close(self):
         """
         Close TF session and graph
@@ -125,14 +149,12 @@ class HumanDetector(Detector):
 
         :param image: 3D nd array, HxWxC
         :return: dict {"classes" : [...], "boxes": [...], "scores": [...]} where
-                        - classes = list of int
-                        - boxes : list of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
-                        - scores : list of float
+                        - classes = 1D nd array of int
+                        - boxes : 2D nd array of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
+                        - scores : 1D nd array of float
         """
-        preprocessed_input = self._preprocess_image(image)
-        model_output = self._run_model([preprocessed_input])[0]
-        filtered_output = self._filter_humans(model_output)
-        return filtered_output
+        preprocessed_input = self.preprocess_images([image])[0]
+        return self._filter_humans(*self._run_model([preprocessed_input]))[0]
 
     def analyze_images(self, images):
         """
@@ -141,42 +163,37 @@ class HumanDetector(Detector):
 
         :param images: list of 3D nd array, HxWxC
         :return: list of dict {"classes" : [...], "boxes": [...], "scores": [...]} where
-                        - classes = list of int
-                        - boxes : list of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
-                        - scores : list of float
+                        - classes = 1D nd array of int
+                        - boxes : 2D nd array of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
+                        - scores : 1D nd array of float
         """
-        if len(images) > batch_max_size:
-            self._logger.warning('Too much images in HumanDetector.analyze_images. Only the {} will be processed'.format(batch_max_size))
-            images = images[:batch_max_size]
-        preprocessed_inputs = [self._preprocess_image(im) for im in images]
-        model_outputs = self._run_model(preprocessed_inputs)
-        filtered_outputs = [self._filter_humans(out) for out in model_outputs]
-        return filtered_outputs
+        if len(images) > self.batch_max_size:
+            self._logger.warning('Too much images in HumanDetector.analyze_images. Only the {} will be processed'.format(self.batch_max_size))
+            images = images[:self.batch_max_size]
+        return self.analyze_preprocessed_images(self.preprocess_images(images))
 
-    def _preprocess_image(self, input_image):
+    def analyze_preprocessed_images(self, preprocessed_images):
         """
-        resize image to target_input_width while keeping the ratio
+        entry point to analyze several images already resized by preprocess_images
 
-        :param input_image: 3D nd array
-        :return: 3D nd array
+        :param preprocessed_images: list of 3D nd array, HxWxC, or 4D nd array taken from the batch buffer (see Detector.get_batch_buffer)
+        :return: same as analyze_images
         """
-        w = input_image.shape[1]
-        ratio = float(target_input_width) / float(w)
-        resized_img = cv2.resize(input_image, (target_input_width, int(float(input_image.shape[0])*ratio)))
-        return resized_img
+        return self._filter_humans(*self._run_model(preprocessed_images))
 
     def _run_model(self, input_images):
         """
         run the TF model on list of input images
 
-        :param input_images: list of 3D nd array
-        :return: list of dict {"classes" : [...], "boxes": [...], "scores": [...]} where
-                        - classes = list of int
-                        - boxes : list of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
-                        - scores : list of float
+        :param input_images: list of 3D nd array, or 4D nd array taken from the batch buffer
+        :return: tuple of nd arrays for the whole batch (num, classes, boxes, scores) where
+                        - num : (batch,) number of valid detections for each image
+                        - classes : (batch, N), int
+                        - boxes : (batch, N, 4), [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
+                        - scores : (batch, N), float
         """
-        # Expand dimensions since the trained_model expects images to have shape: [1, None, None, 3]
-        images_np_expanded = np.vstack([np.expand_dims(im, axis=0) for im in input_images])
+        # the trained_model expects a batch of images with shape: [N, None, None, 3]
+        images_np_expanded = self._get_model_batch(input_images)
         # Actual detection.
         start_time = time.time()
         (num, classes, boxes, scores) = self._tf_sess.run(
@@ -188,40 +205,28 @@ class HumanDetector(Detector):
         end_time = time.time()
         self._logger.debug("Predicting {} images. Processing Time: {}s".format(len(input_images), end_time - start_time))
 
-        results = []
-        for im_ind in range(len(input_images)):
-            num_res = int(num[im_ind])
-            results.append({"classes": [int(x) for x in classes[im_ind].tolist()][:num_res],
-                            "boxes":  boxes[im_ind].tolist()[:num_res],
-                            "scores": scores[im_ind].tolist()[:num_res]})
+        return num.astype(int), classes.astype(int), boxes, scores
 
-        return results
-
-    def _filter_humans(self, results):
-        """
-        Filters the predictions for a single image to keep only the humans detected with a score above a given threshold
-
-        :param results: dict {"classes" : [...], "boxes": [...], "scores": [...]} where
-                        - classes = list of int
-                        - boxes : list of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
-                        - scores : list of float
-        :return: same as input
+    def _filter_humans(self, num, classes, boxes, scores):
         """
-        # filter on class
-        humans_boxes, humans_scores = [], []
-        filtered_tuples = [triplet for triplet in zip(results["classes"], results["boxes"], results["scores"]) if triplet[0] == self._output_ind_for_humans]
-        if len(filtered_tuples):
-            _, humans_boxes, humans_scores = zip(*filtered_tuples)
+        Filters the predictions for a batch of images to keep only the humans detected with a score above a given threshold
+        Filtering is done with masks on the whole batch; results stay nd arrays (see utils.NumpyEncoder for serialization)
 
-        # filter on score
-        correct_humans_boxes, correct_humans_scores = [], []
-        filtered_tuples = [vals for vals in zip(humans_boxes, humans_scores) if vals[1] >= self._min_detection_score]
-        if len(filtered_tuples):
-            correct_humans_boxes, correct_humans_scores = zip(*filtered_tuples)
-
-        return {"classes": [self._output_ind_for_humans for _ in correct_humans_scores],
-                "boxes": list(correct_humans_boxes),
-                "scores": list(correct_humans_scores)}
+        :param num, classes, boxes, scores: batch outputs of the model, as given by _run_model
+        :return: list of dict {"classes" : [...], "boxes": [...], "scores": [...]} where
+                        - classes = 1D nd array of int
+                        - boxes : 2D nd array of [top_left.y, top_left.x, bottom_right.y, bottom_right.x] (with X is horizontal and Y is vertical, openCV)
+                        - scores : 1D nd array of float
+        """
+        # keep only the num first detections of each image, with class "human" and a high enough score
+        mask = np.arange(classes.shape[1])[np.newaxis, :] < num[:, np.newaxis]
+        mask &= classes == self._output_ind_for_humans
+        mask &= scores >= self._min_detection_score
+
+        return [{"classes": im_classes[im_mask],
+                 "boxes": im_boxes[im_mask],
+                 "scores": im_scores[im_mask]}
+                for im_mask, im_classes, im_boxes, im_scores in zip(mask, classes, boxes, scores)]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+# Copyright 2019 Cyril Poulet, cyril.poulet@centraliens.net
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+
+
+class MatchInterleaver(object):
+
+    def __init__(self):
+        """
+        This class reorders the videos held by one worker (the messages it has received and not prepared yet), grouping them by
+        match (the uploaded video they were split from, "parent_video" in their document) :
+            - by rounds : each match with held videos gets one video per round
+            - in a round, the matches with the fewest held videos go first (ties go to the match seen first)
+            - the videos of a match are given back in the order they were added
+
+        It only sees the held videos, not the backlog of the matches in the queue : a video can only move ahead of the videos held
+        with it. It does not prevent a long upload enqueued first (eg a whole tournament) from delaying a short match enqueued after it,
+        as the clips of the short match are only received once the clips before them in the queue have been received.
+        """
+        # match id -> deque of items, in the order the matches were seen
+        self._match_queues = collections.OrderedDict()
+        # matches which already got a video in the current round
+        self._served_in_round = set()
+
+    def __len__(self):
+        return sum(len(match_queue) for match_queue in self._match_queues.values())
+
+    def add(self, match_id, item):
+        """
+        :param match_id: id of the match of the video (eg its parent_video)
+        :param item: anything describing the video to analyze (eg its SQS message)
+        """
+        self._match_queues.setdefault(match_id, collections.deque()).append(item)
+
+    def pop(self):
+        """
+        :return: tuple (match_id, item) of the next video to analyze
+        """
+        if not self._match_queues:
+            raise IndexError("pop from an empty MatchInterleaver")
+        candidates = [match_id for match_id in self._match_queues if match_id not in self._served_in_round]
+        if not candidates:
+            # new round
+            self._served_in_round.clear()
+            candidates = list(self._match_queues)
+
+        match_id = min(candidates, key=lambda candidate: len(self._match_queues[candidate]))
+        item = self._match_queues[match_id].popleft()
+        if not self._match_queues[match_id]:
+            del self._match_queues[match_id]
+        # a match stays served until the end of the round, even if new videos of it are added
+        self._served_in_round.add(match_id)
+        return match_id, item
@@ -0,0 +1,109 @@
+# Copyright 2019 Cyril Poulet, cyril.poulet@centraliens.net
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import cv2
+import tensorflow as tf
+
+
+# colour space of the frames given by OpenCV
+native_color_space = "BGR"
+color_conversions = {
+    "RGB": cv2.COLOR_BGR2RGB
+}
+
+
+def resize_to_width(input_image, target_width):
+    """
+    resize image to target_width while keeping the ratio
+
+    :param input_image: 3D nd array
+    :param target_width: int
+    :return: 3D nd array
+    """
+    w = input_image.shape[1]
+    ratio = float(target_width) / float(w)
+    return cv2.resize(input_image, (target_width, int(float(input_image.shape[0]) * ratio)))
+
+
+class BatchPreprocessor(object):
+
+    def __init__(self, images):
+        """
+        This class computes the inputs of detectors for a batch of frames, and keeps them so that
+        each distinct variant (width, colour space) is computed only once per frame, whatever the number of detectors asking for it.
+
+        Variants are described by input specs (see Detector.input_spec):
+            - None : the raw frames
+            - (target_width, color_space) : frames resized to target_width (keeping the ratio) then converted to color_space ("BGR" or "RGB")
+
+        IMPORTANT : variants are shared between detectors, so they must not be modified in place
+
+        :param images: list of 3D nd array, HxWxC (BGR)
+        """
+        self._images = images
+        self._variants = {}
+
+    def get(self, input_spec):
+        """
+        get the variant of the batch described by input_spec
+
+        :param input_spec: None or tuple (target_width, color_space)
+        :return: list of 3D nd array
+        """
+        if input_spec is None:
+            return self._images
+
+        input_spec = tuple(input_spec)
+        if input_spec not in self._variants:
+            target_width, color_space = input_spec
+            if color_space == native_color_space:
+                self._variants[input_spec] = [resize_to_width(im, target_width) for im in self._images]
+            elif color_space in color_conversions:
+                # convert from the resized native variant, which is shared with detectors using native frames
+                resized_images = self.get((target_width, native_color_space))
+                self._variants[input_spec] = [cv2.cvtColor(im, color_conversions[color_space]) for im in resized_images]
+            else:
+                raise ValueError("Unknown color space {}".format(color_space))
+
+        return self._variants[input_spec]
+
+
+def build_tf_preprocessing(input_spec):
+    """
+    builds in the default TF graph the ops equivalent to BatchPreprocessor.get(input_spec), so that the preprocessing
+    can run inside the model graph (see the in_graph_preprocessing option of the detectors)
+
+    :param input_spec: None or tuple (target_width, color_space), see BatchPreprocessor
+    :return: tuple (placeholder for a uint8 batch of raw frames (N, H, W, 3), preprocessed uint8 batch tensor)
+    """
+    raw_images = tf.placeholder(tf.uint8, shape=[None, None, None, 3], name='raw_image_tensor')
+    if input_spec is None:
+        return raw_images, raw_images
+
+    target_width, color_space = input_spec
+    if color_space != native_color_space and color_space not in color_conversions:
+        raise ValueError("Unknown color space {}".format(color_space))
+
+    # resize to target_width while keeping the ratio (same rounding as resize_to_width)
+    shape = tf.shape(raw_images)
+    ratio = float(target_width) / tf.cast(shape[2], tf.float32)
+    target_height = tf.cast(tf.cast(shape[1], tf.float32) * ratio, tf.int32)
+    images = tf.image.resize_bilinear(raw_images, tf.stack([target_height, target_width]))
+    images = tf.cast(tf.clip_by_value(tf.round(images), 0., 255.), tf.uint8)
+
+    if color_space == "RGB":
+        # frames are BGR, converting is reversing the channels
+        images = tf.reverse(images, axis=[-1])
+    return raw_images, images
@@ -0,0 +1,93 @@
+# Copyright 2019 Cyril Poulet, cyril.poulet@centraliens.net
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+
+from utils import NumpyEncoder
+from columnar_results import ColumnarResultsWriter
+
+
+results_formats = ["json", "jsonl", "npz"]
+# formats written as text, the others are binary
+text_results_formats = ["json", "jsonl"]
+
+
+def create_results_writer(output, results_format="json"):
+    """
+    create the writer for a results format
+
+    :param output: file-like object, opened for writing text for text_results_formats, bytes otherwise
+    :param results_format: one of results_formats
+    :return: ResultsWriter or ColumnarResultsWriter
+    """
+    if results_format == "npz":
+        return ColumnarResultsWriter(output)
+    return ResultsWriter(output, results_format)
+
+
+class ResultsWriter(object):
+
+    def __init__(self, output, results_format="json"):
+        """
+        This class writes the results of VideoAnalyzer.analyze_video to a stream as frames are analyzed,
+        so that results never have to be held in memory for the whole video.
+
+        Formats:
+            - "json" : the same document as the one returned by analyze_video ({"fps": ..., "codec_code": ..., "frames": [...]}),
+                       written incrementally
+            - "jsonl" : newline-delimited JSON, with a first line {"fps": ..., "codec_code": ...} then one line per frame
+
+        :param output: file-like object opened for writing text (or with a write(str) method, eg S3MultipartUploadStream)
+        :param results_format: one of text_results_formats
+        """
+        if results_format not in text_results_formats:
+            raise ValueError("Unknown results format {}. Must be one of {}".format(results_format, text_results_formats))
+        self._output = output
+        self._results_format = results_format
+        self.nb_frames = 0
+
+    def start(self, video_info):
+        """
+        write the information on the video, before any frame
+
+        :param video_info: dict {"fps": vid_fps, "codec_code": vid_codec_code}
+        """
+        if self._results_format == "json":
+            header = json.dumps(video_info, cls=NumpyEncoder)
+            # open the frames list inside the document
+            self._output.write(header[:-1] + (', ' if video_info else '') + '"frames": [')
+        else:
+            self._output.write(json.dumps(video_info, cls=NumpyEncoder) + '\n')
+
+    def write_frames(self, frames):
+        """
+        write results of frames
+
+        :param frames: list of dict (see VideoAnalyzer.analyze_video)
+        """
+        for frame in frames:
+            if self._results_format == "json":
+                self._output.write((', ' if self.nb_frames else '') + json.dumps(frame, cls=NumpyEncoder))
+            else:
+                self._output.write(json.dumps(frame, cls=NumpyEncoder) + '\n')
+            self.nb_frames += 1
+
+    def end(self):
+        """
+        write the end of the results. The output is not closed.
+        """
+        if self._results_format == "json":
+            self._output.write(']}')
+
@@ -0,0 +1,190 @@
+# Copyright 2019 Cyril Poulet, cyril.poulet@centraliens.net
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+IMPORTANT : this module only depends on boto3 (and aws_clients), as it is shared with results_viewer (symbolic link)
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from aws_clients import get_client
+
+
+default_cache_dir = os.path.join(tempfile.gettempdir(), "derby_s3_cache")
+default_max_size_in_mb = 10 * 1024
+partial_download_suffix = ".part"
+
+
+class S3FileCache(object):
+
+    def __init__(self, cache_dir=default_cache_dir, max_size_in_mb=default_max_size_in_mb, nb_prefetch_threads=1):
+        """
+        This class keeps local copies of files from s3, so that a file used several times (eg a video analyzed with new
+        detector settings, then used for its control movie) is downloaded only once.
+
+        Files are content-addressed : the name of the local copy is a hash of bucket/key/ETag, so a file changed on s3
+        is downloaded again, and the cache directory can be kept from one run to the next.
+        When the files in the cache exceed max_size_in_mb, the least recently used ones are removed (except files in use).
+
+        Files can be prefetched in background threads (prefetch), eg the next queued video while the current one is analyzed.
+
+        :param cache_dir: directory of the local copies
+        :param max_size_in_mb: size budget of the cache
+        :param nb_prefetch_threads: number of files prefetched at the same time
+        """
+        self._cache_dir = cache_dir
+        self._max_size = max_size_in_mb * 1024 * 1024
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # local path -> Future, for the downloads in progress
+        self._downloads = {}
+        # local path -> number of users, these files are never evicted
+        self._in_use = collections.Counter()
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=nb_prefetch_threads)
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+        self._logger = logging.getLogger("S3FileCache")
+
+    def get_file(self, region_id, bucket_name, key):
+        """
+        get the local copy of a file, downloading it if it is not in the cache (or waiting for the download in progress)
+        The file must be released (release) once it is not used anymore. It must not be modified or removed.
+
+        :param region_id: region of the bucket (eg "eu-west-1")
+        :param bucket_name: name of the bucket
+        :param key: key of the file to get in the bucket
+        :return: path to the local copy
+        """
+        s3 = get_client('s3', region_id)
+        try:
+            etag = s3.head_object(Bucket=bucket_name, Key=key)["ETag"].strip('"')
+        except Exception as e:
+            if hasattr(e, "message"):
+                e.message = "S3 : " + e.message
+            raise e
+        entry_name = hashlib.sha256("{}/{}/{}".format(bucket_name, key, etag).encode('utf-8')).hexdigest()
+        local_path = os.path.join(self._cache_dir, entry_name + os.path.splitext(key)[1])
+
+        with self._lock:
+            self._in_use[local_path] += 1
+            download = self._downloads.get(local_path)
+            if download is None and os.path.exists(local_path):
+                self.stats["hits"] += 1
+                # the modification time is the last use time, for the LRU eviction
+                os.utime(local_path)
+                return local_path
+            is_downloader = download is None
+            if is_downloader:
+                self.stats["misses"] += 1
+                download = Future()
+                self._downloads[local_path] = download
+
+        try:
+            if is_downloader:
+                self._download(s3, bucket_name, key, local_path, download)
+                self._evict()
+            else:
+                download.result()
+        except Exception as e:
+            self.release(local_path)
+            raise e
+        return local_path
+
+    def _download(self, s3, bucket_name, key, local_path, download):
+        """
+        download a file to a temporary name in the cache, then move it to its final name
+        """
+        partial_path = local_path + partial_download_suffix
+        self._logger.debug("Downloading {}/{}".format(bucket_name, key))
+        try:
+            s3.download_file(bucket_name, key, partial_path)
+            os.replace(partial_path, local_path)
+            download.set_result(local_path)
+        except Exception as e:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            if hasattr(e, "message"):
+                e.message = "S3 : " + e.message
+            download.set_exception(e)
+            raise e
+        finally:
+            with self._lock:
+                self._downloads.pop(local_path)
+
+    def release(self, local_path):
+        """
+        let the cache know that a file given by get_file is not used anymore
+
+        :param local_path: path returned by get_file
+        """
+        with self._lock:
+            self._in_use[local_path] -= 1
+            if self._in_use[local_path] <= 0:
+                del self._in_use[local_path]
+
+    def prefetch(self, region_id, bucket_name, key):
+        """
+        download a file to the cache in a background thread, if it is not there yet
+
+        :param region_id: region of the bucket (eg "eu-west-1")
+        :param bucket_name: name of the bucket
+        :param key: key of the file to get in the bucket
+        :return: Future, done when the file is in the cache
+        """
+        return self._prefetch_pool.submit(self._prefetch, region_id, bucket_name, key)
+
+    def _prefetch(self, region_id, bucket_name, key):
+        try:
+            self.release(self.get_file(region_id, bucket_name, key))
+        except Exception as e:
+            self._logger.warning("Could not prefetch {}/{} : {}".format(bucket_name, key, e))
+            raise e
+
+    def _evict(self):
+        """
+        remove the least recently used files until the cache fits in its size budget
+        """
+        with self._lock:
+            entries = []
+            for entry_name in os.listdir(self._cache_dir):
+                if entry_name.endswith(partial_download_suffix):
+                    continue
+                entry_path = os.path.join(self._cache_dir, entry_name)
+                entry_stat = os.stat(entry_path)
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+
+            cache_size = sum(entry[1] for entry in entries)
+            for _, entry_size, entry_path in sorted(entries):
+                if cache_size <= self._max_size:
+                    break
+                if entry_path in self._in_use:
+                    continue
+                os.remove(entry_path)
+                cache_size -= entry_size
+                self.stats["evictions"] += 1
+                self._logger.debug("Evicted {} from the cache".format(entry_path))
+
+    def close(self):
+        """
+        wait for the prefetches in progress
+        """
+        self._prefetch_pool.shutdown()
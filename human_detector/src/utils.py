@@ -15,6 +15,7 @@
 
 import json
 import decimal
+import numpy as np
 from tensorflow.python.client import device_lib
 
 
@@ -51,3 +52,15 @@ class DecimalDecoder(json.JSONEncoder):
             else:
                 return int(o)
         return super(DecimalDecoder, self).default(o)
+
+
+# Helper class to convert detection results (nd arrays) to JSON.
+class NumpyEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, np.ndarray):
+            return o.tolist()
+        if isinstance(o, np.integer):
+            return int(o)
+        if isinstance(o, np.floating):
+            return float(o)
+        return super(NumpyEncoder, self).default(o)
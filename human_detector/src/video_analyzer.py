@@ -13,25 +13,90 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import cv2
+import collections
 import logging
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import sys
+import threading
+import time
 
 from detector import DetectorFactory
+from frame_reader import FrameReader, default_seek_min_frame_gap
+from preprocessing import BatchPreprocessor
 
 logging.basicConfig(stream=sys.stdout,
                     level=logging.DEBUG,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 
+# marks the end of the stream of chunks between two stages of the pipeline
+_END_OF_STREAM = object()
+
+
+class FrameResultsAligner(object):
+
+    def __init__(self, detectors_names):
+        """
+        This class merges results from various detectors which may run on different batches of frames,
+        and returns them by frame, in the order the frames were read, once all detectors have processed them
+
+        :param detectors_names: list of str, names of the detectors whose results are expected for each frame
+        """
+        self._detectors_names = detectors_names
+        self._pending_frames = collections.OrderedDict()
+
+    def add(self, frames_info, detections):
+        """
+        register new frames to wait results for, and new detection results
+
+        :param frames_info: list of tuples (index of frame, time of frame), in reading order
+        :param detections: list of tuples (detector_name, frames_info, list of {detection results for given frame})
+        :returns: list of dict for the frames which are now complete {
+                                "frame_index": ,
+                                "frame_timestamp": 
+                                "detector_name_1":  {detection results for given frame},
+                                ...
+                                }
+        """
+        for f_ind, f_tsp in frames_info:
+            self._pending_frames[f_ind] = (f_tsp, {})
+        for detector_name, det_frames_info, det_results in detections:
+            for (f_ind, _), im_det_res in zip(det_frames_info, det_results):
+                self._pending_frames[f_ind][1][detector_name] = im_det_res
+
+        results = []
+        while self._pending_frames:
+            f_ind, (f_tsp, frame_detections) = next(iter(self._pending_frames.items()))
+            if len(frame_detections) < len(self._detectors_names):
+                break
+            self._pending_frames.popitem(last=False)
+            im_res = {
+                "frame_index": f_ind,
+                "frame_timestamp": f_tsp
+            }
+            for key in self._detectors_names:
+                im_res[key] = frame_detections[key]
+            results.append(im_res)
+        return results
+
+
 class VideoAnalyzer(object):
 
-    def __init__(self, detectors=None, frame_ratio=1.):
+    def __init__(self, detectors=None, frame_ratio=1., pipelined=False, pipeline_queue_size=4,
+                 decode_mode="grab", seek_min_frame_gap=default_seek_min_frame_gap, concurrent_detectors=False):
         """
         This class instantiate N detectors and applies them to frames of a given video
 
         :param detectors: [(detector_name, parameters_dict), ...] -> list of tuples (str, dict). The detector_name must be an existing Detector subclass
         :param frame_ratio: ratio of frames to analyze (1 -> all frames, 0.2 -> 1 on 5, etc)
+        :param pipelined: if True, decoding/preprocessing, inference and results merging run in separate threads
+                          linked by bounded queues, so that decoding the next frames overlaps inference on the current one
+        :param pipeline_queue_size: max number of chunks of frames waiting between two stages of the pipeline
+        :param decode_mode: how frames not analyzed are skipped ("read", "grab" or "seek", see FrameReader)
+        :param seek_min_frame_gap: min number of frames to skip to seek instead of grabbing frames (see FrameReader)
+        :param concurrent_detectors: if True, each batch is sent to all detectors in parallel through a thread pool
+                                     (TF sessions release the GIL), so a batch takes the time of the slowest detector
         """
         if detectors is None:
             detectors = [("HumanDetector", {})]
@@ -47,12 +112,29 @@ class VideoAnalyzer(object):
             self._detectors.append(DetectorFactory.get_detector(key)(**vals))
 
         self._analysis_ratio = float(frame_ratio)
+        self._pipelined = pipelined
+        self._pipeline_queue_size = pipeline_queue_size
+        self._decode_mode = decode_mode
+        self._seek_min_frame_gap = seek_min_frame_gap
+        self.last_decode_stats = None
+
+        self._detectors_pool = None
+        if concurrent_detectors and len(self._detectors) > 1:
+            self._detectors_pool = ThreadPoolExecutor(max_workers=len(self._detectors))
 
-    def analyze_video(self, path_to_video):
+    def analyze_video(self, path_to_video, results_sink=None):
         """
         Loads a video and applies the detectors to the frames, with respect to the ratio defined at instantiation
 
+        Each detector accumulates frames in its own buffer and runs on them when it has batch_max_size frames,
+        so detectors with different batch sizes are not held to the smallest one. Results are then re-aligned by frame.
+
+        If results_sink is given, frames results are written to it as soon as they are complete instead of being returned,
+        so that memory does not grow with the length of the video.
+
         :param path_to_video: path to the video to annalyze
+        :param results_sink: None, or object with methods start(video_info), write_frames(list of frames results) and end(),
+                             eg a ResultsWriter
         :return:  {
                     "fps": vid_fps, 
                     "codec_code": vid_codec_code, 
@@ -63,96 +145,245 @@ class VideoAnalyzer(object):
                                     ...
                                     }
                   }
+                  if results_sink is given, "frames" is replaced by "nb_frames", the number of frames written to the sink
         """
         one_frame_every_n_frame = int(1./self._analysis_ratio)
         self._logger.info("Analyzing file {}, 1 frame every {} frame".format(path_to_video, one_frame_every_n_frame))
+        start_time = time.time()
         # open video
-        cap = cv2.VideoCapture(path_to_video)
+        frame_reader = FrameReader(path_to_video, self._analysis_ratio, self._decode_mode, self._seek_min_frame_gap)
         # get various infos on the video
-        vid_fps = cap.get(cv2.CAP_PROP_FPS)
-        vid_codec_code = cap.get(cv2.CAP_PROP_FOURCC)
+        vid_fps = frame_reader.fps
+        vid_codec_code = frame_reader.codec_code
         self._logger.info("Detected codec and FPS: {}, {}".format(vid_codec_code, vid_fps))
 
-        # determine processing batch size from detectors
-        max_batch_size = min([c.batch_max_size for c in self._detectors])
-        current_frame_ind = 0
-        input_timestamps = []
-        input_images = []
+        # frames are decoded in chunks of the smallest batch size, so that no detector waits for more frames than it needs
+        chunk_size = min([c.batch_max_size for c in self._detectors])
+
         frame_results = []
+        if results_sink is None:
+            write_frames = frame_results.extend
+        else:
+            results_sink.start({"fps": vid_fps, "codec_code": vid_codec_code})
+            write_frames = results_sink.write_frames
 
-        def process_results(frames_info, results_dict):
-            """
-            merge results from various detectors
+        try:
+            chunks = self._read_chunks(frame_reader, chunk_size)
+            if self._pipelined:
+                nb_frames = self._analyze_chunks_pipelined(chunks, write_frames)
+            else:
+                nb_frames = self._analyze_chunks(chunks, write_frames)
+        finally:
+            self.last_decode_stats = frame_reader.release()
 
-            :param frames_info: list of tuples (index of frame, time of frame)
-            :param results_dict: list of dict {detector_name: {detection results for given frame}}
-            :returns: list of dict {
-                                    "frame_index": ,
-                                    "frame_timestamp": 
-                                    "detector_name_1":  {detection results for given frame},
-                                    ...
-                                    }
-            """
-            results = []
-            for i, (f_ind, f_tsp) in enumerate(frames_info):
-                im_res = {
-                    "frame_index": f_ind,
-                    "frame_timestamp": f_tsp
-                }
-                for key in results_dict:
-                    im_res[key] = results_dict[key][i]
-                results.append(im_res)
-            return results
-
-        while True:
-            r, img = cap.read()
-            if not r:
-                # we reached the end of the video
-                break
+        self._logger.info("Analyzed {} images in {}s".format(nb_frames, time.time() - start_time))
+
+        if results_sink is not None:
+            results_sink.end()
+            return {"fps": vid_fps, "codec_code": vid_codec_code, "nb_frames": nb_frames}
+        return {"fps": vid_fps, "codec_code": vid_codec_code, "frames": frame_results}
+
+    @staticmethod
+    def _read_chunks(frames, chunk_size):
+        """
+        generator grouping the frames to analyze in chunks
+
+        :param frames: iterable of tuples (index of frame, time of frame, image), eg a FrameReader
+        :param chunk_size: max number of frames in a chunk
+        :return: yields tuples (frames_info, images) where
+                    - frames_info : list of tuples (index of frame, time of frame)
+                    - images : list of 3D nd array, HxWxC
+        """
+        input_timestamps = []
+        input_images = []
+
+        for frame_ind, frame_tsp, img in frames:
+            input_images.append(img)
+            input_timestamps.append((frame_ind, frame_tsp))
 
-            # count frames, skip frames if necessary to respect processing ratio
-            current_frame_ind += 1
-            if (current_frame_ind - 1) % one_frame_every_n_frame != 0:
-                continue
-
-            if len(input_images) < max_batch_size:
-                # while we do not have a complete batch, stack images to process
-                input_images.append(img)
-                input_timestamps.append((current_frame_ind, cap.get(cv2.CAP_PROP_POS_MSEC)))
-
-            if len(input_images) == max_batch_size:
-                # process batch
-                detection_results = {}
-                for det in self._detectors:
-                    det_results = det.analyze_images(input_images)
-                    detection_results[det.detected_category] = det_results
-                batch_results = process_results(input_timestamps, detection_results)
-                # store results
-                frame_results.extend(batch_results)
+            if len(input_images) == chunk_size:
+                yield input_timestamps, input_images
                 input_images = []
                 input_timestamps = []
 
-        # process last batch (which may be incomplete)
-        detection_results = {}
+        # last chunk may be incomplete
         if input_images:
-            for det in self._detectors:
-                det_results = det.analyze_images(input_images)
-                detection_results[det.detected_category] = det_results
-            batch_results = process_results(input_timestamps, detection_results)
-            frame_results.extend(batch_results)
+            yield input_timestamps, input_images
 
-        cap.release()
-        self._logger.info("Analyzed {} images".format(len(frame_results)))
+    def _prepare_batches(self, chunks, batch_buffers):
+        """
+        generator writing the inputs of each detector for chunks of images straight into the detectors batch buffers
+        Each distinct input declared by the detectors (see Detector.input_spec) is computed once and shared between them.
+        Each detector has its own batches, which are ready when they hold batch_max_size frames. Remaining frames make a final batch.
 
-        return {"fps": vid_fps, "codec_code": vid_codec_code, "frames": frame_results}
+        :param chunks: iterable of (frames_info, images), as given by _read_chunks
+        :param batch_buffers: list (one item per detector) of BatchBuffer
+        :return: yields tuples (frames_info, ready_batches) where
+                    - frames_info : frames of the chunk (empty for the final batches)
+                    - ready_batches : list of tuples (detector, frames_info, 4D nd array of inputs)
+        """
+        batches_frames = [[] for _ in self._detectors]
+
+        for frames_info, images in chunks:
+            preprocessor = BatchPreprocessor(images)
+            ready_batches = []
+            for det, batch_buffer, batch_frames in zip(self._detectors, batch_buffers, batches_frames):
+                for frame_info, det_input in zip(frames_info, preprocessor.get(det.input_spec)):
+                    batch_frames.append(frame_info)
+                    if batch_buffer.write(det_input):
+                        ready_batches.append((det, list(batch_frames), batch_buffer.take()))
+                        del batch_frames[:]
+            yield frames_info, ready_batches
+
+        yield [], [(det, list(batch_frames), batch_buffer.take())
+                   for det, batch_buffer, batch_frames in zip(self._detectors, batch_buffers, batches_frames)
+                   if batch_frames]
+
+    def _detect_batches(self, prepared_batches):
+        """
+        generator running the detectors on their ready batches
+
+        :param prepared_batches: iterable of (frames_info, ready_batches), as given by _prepare_batches
+        :return: yields tuples (frames_info, detections) where
+                    - frames_info : frames of the chunk (empty for the final batches)
+                    - detections : list of tuples (detector_name, frames_info, list of {detection results for given frame})
+        """
+        for frames_info, ready_batches in prepared_batches:
+            results = self._run_detectors([(det, batch) for det, _, batch in ready_batches])
+            yield frames_info, [(det.detected_category, batch_frames, det_results)
+                                for (det, batch_frames, _), det_results in zip(ready_batches, results)]
+
+    def _run_detectors(self, detectors_inputs):
+        """
+        apply detectors to their batches
+
+        :param detectors_inputs: list of tuples (detector, batch of preprocessed inputs)
+        :return: list (one item per detector, same order) of lists of {detection results for given frame}
+        """
+        if self._detectors_pool is not None and len(detectors_inputs) > 1:
+            futures = [self._detectors_pool.submit(det.analyze_preprocessed_images, det_inputs)
+                       for det, det_inputs in detectors_inputs]
+            # results are collected in the detectors order, so the merge does not depend on which detector ends first
+            return [future.result() for future in futures]
+        return [det.analyze_preprocessed_images(det_inputs) for det, det_inputs in detectors_inputs]
+
+    def _get_batch_buffers(self, nb_buffers):
+        """
+        get the batch buffers of the detectors, with room for nb_buffers batches in use at the same time, and empty
+
+        :param nb_buffers: int
+        :return: list (one item per detector) of BatchBuffer
+        """
+        batch_buffers = [det.get_batch_buffer(nb_buffers) for det in self._detectors]
+        for batch_buffer in batch_buffers:
+            batch_buffer.reset()
+        return batch_buffers
+
+    def _analyze_chunks(self, chunks, write_frames):
+        """
+        decode, analyze and merge chunks one after the other
+
+        :param chunks: iterable of (frames_info, images), as given by _read_chunks
+        :param write_frames: function called with each list of merged frame results (see FrameResultsAligner), in frames order
+        :return: number of frames analyzed
+        """
+        batch_buffers = self._get_batch_buffers(nb_buffers=2)
+        aligner = FrameResultsAligner([det.detected_category for det in self._detectors])
+        nb_frames = 0
+        for frames_info, detections in self._detect_batches(self._prepare_batches(chunks, batch_buffers)):
+            frames = aligner.add(frames_info, detections)
+            write_frames(frames)
+            nb_frames += len(frames)
+        return nb_frames
+
+    def _analyze_chunks_pipelined(self, chunks, write_frames):
+        """
+        same as _analyze_chunks, but with 3 stages running concurrently:
+            - a producer thread decoding and preprocessing chunks, writing them into the detectors batches
+            - a consumer thread running the detectors on them
+            - the calling thread merging the results
+        Stages are linked by bounded queues, so that decoding cannot run too far ahead of inference.
+        If a stage fails, all stages are stopped and the error is raised in the calling thread.
+
+        :param chunks: iterable of (frames_info, images), as given by _read_chunks
+        :param write_frames: function called with each list of merged frame results (see FrameResultsAligner), in frames order
+        :return: number of frames analyzed
+        """
+        # batches can be in the decoded queue, being run, being filled, and done but waiting to be put in the queue
+        batch_buffers = self._get_batch_buffers(nb_buffers=self._pipeline_queue_size + 3)
+        decoded_chunks = queue.Queue(maxsize=self._pipeline_queue_size)
+        analyzed_chunks = queue.Queue(maxsize=self._pipeline_queue_size)
+        stop_event = threading.Event()
+        errors = []
+
+        def put(output_queue, item):
+            # block while the queue is full, unless another stage has failed
+            while not stop_event.is_set():
+                try:
+                    output_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def iterate(input_queue):
+            # yield items until the end of the stream, or until another stage has failed
+            while not stop_event.is_set():
+                try:
+                    item = input_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _END_OF_STREAM:
+                    return
+                yield item
+
+        def run_stage(stage_name, items, output_queue):
+            try:
+                for item in items:
+                    if not put(output_queue, item):
+                        return
+                put(output_queue, _END_OF_STREAM)
+            except Exception as e:
+                self._logger.error("Error in {} stage : {}".format(stage_name, e))
+                errors.append(e)
+                stop_event.set()
+
+        stages = [
+            threading.Thread(target=run_stage,
+                             args=("decoding", self._prepare_batches(chunks, batch_buffers), decoded_chunks)),
+            threading.Thread(target=run_stage,
+                             args=("inference", self._detect_batches(iterate(decoded_chunks)), analyzed_chunks)),
+        ]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+
+        aligner = FrameResultsAligner([det.detected_category for det in self._detectors])
+        nb_frames = 0
+        try:
+            for frames_info, detections in iterate(analyzed_chunks):
+                frames = aligner.add(frames_info, detections)
+                write_frames(frames)
+                nb_frames += len(frames)
+        finally:
+            stop_event.set()
+            for stage in stages:
+                stage.join()
+
+        if errors:
+            raise errors[0]
+        return nb_frames
 
     def close(self):
         self._logger.info("Closing all detectors")
+        if self._detectors_pool is not None:
+            self._detectors_pool.shutdown()
         [c.close() for c in self._detectors]
 
 
 if __name__ == "__main__":
     import json
+    from utils import NumpyEncoder
     with open('variables.json') as f:
         params = json.load(f)
 
@@ -161,6 +392,6 @@ if __name__ == "__main__":
     analyzer = VideoAnalyzer(**params["human_detection"])
     results = analyzer.analyze_video(test_video)
     with open('test.json', 'w') as f:
-        json.dump(results, f)
+        json.dump(results, f, cls=NumpyEncoder)
 
     analyzer.close()
@@ -0,0 +1,352 @@
+# Copyright 2019 Cyril Poulet, cyril.poulet@centraliens.net
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Partial updates of the video documents in dynamoDB (index is VideoId).
+
+Instead of getting the whole document then putting it back, each change is a single update_item on the attributes it touches,
+so the size of the request does not grow with the document, and concurrent changes of different steps cannot overwrite each other.
+Changes of a step entry are conditioned on the entry at the given index being that step.
+
+A step can be claimed (claim_process_step) : a lease {"claimer": ..., "claimed_at": ..., "finished": false} is put in the
+"claim_<step name>" attribute of the document in the same update as the step entry, on condition that there is no claim yet, or that
+the claim is unfinished and older than its lease. Of several workers given the same video and step (duplicate messages), only the
+first one gets it, the others get StepAlreadyClaimed. The claimer renews its lease while it works (renew_process_step_claim), and
+marks the claim as finished with the "done" state (complete_process_step), or removes it on error (release_process_step).
+If the claimer dies, its lease expires and the step can be claimed again. A finished claim is only removed by reset_process_step_claim
+(eg to run the step again with new settings).
+
+IMPORTANT : this module only depends on boto3 (and aws_clients), as it is shared with results_viewer and derbyTimeSplitVideoLambda
+(symbolic links)
+"""
+
+import json
+import decimal
+import time
+
+from aws_clients import get_resource
+
+
+class ConditionFailed(Exception):
+    pass
+
+
+class StepAlreadyClaimed(Exception):
+
+    def __init__(self, message, finished):
+        """
+        :param message: error message
+        :param finished: True if the step is done (or the document does not exist), False if another claimer holds an unexpired lease
+        """
+        super(StepAlreadyClaimed, self).__init__(message)
+        self.finished = finished
+
+
+default_claim_lease_in_sec = 300
+
+
+def _to_dynamo_db(value):
+    # trick to turn floats and ints to Decimal for DynamoDB
+    return json.loads(json.dumps(value), parse_float=decimal.Decimal)
+
+
+def _update_item(region_id, tableId, video_id, **update_args):
+    table = get_resource('dynamodb', region_id).Table(tableId)
+    try:
+        return table.update_item(Key={"VideoId": _to_dynamo_db(video_id)}, **update_args)
+    except table.meta.client.exceptions.ConditionalCheckFailedException as e:
+        raise ConditionFailed('DynamoDB : Condition failed on document {} ({})'.format(video_id, update_args["ConditionExpression"])) from e
+    except Exception as e:
+        if hasattr(e, "message"):
+            e.message = "DynamoDB : " + e.message
+        raise e
+
+
+def append_process_step(region_id, tableId, video_id, step_name, state):
+    """
+    add a step entry {"step": step_name, "state": state} at the end of the process_steps of a document, which must exist
+
+    :param region_id: region of the table
+    :param tableId: table to update
+    :param video_id: VideoId of the document
+    :param step_name: name of the step
+    :param state: state of the step (eg "running")
+    :return: index of the new entry in process_steps (to give to set_process_step_state)
+    """
+    response = _update_item(region_id, tableId, video_id,
+                            UpdateExpression="SET process_steps = list_append(process_steps, :new_steps)",
+                            ConditionExpression="attribute_exists(VideoId)",
+                            ExpressionAttributeValues={":new_steps": [{"step": step_name, "state": state}]},
+                            ReturnValues="UPDATED_NEW")
+    return len(response["Attributes"]["process_steps"]) - 1
+
+
+def _claim_attribute(step_name):
+    return "claim_" + step_name
+
+
+def claim_process_step(region_id, tableId, video_id, step_name, state, claimer, lease_in_sec=default_claim_lease_in_sec):
+    """
+    add a step entry {"step": step_name, "state": state} at the end of the process_steps of a document, which must exist,
+    and claim the step for claimer. Fails if the step is claimed by someone else and the lease has not expired, or if the claim is finished
+
+    :param region_id: region of the table
+    :param tableId: table to update
+    :param video_id: VideoId of the document
+    :param step_name: name of the step
+    :param state: state of the step (eg "running")
+    :param claimer: id of the claimer (eg of the worker)
+    :param lease_in_sec: duration after which an unrenewed claim can be taken over
+    :return: index of the new entry in process_steps (to give to set_process_step_state)
+    :raise StepAlreadyClaimed: if the step can not be claimed (or the document does not exist)
+    """
+    now = time.time()
+    try:
+        response = _update_item(region_id, tableId, video_id,
+                                UpdateExpression="SET process_steps = list_append(process_steps, :new_steps), #claim = :claim",
+                                ConditionExpression="attribute_exists(VideoId) AND (attribute_not_exists(#claim) OR "
+                                                    "(#claim.finished = :false AND #claim.claimed_at < :expired_before))",
+                                ExpressionAttributeNames={"#claim": _claim_attribute(step_name)},
+                                ExpressionAttributeValues={":new_steps": [{"step": step_name, "state": state}],
+                                                           ":claim": _to_dynamo_db({"claimer": claimer, "claimed_at": now, "finished": False}),
+                                                           ":false": False,
+                                                           ":expired_before": _to_dynamo_db(now - lease_in_sec)},
+                                ReturnValues="UPDATED_NEW")
+    except ConditionFailed as e:
+        claim = get_process_step_claim(region_id, tableId, video_id, step_name)
+        finished = claim is None or claim.get("finished", False)
+        raise StepAlreadyClaimed('DynamoDB : Step {} of document {} is already claimed ({})'.format(step_name, video_id, claim),
+                                 finished) from e
+    return len(response["Attributes"]["process_steps"]) - 1
+
+
+def get_process_step_claim(region_id, tableId, video_id, step_name):
+    """
+    :param region_id: region of the table
+    :param tableId: table to read
+    :param video_id: VideoId of the document
+    :param step_name: name of the step
+    :return: the claim on the step {"claimer": ..., "claimed_at": ..., "finished": ...}, {} if it is not claimed,
+             or None if the document does not exist
+    """
+    table = get_resource('dynamodb', region_id).Table(tableId)
+    try:
+        response = table.get_item(Key={"VideoId": _to_dynamo_db(video_id)}, ConsistentRead=True)
+    except Exception as e:
+        if hasattr(e, "message"):
+            e.message = "DynamoDB : " + e.message
+        raise e
+    if "Item" not in response:
+        return None
+    return response["Item"].get(_claim_attribute(step_name), {})
+
+
+def renew_process_step_claim(region_id, tableId, video_id, step_name, claimer):
+    """
+    renew the lease of claimer on a step (see claim_process_step), so that it is not taken over while claimer works on it
+
+    :param region_id: region of the table
+    :param tableId: table to update
+    :param video_id: VideoId of the document
+    :param step_name: name of the step
+    :param claimer: id of the claimer
+    :return: None
+    :raise ConditionFailed: if the claim is not held by claimer anymore, or is finished
+    """
+    _update_item(region_id, tableId, video_id,
+                 UpdateExpression="SET #claim.claimed_at = :now",
+                 ConditionExpression="#claim.claimer = :claimer AND #claim.finished = :false",
+                 ExpressionAttributeNames={"#claim": _claim_attribute(step_name)},
+                 ExpressionAttributeValues={":now": _to_dynamo_db(time.time()), ":claimer": claimer, ":false": False})
+
+
+def release_process_step(region_id, tableId, video_id, step_name, claimer):
+    """
+    remove the claim of claimer on a step (see claim_process_step), so that it can be claimed again (eg after an error).
+    Nothing is done if the claim was taken over by someone else.
+
+    :param region_id: region of the table
+    :param tableId: table to update
+    :param video_id: VideoId of the document
+    :param step_name: name of the step
+    :param claimer: id of the claimer
+    :return: True if the claim was removed, False if it is not held by claimer
+    """
+    try:
+        _update_item(region_id, tableId, video_id,
+                     UpdateExpression="REMOVE #claim",
+                     ConditionExpression="#claim.claimer = :claimer",
+                     ExpressionAttributeNames={"#claim": _claim_attribute(step_name)},
+                     ExpressionAttributeValues={":claimer": claimer})
+    except ConditionFailed:
+        return False
+    return True
+
+
+def reset_process_step_claim(region_id, tableId, video_id, step_name):
+    """
+    remove the claim on a step, whoever holds it and even if it is finished, so that the step can be run again
+    (eg with new settings of the detector). The step entries already in process_steps are kept.
+
+    :param region_id: region of the table
+    :param tableId: table to update
+    :param video_id: VideoId of the document
+    :param step_name: name of the step
+    :return: None
+    """
+    _update_item(region_id, tableId, video_id,
+                 UpdateExpression="REMOVE #claim",
+                 ConditionExpression="attribute_exists(VideoId)",
+                 ExpressionAttributeNames={"#claim": _claim_attribute(step_name)})
+
+
+def _step_state_update(step_index, step_name, state, step_values):
+    """
+    :return: tuple (list of SET assignments, attribute names, attribute values) setting the state and values of a step entry
+    """
+    step_path = "process_steps[{}]".format(int(step_index))
+    names = {"#step": "step", "#state": "state"}
+    values = {":step": step_name, ":state": state}
+    assignments = ["{}.#state = :state".format(step_path)]
+    for i, (key, value) in enumerate(step_values.items()):
+        names["#value{}".format(i)] = key
+        values[":value{}".format(i)] = _to_dynamo_db(value)
+        assignments.append("{0}.#value{1} = :value{1}".format(step_path, i))
+    return assignments, names, values
+
+
+def set_process_step_state(region_id, tableId, video_id, step_index, step_name, state, **step_values):
+    """
+    set the state (and other values) of a step entry of a document.
+    Fails if the entry at step_index is not step_name.
+
+    :param region_id: region of the table
+    :param tableId: table to update
+    :param video_id: VideoId of the document
+    :param step_index: index of the entry in process_steps
+    :param step_name: name of the step
+    :param state: new state of the step (eg "done", "error")
+    :param step_values: other values to set in the step entry (eg result_file)
+    :return: None
+    """
+    assignments, names, values = _step_state_update(step_index, step_name, state, step_values)
+    _update_item(region_id, tableId, video_id,
+                 UpdateExpression="SET " + ", ".join(assignments),
+                 ConditionExpression="process_steps[{}].#step = :step".format(int(step_index)),
+                 ExpressionAttributeNames=names,
+                 ExpressionAttributeValues=values)
+
+
+def complete_process_step(region_id, tableId, video_id, step_index, step_name, claimer, **step_values):
+    """
+    set the state of a step entry of a document to "done" (and its other values), and mark the claim on the step as finished,
+    so that it is not claimed again (see claim_process_step). Fails if the entry at step_index is not step_name.
+
+    :param region_id: region of the table
+    :param tableId: table to update
+    :param video_id: VideoId of the document
+    :param step_index: index of the entry in process_steps
+    :param step_name: name of the step
+    :param claimer: id of the claimer
+    :param step_values: other values to set in the step entry (eg result_file)
+    :return: None
+    """
+    assignments, names, values = _step_state_update(step_index, step_name, "done", step_values)
+    names["#claim"] = _claim_attribute(step_name)
+    values[":claim"] = _to_dynamo_db({"claimer": claimer, "claimed_at": time.time(), "finished": True})
+    assignments.append("#claim = :claim")
+    _update_item(region_id, tableId, video_id,
+                 UpdateExpression="SET " + ", ".join(assignments),
+                 ConditionExpression="process_steps[{}].#step = :step".format(int(step_index)),
+                 ExpressionAttributeNames=names,
+                 ExpressionAttributeValues=values)
+
+
+def set_video_attributes(region_id, tableId, video_id, **attributes):
+    """
+    set top-level attributes of a document, which must exist
+
+    :param region_id: region of the table
+    :param tableId: table to update
+    :param video_id: VideoId of the document
+    :param attributes: attributes to set (eg duration=30.)
+    :return: None
+    """
+    names = {}
+    values = {}
+    assignments = []
+    for i, (key, value) in enumerate(attributes.items()):
+        names["#attribute{}".format(i)] = key
+        values[":attribute{}".format(i)] = _to_dynamo_db(value)
+        assignments.append("#attribute{0} = :attribute{0}".format(i))
+
+    _update_item(region_id, tableId, video_id,
+                 UpdateExpression="SET " + ", ".join(assignments),
+                 ConditionExpression="attribute_exists(VideoId)",
+                 ExpressionAttributeNames=names,
+                 ExpressionAttributeValues=values)
+
+
+def append_sub_videos(region_id, tableId, video_id, sub_video_ids):
+    """
+    add videos at the end of the sub_videos of a document, which must exist
+
+    :param region_id: region of the table
+    :param tableId: table to update
+    :param video_id: VideoId of the document
+    :param sub_video_ids: list of VideoId
+    :return: None
+    """
+    _update_item(region_id, tableId, video_id,
+                 UpdateExpression="SET sub_videos = list_append(if_not_exists(sub_videos, :empty_list), :sub_videos)",
+                 ConditionExpression="attribute_exists(VideoId)",
+                 ExpressionAttributeValues={":empty_list": [], ":sub_videos": _to_dynamo_db(list(sub_video_ids))})
+
+
+class VideoDocumentsBatchWriter(object):
+
+    def __init__(self, region_id, tableId):
+        """
+        This class puts new video documents in dynamoDB by batches (batch_write_item, 25 documents per request).
+        Unprocessed documents of a batch are sent again with the next one.
+
+        Use it as a context manager : the last batch is sent on exit.
+
+        :param region_id: region of the table
+        :param tableId: table to insert into
+        """
+        self._table = get_resource('dynamodb', region_id).Table(tableId)
+        self._batch_writer = None
+        self.nb_documents = 0
+
+    def put(self, document):
+        """
+        :param document: dict to insert (index is VideoId, must be filled)
+        """
+        self._batch_writer.put_item(Item=_to_dynamo_db(document))
+        self.nb_documents += 1
+
+    def __enter__(self):
+        self._batch_writer = self._table.batch_writer()
+        self._batch_writer.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self._batch_writer.__exit__(exc_type, exc_val, exc_tb)
+        except Exception as e:
+            if hasattr(e, "message"):
+                e.message = "DynamoDB : " + e.message
+            raise e
@@ -0,0 +1,86 @@
+# Copyright 2019 Cyril Poulet, cyril.poulet@centraliens.net
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from match_interleaver import MatchInterleaver
+
+
+def process_queue(queue, window):
+    """
+    order in which a worker holding up to window messages processes a queue (as SQSWorker.run : the held messages are topped up
+    from the queue, then the interleaver gives the next one)
+
+    :param queue: list of tuple (match id, clip), in the order of the queue
+    :param window: max number of held messages
+    :return: list of tuple (match id, clip), in the order they are processed
+    """
+    queue = collections.deque(queue)
+    interleaver = MatchInterleaver()
+    processed = []
+    while queue or len(interleaver):
+        while queue and len(interleaver) < window:
+            interleaver.add(*queue.popleft())
+        processed.append(interleaver.pop())
+    return processed
+
+
+class TestMatchInterleaver(unittest.TestCase):
+
+    def test_held_matches_are_interleaved(self):
+        interleaver = MatchInterleaver()
+        for clip in range(4):
+            interleaver.add("long", clip)
+        for clip in range(2):
+            interleaver.add("short", clip)
+
+        order = [interleaver.pop() for _ in range(6)]
+        # one clip per match and per round, the match with the fewest held clips first, clips of a match in order
+        self.assertEqual(order, [("short", 0), ("long", 0), ("short", 1), ("long", 1), ("long", 2), ("long", 3)])
+        self.assertEqual(len(interleaver), 0)
+        with self.assertRaises(IndexError):
+            interleaver.pop()
+
+    def test_large_match_enqueued_before_small_one(self):
+        window = 6
+        queue = [("tournament", clip) for clip in range(30)] + [("match", clip) for clip in range(4)]
+        processed = process_queue(queue, window)
+
+        self.assertEqual(sorted(processed), sorted(queue))
+        # the clips of each match keep their order
+        for match_id in ["tournament", "match"]:
+            clips = [clip for processed_match_id, clip in processed if processed_match_id == match_id]
+            self.assertEqual(clips, sorted(clips))
+        # the reordering is local : a clip moves ahead by less than the window, so the small match enqueued after the
+        # tournament still waits for most of it
+        for position, item in enumerate(processed):
+            self.assertGreater(position, queue.index(item) - window)
+        first_match_clip = [match_id for match_id, _ in processed].index("match")
+        self.assertGreaterEqual(first_match_clip, 30 - window + 1)
+        # once its clips are held, the small match goes ahead of the rest of the tournament
+        self.assertEqual(processed[-1][0], "tournament")
+
+    def test_no_window_keeps_queue_order(self):
+        queue = [("tournament", clip) for clip in range(5)] + [("match", clip) for clip in range(2)]
+        self.assertEqual(process_queue(queue, 1), queue)
+
+
+if __name__ == "__main__":
+    unittest.main()
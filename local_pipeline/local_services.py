@@ -0,0 +1,632 @@
+# Copyright 2019 Cyril Poulet, cyril.poulet@centraliens.net
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Local stand-ins of the AWS services used by the pipeline, to run it on one machine (see run_local_pipeline.py) :
+
+    - LocalS3 : buckets are directories, objects are files
+    - LocalDynamoDB : tables are dicts (optionally saved to a SQLite file), and every change is recorded as a stream record,
+                      in the format given by DynamoDB streams to the lambdas
+    - LocalSQS : queues are in-memory deques
+
+They implement the parts of the boto3 clients and resources used by the pipeline (each one acts as both), and are given
+by aws_clients.get_client / get_resource once registered with aws_clients.use_local_services.
+Errors are LocalServiceError, which has the "response" of the boto3 errors.
+"""
+
+import collections
+import copy
+import decimal
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import types
+import uuid
+
+
+class LocalServiceError(Exception):
+
+    def __init__(self, code, message):
+        super(LocalServiceError, self).__init__("{} : {}".format(code, message))
+        self.response = {"Error": {"Code": code, "Message": message}}
+
+
+###############
+# S3
+###############
+
+class LocalS3(object):
+
+    def __init__(self, root_dir):
+        """
+        S3 stand-in : object bucket/key is the file root_dir/bucket/key
+
+        :param root_dir: directory of the buckets
+        """
+        self._root_dir = os.path.abspath(root_dir)
+        self._lock = threading.Lock()
+        # upload id -> {part number: bytes}
+        self._multipart_uploads = {}
+
+    def get_path(self, bucket_name, key):
+        """
+        :return: path of the file of an object
+        """
+        path = os.path.abspath(os.path.join(self._root_dir, bucket_name, key))
+        if not path.startswith(os.path.join(self._root_dir, bucket_name) + os.sep):
+            raise LocalServiceError("InvalidKey", "Key {} is out of bucket {}".format(key, bucket_name))
+        return path
+
+    def _get_existing_path(self, bucket_name, key):
+        path = self.get_path(bucket_name, key)
+        if not os.path.isfile(path):
+            raise LocalServiceError("404", "Object {}/{} does not exist".format(bucket_name, key))
+        return path
+
+    def _write(self, bucket_name, key, write_function):
+        """
+        write an object to a temporary file, then move it to its final name, so that it is never read half written
+        """
+        path = self.get_path(bucket_name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = "{}.{}.part".format(path, uuid.uuid4().hex)
+        try:
+            with open(partial_path, 'wb') as f:
+                write_function(f)
+            os.replace(partial_path, path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    # resource
+    def Bucket(self, bucket_name):
+        return types.SimpleNamespace(download_file=lambda key, filename: self.download_file(bucket_name, key, filename))
+
+    # client
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        shutil.copyfile(self._get_existing_path(Bucket, Key), Filename)
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, 'rb') as source:
+            self._write(Bucket, Key, lambda f: shutil.copyfileobj(source, f))
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        self._write(Bucket, Key, lambda f: shutil.copyfileobj(Fileobj, f))
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        self._write(Bucket, Key, lambda f: f.write(Body))
+        return {}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        stat = os.stat(self._get_existing_path(Bucket, Key))
+        etag = hashlib.md5("{}/{}".format(stat.st_size, stat.st_mtime_ns).encode('utf-8')).hexdigest()
+        return {"ContentLength": stat.st_size, "ETag": '"{}"'.format(etag)}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        path = self._get_existing_path(Bucket, Key)
+        with open(path, 'rb') as f:
+            if Range is None:
+                data = f.read()
+            else:
+                # "bytes=start-end", end included
+                start, end = Range[len("bytes="):].split('-')
+                f.seek(int(start))
+                data = f.read(int(end) - int(start) + 1)
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        path = self.get_path(Bucket, Key)
+        if os.path.isfile(path):
+            os.remove(path)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._multipart_uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        with self._lock:
+            self._multipart_uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": '"{}"'.format(hashlib.md5(Body).hexdigest())}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        with self._lock:
+            parts = self._multipart_uploads.pop(UploadId)
+
+        def write_parts(f):
+            for part in MultipartUpload["Parts"]:
+                f.write(parts[part["PartNumber"]])
+        self._write(Bucket, Key, write_parts)
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        with self._lock:
+            self._multipart_uploads.pop(UploadId, None)
+        return {}
+
+
+###############
+# SQS
+###############
+
+class LocalMessage(object):
+
+    def __init__(self, queue, body):
+        self.queue = queue
+        self.body = body
+        self.message_id = uuid.uuid4().hex
+
+    def delete(self):
+        self.queue.delete_message(self)
+
+    def change_visibility(self, VisibilityTimeout):
+        pass
+
+
+class LocalQueue(object):
+
+    def __init__(self, name):
+        """
+        SQS queue stand-in. Received messages are not sent again if they are not deleted (no visibility timeout)
+        """
+        self.url = name
+        self._messages = collections.deque()
+        self._condition = threading.Condition()
+        self.nb_sent = 0
+        self.nb_deleted = 0
+
+    def __len__(self):
+        return len(self._messages)
+
+    def send_message(self, MessageBody, **kwargs):
+        message = LocalMessage(self, MessageBody)
+        with self._condition:
+            self._messages.append(message)
+            self.nb_sent += 1
+            self._condition.notify_all()
+        return {"MessageId": message.message_id}
+
+    def delete_message(self, message):
+        with self._condition:
+            self.nb_deleted += 1
+
+    def receive_messages(self, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        with self._condition:
+            if not self._messages and WaitTimeSeconds:
+                self._condition.wait(WaitTimeSeconds)
+            messages = []
+            while self._messages and len(messages) < MaxNumberOfMessages:
+                messages.append(self._messages.popleft())
+            return messages
+
+
+class LocalSQS(object):
+
+    def __init__(self):
+        """
+        SQS stand-in : queues are in memory. Queue urls are the queue names
+        """
+        self._queues = {}
+
+    def create_queue(self, QueueName, **kwargs):
+        queue = self._queues.setdefault(QueueName, LocalQueue(QueueName))
+        return queue
+
+    def _get_queue(self, queue_name):
+        if queue_name not in self._queues:
+            raise LocalServiceError("AWS.SimpleQueueService.NonExistentQueue", "Queue {} does not exist".format(queue_name))
+        return self._queues[queue_name]
+
+    # resource
+    def get_queue_by_name(self, QueueName):
+        return self._get_queue(QueueName)
+
+    # client
+    def get_queue_url(self, QueueName):
+        return {"QueueUrl": self._get_queue(QueueName).url}
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        return self._get_queue(QueueUrl).send_message(MessageBody)
+
+    def send_message_batch(self, QueueUrl, Entries):
+        queue = self._get_queue(QueueUrl)
+        for entry in Entries:
+            queue.send_message(entry["MessageBody"])
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+
+###############
+# DynamoDB
+###############
+
+def to_stream_format(value):
+    """
+    convert a python value (as stored by boto3 : Decimal for numbers) to the typed format of DynamoDB streams (eg {"N": "30"})
+    """
+    if isinstance(value, bool):
+        return {"BOOL": value}
+    if value is None:
+        return {"NULL": True}
+    if isinstance(value, (int, float, decimal.Decimal)):
+        value = decimal.Decimal(str(value))
+        return {"N": str(int(value)) if value == value.to_integral_value() else str(value)}
+    if isinstance(value, str):
+        return {"S": value}
+    if isinstance(value, (bytes, bytearray)):
+        return {"B": bytes(value)}
+    if isinstance(value, (set, frozenset)):
+        if all(isinstance(element, str) for element in value):
+            return {"SS": sorted(value)}
+        return {"NS": sorted(to_stream_format(element)["N"] for element in value)}
+    if isinstance(value, dict):
+        return {"M": {key: to_stream_format(element) for key, element in value.items()}}
+    return {"L": [to_stream_format(element) for element in value]}
+
+
+def from_stream_format(typed_value):
+    """
+    convert a value in the typed format of DynamoDB streams back to a python value
+    """
+    value_type, value = next(iter(typed_value.items()))
+    if value_type == "N":
+        return decimal.Decimal(value)
+    if value_type == "NS":
+        return {decimal.Decimal(element) for element in value}
+    if value_type == "SS":
+        return set(value)
+    if value_type == "NULL":
+        return None
+    if value_type == "M":
+        return {key: from_stream_format(element) for key, element in value.items()}
+    if value_type == "L":
+        return [from_stream_format(element) for element in value]
+    return value
+
+
+_missing = object()
+_expression_token = re.compile(r"\s*(?:(#\w+)|(:\w+)|(\[\d+\])|(\w+)|(<>|<=|>=|[=<>(),.]))")
+_comparators = {"=": lambda a, b: a == b,
+                "<>": lambda a, b: a != b,
+                "<": lambda a, b: a < b,
+                "<=": lambda a, b: a <= b,
+                ">": lambda a, b: a > b,
+                ">=": lambda a, b: a >= b}
+
+
+def _get_path(item, path):
+    value = item
+    for element in path:
+        try:
+            value = value[element]
+        except (KeyError, IndexError, TypeError):
+            return _missing
+    return value
+
+
+def _copy_value(value):
+    return value if value is _missing else copy.deepcopy(value)
+
+
+def _set_path(item, path, value):
+    parent = _get_path(item, path[:-1])
+    if parent is _missing:
+        raise LocalServiceError("ValidationException", "The document path provided in the update expression is invalid")
+    if isinstance(path[-1], int) and path[-1] >= len(parent):
+        parent.append(value)
+    else:
+        parent[path[-1]] = value
+
+
+def _remove_path(item, path):
+    parent = _get_path(item, path[:-1])
+    if parent is not _missing and _get_path(item, path) is not _missing:
+        del parent[path[-1]]
+
+
+class _Expression(object):
+
+    def __init__(self, expression, names, values):
+        """
+        parser of the condition and update expressions of DynamoDB (the parts used by video_documents : SET with list_append
+        and if_not_exists, REMOVE, comparisons, AND / OR, parentheses, attribute_exists, attribute_not_exists)
+        Operands are parsed to functions of the item.
+        """
+        self._tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = _expression_token.match(expression, position)
+            if match is None:
+                raise LocalServiceError("ValidationException", "Invalid expression : {}".format(expression))
+            self._tokens.append(match.group(match.lastindex))
+            position = match.end()
+        self._position = 0
+        self._names = names or {}
+        self._values = values or {}
+
+    def _peek(self):
+        return self._tokens[self._position] if self._position < len(self._tokens) else None
+
+    def _next(self, expected=None):
+        token = self._peek()
+        if expected is not None and (token is None or token.upper() != expected):
+            raise LocalServiceError("ValidationException", "Expected {} in expression, got {}".format(expected, token))
+        self._position += 1
+        return token
+
+    def _parse_path(self):
+        path = []
+        while True:
+            token = self._next()
+            path.append(self._names[token] if token.startswith('#') else token)
+            while self._peek() is not None and self._peek().startswith('['):
+                path.append(int(self._next()[1:-1]))
+            if self._peek() != '.':
+                return path
+            self._next('.')
+
+    def _parse_operand(self):
+        token = self._peek()
+        if token.startswith(':'):
+            value = self._values[self._next()]
+            return lambda item: copy.deepcopy(value)
+        if token in ["list_append", "if_not_exists"] and self._tokens[self._position + 1] == '(':
+            self._next()
+            self._next('(')
+            if token == "list_append":
+                first = self._parse_operand()
+                self._next(',')
+                second = self._parse_operand()
+                self._next(')')
+                return lambda item: first(item) + second(item)
+            path = self._parse_path()
+            self._next(',')
+            default = self._parse_operand()
+            self._next(')')
+            return lambda item: _copy_value(_get_path(item, path)) if _get_path(item, path) is not _missing else default(item)
+        path = self._parse_path()
+        return lambda item: _copy_value(_get_path(item, path))
+
+    def parse_condition(self):
+        condition = self._parse_or()
+        if self._peek() is not None:
+            raise LocalServiceError("ValidationException", "Unexpected {} in condition".format(self._peek()))
+        return condition
+
+    def _parse_or(self):
+        conditions = [self._parse_and()]
+        while self._peek() is not None and self._peek().upper() == "OR":
+            self._next()
+            conditions.append(self._parse_and())
+        return lambda item: any(condition(item) for condition in conditions)
+
+    def _parse_and(self):
+        conditions = [self._parse_term()]
+        while self._peek() is not None and self._peek().upper() == "AND":
+            self._next()
+            conditions.append(self._parse_term())
+        return lambda item: all(condition(item) for condition in conditions)
+
+    def _parse_term(self):
+        if self._peek() == '(':
+            self._next('(')
+            condition = self._parse_or()
+            self._next(')')
+            return condition
+        token = self._peek()
+        if token in ["attribute_exists", "attribute_not_exists"]:
+            self._next()
+            self._next('(')
+            path = self._parse_path()
+            self._next(')')
+            if token == "attribute_exists":
+                return lambda item: _get_path(item, path) is not _missing
+            return lambda item: _get_path(item, path) is _missing
+        first = self._parse_operand()
+        comparator = _comparators[self._next()]
+        second = self._parse_operand()
+
+        def compare(item):
+            first_value, second_value = first(item), second(item)
+            if first_value is _missing or second_value is _missing:
+                return False
+            return comparator(first_value, second_value)
+        return compare
+
+    def parse_update(self):
+        """
+        :return: list of tuple (action, path, operand function)
+        """
+        actions = []
+        action = None
+        while self._peek() is not None:
+            if self._peek().upper() in ["SET", "REMOVE"]:
+                action = self._next().upper()
+            elif self._peek() == ',':
+                self._next()
+            elif action is None:
+                raise LocalServiceError("ValidationException", "Unsupported update action {}".format(self._peek()))
+            path = self._parse_path()
+            if action == "SET":
+                self._next('=')
+                actions.append((action, path, self._parse_operand()))
+            else:
+                actions.append((action, path, None))
+        return actions
+
+
+class LocalTable(object):
+
+    def __init__(self, dynamodb, name, key_name="VideoId"):
+        """
+        DynamoDB table stand-in, holding the documents in a dict
+
+        :param dynamodb: LocalDynamoDB of the table
+        :param name: name of the table
+        :param key_name: name of the key attribute of the documents
+        """
+        self._dynamodb = dynamodb
+        self.name = name
+        self.key_name = key_name
+        self.items = {}
+        self._lock = threading.Lock()
+        exceptions = types.SimpleNamespace(ConditionalCheckFailedException=LocalConditionalCheckFailed)
+        self.meta = types.SimpleNamespace(client=types.SimpleNamespace(exceptions=exceptions))
+
+    def _get_key(self, key):
+        return decimal.Decimal(str(key[self.key_name]))
+
+    def _store(self, key, old_item, new_item):
+        self.items[key] = new_item
+        self._dynamodb.record_change(self, old_item, new_item)
+
+    def put_item(self, Item, **kwargs):
+        item = copy.deepcopy(Item)
+        key = self._get_key(item)
+        with self._lock:
+            self._store(key, self.items.get(key), item)
+        return {}
+
+    def get_item(self, Key, **kwargs):
+        with self._lock:
+            item = self.items.get(self._get_key(Key))
+            return {"Item": copy.deepcopy(item)} if item is not None else {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues="NONE", **kwargs):
+        actions = _Expression(UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues).parse_update()
+        condition = None
+        if ConditionExpression:
+            condition = _Expression(ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues).parse_condition()
+
+        key = self._get_key(Key)
+        with self._lock:
+            old_item = self.items.get(key)
+            current_item = old_item if old_item is not None else {}
+            if condition is not None and not condition(current_item):
+                raise LocalConditionalCheckFailed("ConditionalCheckFailedException", "The conditional request failed")
+
+            new_item = copy.deepcopy(current_item)
+            new_item[self.key_name] = copy.deepcopy(Key[self.key_name])
+            # all operands are evaluated on the document before the update
+            values = [operand(current_item) if operand is not None else None for _, _, operand in actions]
+            for (action, path, _), value in zip(actions, values):
+                if action == "SET":
+                    _set_path(new_item, path, value)
+                else:
+                    _remove_path(new_item, path)
+            self._store(key, old_item, new_item)
+
+            if ReturnValues == "UPDATED_NEW":
+                updated_names = set(path[0] for _, path, _ in actions)
+                return {"Attributes": {name: copy.deepcopy(new_item[name]) for name in updated_names if name in new_item}}
+            if ReturnValues == "ALL_NEW":
+                return {"Attributes": copy.deepcopy(new_item)}
+        return {}
+
+    def batch_writer(self, **kwargs):
+        return LocalBatchWriter(self)
+
+
+class LocalConditionalCheckFailed(LocalServiceError):
+    pass
+
+
+class LocalBatchWriter(object):
+
+    def __init__(self, table):
+        self._table = table
+
+    def put_item(self, Item):
+        self._table.put_item(Item=Item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class LocalDynamoDB(object):
+
+    def __init__(self, database_file=None):
+        """
+        DynamoDB stand-in : tables are dicts. Each change of a document is recorded as a DynamoDB stream record
+        (NEW_AND_OLD_IMAGES), to be given to the lambdas triggered by the stream (see pop_stream_records).
+
+        :param database_file: SQLite file to save the documents to (and load them from, if it exists), or None to keep them in memory only
+        """
+        self._tables = {}
+        self._stream_records = collections.deque()
+        self._lock = threading.Lock()
+        self._database = None
+        if database_file is not None:
+            self._database = sqlite3.connect(database_file, check_same_thread=False)
+            self._database.execute("CREATE TABLE IF NOT EXISTS documents "
+                                   "(table_name TEXT, document_key TEXT, document TEXT, PRIMARY KEY (table_name, document_key))")
+            for table_name, document in self._database.execute("SELECT table_name, document FROM documents").fetchall():
+                table = self.Table(table_name)
+                item = from_stream_format(json.loads(document))
+                table.items[table._get_key(item)] = item
+
+    # resource
+    def Table(self, name):
+        with self._lock:
+            if name not in self._tables:
+                self._tables[name] = LocalTable(self, name)
+            return self._tables[name]
+
+    def record_change(self, table, old_item, new_item):
+        """
+        called by the tables on each change of a document
+        """
+        new_image = to_stream_format(new_item)["M"]
+        record = {"eventName": "INSERT" if old_item is None else "MODIFY",
+                  "eventSource": "aws:dynamodb",
+                  "dynamodb": {"Keys": {table.key_name: new_image[table.key_name]},
+                               "NewImage": new_image,
+                               "StreamViewType": "NEW_AND_OLD_IMAGES"}}
+        if old_item is not None:
+            record["dynamodb"]["OldImage"] = to_stream_format(old_item)["M"]
+        with self._lock:
+            self._stream_records.append(record)
+            if self._database is not None:
+                with self._database:
+                    self._database.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?)",
+                                           (table.name, new_image[table.key_name]["N"], json.dumps({"M": new_image})))
+
+    def pop_stream_records(self, max_records=None):
+        """
+        :param max_records: max number of records to get, None for all
+        :return: list of the oldest stream records, in the format of the "Records" of the events given to lambdas
+        """
+        with self._lock:
+            records = []
+            while self._stream_records and (max_records is None or len(records) < max_records):
+                records.append(self._stream_records.popleft())
+            return records
+
+    def close(self):
+        if self._database is not None:
+            self._database.close()
@@ -0,0 +1,231 @@
+# Copyright 2019 Cyril Poulet, cyril.poulet@centraliens.net
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Runs the whole pipeline in this process, on local stand-ins of S3, DynamoDB and SQS (see local_services.py) :
+
+    upload -> split (derbyTimeSplitVideoLambda) -> DynamoDB stream -> dispatch (awsQueueManagement) -> SQS -> human detection worker
+
+The code of each part is the one deployed on AWS, only the boto3 clients are replaced (see aws_clients.use_local_services).
+Each stage is timed, so the pipeline can be benchmarked and profiled on one machine, or used to process archives of matches.
+"""
+
+import argparse
+import collections
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(project_dir, "human_detector", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import aws_clients
+from local_services import LocalS3, LocalDynamoDB, LocalSQS
+
+# max number of records given to the dispatch lambda at once (batch size of the DynamoDB stream trigger)
+stream_batch_size = 100
+
+
+def load_lambda(name, lambda_dir):
+    """
+    import the lambda_function.py of a lambda under another name, as all lambdas use the same file name
+
+    :param name: name to give to the module
+    :param lambda_dir: directory of the lambda
+    :return: module
+    """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(project_dir, lambda_dir, "lambda_function.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class LocalPipeline(object):
+
+    def __init__(self, data_dir, params, database_file=None, ffmpeg_exe=None, logger=None):
+        """
+        This class runs the steps of the pipeline one after the other, on local stand-ins of the AWS services.
+
+        :param data_dir: directory of the buckets (see LocalS3)
+        :param params: variables of the project (variables.json)
+        :param database_file: SQLite file to keep the DynamoDB documents in, or None to keep them in memory
+        :param ffmpeg_exe: ffmpeg executable used by the split, or None to use the one on the PATH
+        :param logger: Logging.Logger object to log to
+        """
+        self.params = params
+        self.s3 = LocalS3(data_dir)
+        self.dynamodb = LocalDynamoDB(database_file)
+        self.sqs = LocalSQS()
+        # queues are created at deployment
+        for queue_name in params["aws_queues"].values():
+            self.sqs.create_queue(QueueName=queue_name.lower())
+        aws_clients.use_local_services({"s3": self.s3, "dynamodb": self.dynamodb, "sqs": self.sqs})
+
+        self.split_lambda = load_lambda("split_lambda", "derbyTimeSplitVideoLambda")
+        self.dispatch_lambda = load_lambda("dispatch_lambda", "awsQueueManagement")
+        # the lambdas use the same variables as the pipeline, instead of their own variables.json
+        self.dispatch_lambda.params = params
+        os.environ["IMAGEIO_FFMPEG_EXE"] = ffmpeg_exe or shutil.which("ffmpeg") or "ffmpeg"
+
+        self._logger = logger or logging.getLogger("LocalPipeline")
+        # stage name -> total duration, in sec
+        self.timings = collections.OrderedDict()
+
+    def _timed(self, stage_name, function, *args, **kwargs):
+        start_time = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.timings[stage_name] = self.timings.get(stage_name, 0.) + time.time() - start_time
+
+    def upload(self, video_file):
+        """
+        put a video in the upload bucket, as the upload page does
+
+        :param video_file: path to the video
+        :return: key of the video in the upload bucket
+        """
+        key = "{}/{}".format(self.params["video_upload"]["s3_upload_startkey"], os.path.basename(video_file))
+        self._logger.info("Uploading {} to {}".format(video_file, key))
+        self._timed("upload", self.s3.upload_file, video_file, self.params["video_upload"]["upload_bucket_name"], key)
+        return key
+
+    def split(self, key):
+        """
+        split an uploaded video (what the split lambda does when the video is uploaded)
+
+        :param key: key of the video in the upload bucket
+        """
+        split_params = self.params["video_split"]
+        self._logger.info("Splitting {}".format(key))
+        self._timed("split", self.split_lambda.transfer_and_split_in_sequences,
+                    self.params["video_upload"]["upload_bucket_name"], key,
+                    split_params["output_bucket"], split_params["output_key_prefix"],
+                    split_params["output_files_duration_in_sec"],
+                    self.params["dynamodb"]["region"], self.params["dynamodb"]["table_id"],
+                    split_params.get("nb_encoding_processes", self.split_lambda.default_nb_encoding_processes),
+                    split_params.get("nb_upload_threads", self.split_lambda.default_nb_upload_threads),
+                    split_params.get("split_mode", "encode"),
+                    split_params.get("streaming_input", False),
+                    split_params.get("direct_upload", False))
+
+    def dispatch(self):
+        """
+        give the pending DynamoDB stream records to the dispatch lambda, by batches, until there are none left
+
+        :return: dict {queue name: number of messages sent}
+        """
+        dispatched = collections.Counter()
+        while True:
+            records = self.dynamodb.pop_stream_records(stream_batch_size)
+            if not records:
+                return dict(dispatched)
+            response = self._timed("dispatch", self.dispatch_lambda.lambda_handler, {"Records": records}, None)
+            dispatched.update(response["dispatched"])
+
+    def detect_humans(self, results_format=None):
+        """
+        run a human detection worker on the messages of its queue, until the queue is empty
+
+        :param results_format: format of the result files (see results_writer.results_formats),
+                               or None for the "results_format" of the "human_detection_worker" variables
+        """
+        # imported here, as it needs tensorflow and the models
+        from aws_interface import SQSWorker, default_messages_in_flight, default_scheduling_window
+        from video_analyzer import VideoAnalyzer
+
+        step_name = "human_detection"
+        worker_params = self.params.get("human_detection_worker", {})
+        queue = self.sqs.get_queue_by_name(QueueName=self.params["aws_queues"][step_name].lower())
+        # the worker processes the messages received before the stop command, then returns
+        queue.send_message(MessageBody=json.dumps({"command": "stop"}))
+
+        video_analyzer = self._timed("detection_setup", VideoAnalyzer, **self.params["human_detection"])
+        try:
+            worker = SQSWorker(queue, step_name, video_analyzer,
+                               self.params["aws_region"], self.params["dynamodb"]["region"], self.params["dynamodb"]["table_id"],
+                               self._logger,
+                               messages_in_flight=worker_params.get("messages_in_flight", default_messages_in_flight),
+                               results_format=results_format or worker_params.get("results_format", "json"),
+                               scheduling_window=worker_params.get("scheduling_window", default_scheduling_window))
+            self._timed(step_name, worker.run)
+        finally:
+            video_analyzer.close()
+
+    def get_documents(self):
+        """
+        :return: list of the documents of the videos
+        """
+        return list(self.dynamodb.Table(self.params["dynamodb"]["table_id"]).items.values())
+
+    def close(self):
+        self.dynamodb.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the pipeline on local videos, without AWS")
+    parser.add_argument("videos", nargs="+", help="videos to process")
+    parser.add_argument("--data-dir", default="local_data", help="directory of the local buckets (default: local_data)")
+    parser.add_argument("--database", default=None, help="SQLite file to keep the video documents in (default: in memory)")
+    parser.add_argument("--ffmpeg", default=None, help="ffmpeg executable (default: ffmpeg on the PATH)")
+    parser.add_argument("--results-format", default=None,
+                        help="format of the human detection results (json, jsonl, npz). Default: results_format of the variables")
+    parser.add_argument("--no-detection", action="store_true", help="only split the videos and dispatch the clips")
+    parser.add_argument("--variables", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "variables.json"),
+                        help="variables of the project (default: variables.json)")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout,
+                        level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger("LocalPipeline")
+
+    with open(args.variables) as f:
+        params = json.load(f)
+
+    pipeline = LocalPipeline(args.data_dir, params, args.database, args.ffmpeg, logger)
+    start_time = time.time()
+    try:
+        for video_file in args.videos:
+            pipeline.split(pipeline.upload(video_file))
+            logger.info("Dispatched : {}".format(pipeline.dispatch()))
+
+        if not args.no_detection:
+            pipeline.detect_humans(args.results_format)
+            logger.info("Dispatched : {}".format(pipeline.dispatch()))
+    finally:
+        pipeline.close()
+    total_time = time.time() - start_time
+
+    documents = pipeline.get_documents()
+    clips = [document for document in documents if "parent_video" in document]
+    steps_states = collections.Counter("{}:{}".format(step["step"], step["state"])
+                                       for document in clips for step in document["process_steps"])
+    print("\n{} videos, {} clips ({:.1f}s of video) in {:.1f}s".format(len(args.videos), len(clips),
+                                                                      float(sum(clip.get("duration", 0) for clip in clips)),
+                                                                      total_time))
+    for stage_name, duration in pipeline.timings.items():
+        print("    {:<16} {:8.2f}s".format(stage_name, duration))
+    print("Steps of the clips : {}".format(dict(steps_states)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+../human_detector/src/aws_clients.py
\ No newline at end of file
@@ -0,0 +1 @@
+../human_detector/src/columnar_results.py
\ No newline at end of file
@@ -3,7 +3,9 @@ import os
 import tempfile
 
 import cv2
-import boto3
+from aws_clients import get_client, get_resource
+from video_documents import set_process_step_state
+from columnar_results import ColumnarResults
 
 
 ###############
@@ -19,7 +21,7 @@ def get_object_from_s3(region_id, bucket_name, key, local_filename):
     :param local_filename: path to file to write
     :return: None
     """
-    s3 = boto3.resource('s3', region_name=region_id)
+    s3 = get_resource('s3', region_id)
     try:
         res = s3.Bucket(bucket_name).download_file(key, local_filename)
     except Exception as e:
@@ -37,7 +39,7 @@ def put_object_to_s3(region_id, local_filename, bucket_name, key):
     :param key: key of the file to write in the bucket
     :return: None
     """
-    s3 = boto3.client('s3', region_name=region_id)
+    s3 = get_client('s3', region_id)
     try:
         s3.upload_file(local_filename, bucket_name, key)
     except Exception as e:
@@ -60,7 +62,7 @@ def get_video_info_from_dynamo_db(region_id, tableId, search_keys):
     :param document: dict to get from
     :return: None
     """
-    dynamodb = boto3.resource('dynamodb', region_name=region_id) #, endpoint_url="http://localhost:8000")
+    dynamodb = get_resource('dynamodb', region_id)
     table = dynamodb.Table(tableId)
     # trick to turn floats and ints to Decimal for DynamoDB
     response = table.get_item(Key=search_keys)
@@ -83,7 +85,7 @@ def send_video_info_to_dynamo_db(region_id, tableId, document):
     :param document: dict to insert
     :return: None
     """
-    dynamodb = boto3.resource('dynamodb', region_name=region_id) #, endpoint_url="http://localhost:8000")
+    dynamodb = get_resource('dynamodb', region_id)
     table = dynamodb.Table(tableId)
     # trick to turn floats and ints to Decimal for DynamoDB
     try:
@@ -99,10 +101,32 @@ def send_video_info_to_dynamo_db(region_id, tableId, document):
 # Main functions
 #####################
 
-def create_movie_from_result_file(video_file, result_file, output_video_file):
+def iter_results_frames(result_file):
+    """
+    iterate over the frames of a result file of the human detection, in "json", "jsonl" or "npz" format
+    (see human_detector/src/results_writer.py). "jsonl" files are read line by line, and "npz" files are memory-mapped
+    (see columnar_results.py), so only the json format is loaded at once.
+
+    :param result_file: path to the result file
+    :return: generator of dict (frames of VideoAnalyzer.analyze_video), in order
+    """
+    if result_file.endswith('.npz'):
+        yield from ColumnarResults(result_file).iter_frames()
+        return
     with open(result_file) as f:
-        results = json.load(f)
-        frames_results = results["frames"]
+        if not result_file.endswith('.jsonl'):
+            yield from json.load(f)["frames"]
+            return
+        # first line holds the video information, then one line per frame
+        f.readline()
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def create_movie_from_result_file(video_file, result_file, output_video_file):
+    frames_results = iter_results_frames(result_file)
+    frame_values = next(frames_results, None)
 
     cap = cv2.VideoCapture(video_file)
 
@@ -114,7 +138,7 @@ def create_movie_from_result_file(video_file, result_file, output_video_file):
     current_frame_ind = 0
 
     while True:
-        if not frames_results:
+        if frame_values is None:
             break
 
         r, img = cap.read()
@@ -122,13 +146,12 @@ def create_movie_from_result_file(video_file, result_file, output_video_file):
             break
 
         current_frame_ind += 1
-        while frames_results and frames_results[0]["frame_index"] < current_frame_ind:
-            frames_results.pop(0)
-        if not frames_results or frames_results[0]["frame_index"] > current_frame_ind:
+        while frame_values is not None and frame_values["frame_index"] < current_frame_ind:
+            frame_values = next(frames_results, None)
+        if frame_values is None or frame_values["frame_index"] > current_frame_ind:
             continue
 
         im_height, im_width, _ = img.shape
-        frame_values = frames_results[0]
         out_img = img.copy()
         for key in frame_values:
             if key.lower() in ["human", "face"]:
@@ -151,40 +174,55 @@ def create_movie_from_result_file(video_file, result_file, output_video_file):
 def create_control_movie( video_id, step_name,
                           video_s3_region_id, video_s3_bucket, video_s3_key,
                           dyndb_region_id, dyndb_tableId,
-                          logger):
+                          logger, file_cache=None):
+    """
+    :param file_cache: S3FileCache (see s3_cache.py) to get the video from, or None to download it to a temp file.
+                       With a cache, the video is prefetched while the result file is downloaded, and is not downloaded
+                       again if the analysis worker already cached it.
+    """
 
     # get doc from dynamodb
     logger.info("Getting doc from dynamoDB")
     video_doc = get_video_info_from_dynamo_db(dyndb_region_id, dyndb_tableId, {"VideoId": int(video_id)})
 
     result_file = None
+    step_index = None
     for i in range(len(video_doc["process_steps"])):
         if video_doc["process_steps"][i]["step"] == step_name:
+            step_index = i
             if "result_file" in video_doc["process_steps"][i]:
                 result_file = video_doc["process_steps"][i]["result_file"]
             break
 
     if result_file is None:
         logger.error('Could not find path to result file for doc {}, step {}'.format(video_id, step_name))
+        return
+
+    if file_cache is not None:
+        file_cache.prefetch(video_s3_region_id, video_s3_bucket, video_s3_key)
 
     video_temp_file = tempfile.NamedTemporaryFile(delete=False)
-    results_temp_file = tempfile.NamedTemporaryFile(delete=False)
+    video_file = video_temp_file.name
+    results_temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(result_file["key"])[1])
     output_video_temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.mp4')
 
     try:
+        # get result file
+        logger.info("Getting result file from S3: {}/{}".format(result_file["bucket"], result_file["key"]))
+        get_object_from_s3(video_s3_region_id, result_file["bucket"], result_file["key"], results_temp_file.name)
+
         # get video from s3
         logger.info("Getting video from S3: {}/{}".format(video_s3_bucket, video_s3_key))
-        get_object_from_s3(video_s3_region_id, video_s3_bucket, video_s3_key, video_temp_file.name)
+        if file_cache is not None:
+            video_file = file_cache.get_file(video_s3_region_id, video_s3_bucket, video_s3_key)
+        else:
+            get_object_from_s3(video_s3_region_id, video_s3_bucket, video_s3_key, video_temp_file.name)
         video_name = os.path.basename(video_s3_key)
         video_name = video_name[:video_name.rfind('.')]
 
-        # get result file
-        logger.info("Getting result file from S3: {}/{}".format(result_file["bucket"], result_file["key"]))
-        get_object_from_s3(video_s3_region_id, result_file["bucket"], result_file["key"], results_temp_file.name)
-
         # generate video
         logger.info("Generating control video")
-        create_movie_from_result_file(video_temp_file.name, results_temp_file.name, output_video_temp_file.name)
+        create_movie_from_result_file(video_file, results_temp_file.name, output_video_temp_file.name)
 
         # push result to s3
         video_key_path = os.path.dirname(video_s3_key)  # this is project_name/split
@@ -192,14 +230,10 @@ def create_control_movie( video_id, step_name,
         logger.info("Pushing control video to s3 : {}/{}".format(video_s3_bucket, result_key))
         put_object_to_s3(video_s3_region_id, results_temp_file.name, video_s3_bucket, result_key)
 
-        # update dynamoDB document
+        # update dynamoDB document (only the step entry, see video_documents.py)
         logger.info("Updating doc on dynamoDB")
-        for i in range(len(video_doc["process_steps"])):
-            if video_doc["process_steps"][i]["step"] == step_name:
-                video_doc["process_steps"][i]["state"] = "done"
-                video_doc["process_steps"][i]["control_video"] = {"bucket": video_s3_bucket, "key": result_key}
-                break
-        send_video_info_to_dynamo_db(dyndb_region_id, dyndb_tableId, video_doc)
+        set_process_step_state(dyndb_region_id, dyndb_tableId, int(video_id), step_index, step_name, "done",
+                               control_video={"bucket": video_s3_bucket, "key": result_key})
 
     except Exception as e:
         raise e
@@ -207,6 +241,8 @@ def create_control_movie( video_id, step_name,
     finally:
         # clean
         os.remove(video_temp_file.name)
+        if video_file != video_temp_file.name:
+            file_cache.release(video_file)
         os.remove(results_temp_file.name)
         os.remove(output_video_temp_file.name)
 
@@ -0,0 +1 @@
+../human_detector/src/s3_cache.py
\ No newline at end of file